@@ -0,0 +1,20 @@
+"""
+
+Helpers shared by the benchmarks, importing it puts the repository on sys.path so vaxonbot can be imported
+
+    load_app(**settings)    ->  create_app(**settings) run from the repository root, where the metadata files are
+
+"""
+
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,REPO_ROOT)
+
+
+def load_app(**settings):
+    ## The bot reads its metadata relative to the working directory
+    import vaxonbot
+    os.chdir(REPO_ROOT)
+    return vaxonbot.create_app(**settings)
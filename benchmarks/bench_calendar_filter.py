@@ -0,0 +1,120 @@
+"""
+
+Micro-benchmark of the calendar availability filter
+
+Compares util_parse_calendar against the nested list comprehensions print_calendar used to run
+(one pass to find available centers, a second pass over the same sessions for available sessions)
+
+usage       :   python benchmarks/bench_calendar_filter.py [--payload calendar.json] [--centers N] [--repeat R]
+
+Without --payload a calendarByDistrict shaped payload is generated, with --payload a recorded
+response saved from the CoWIN API is used
+
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,REPO_ROOT)
+
+from vaxonbot.calendars import util_parse_calendar
+
+
+def generate_payload(centers,days=7,available_ratio=0.3,seed=7):
+    rng = random.Random(seed)
+    payload = {'centers' : []}
+    for center_id in range(centers):
+        sessions = []
+        for day in range(days):
+            available = rng.random() < available_ratio
+            sessions.append({
+                'session_id'                : f'{center_id:06d}-{day}',
+                'date'                      : f'{day+1:02d}-06-2021',
+                'available_capacity'        : 0,
+                'available_capacity_dose1'  : rng.randint(1,50) if available else 0,
+                'available_capacity_dose2'  : rng.randint(0,50) if available else 0,
+                'min_age_limit'             : rng.choice((18,45)),
+                'vaccine'                   : rng.choice(('COVISHIELD','COVAXIN','SPUTNIK V')),
+                'slots'                     : ['09:00AM-11:00AM','11:00AM-01:00PM','01:00PM-03:00PM','03:00PM-05:00PM'],
+            })
+        payload['centers'].append({
+            'center_id'     : center_id,
+            'name'          : f'Primary Health Centre {center_id}',
+            'address'       : f'{center_id} Main Road',
+            'state_name'    : 'Kerala',
+            'district_name' : 'Ernakulam',
+            'block_name'    : 'Block',
+            'pincode'       : 682000 + center_id % 100,
+            'lat'           : 10,
+            'long'          : 76,
+            'from'          : '09:00:00',
+            'to'            : '17:00:00',
+            'fee_type'      : rng.choice(('Free','Paid')),
+            'sessions'      : sessions,
+        })
+    return payload
+
+
+def comprehension_filter(resp_obj):
+    available_centers = [ center for center in resp_obj['centers'] if ( [] != [session for session in center['sessions'] if (session['available_capacity_dose1']+session['available_capacity_dose2'] > 0)]) ]
+    return [ (center, [ session for session in center['sessions'] if (session["available_capacity_dose1"]+session["available_capacity_dose2"] > 0) ]) for center in available_centers ]
+
+
+def retained_bytes(raw,filter_calendar):
+    ## Memory still held once the response is parsed, filtered and only the filter's result is kept,
+    ## the comprehensions keep references into the parsed payload so all of it stays alive
+    tracemalloc.start()
+    result = filter_calendar(json.loads(raw))
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained
+
+
+def time_filters(resp_obj,repeat):
+    ## The cases hold on to resp_obj only until this returns, so the memory measurement after it starts clean
+    cases = [
+        ('comprehensions',          lambda : comprehension_filter(resp_obj)),
+        ('util_parse_calendar',     lambda : util_parse_calendar(resp_obj)),
+        ('util_parse_calendar 18+ dose 1', lambda : util_parse_calendar(resp_obj,min_age=18,dose=1)),
+    ]
+    for name, case in cases:
+        best = min(timeit.repeat(case,number=1,repeat=repeat))
+        print(f'{name:<32} {best*1000:8.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--payload',help='recorded calendarByDistrict/calendarByPin JSON response')
+    parser.add_argument('--centers',type=int,default=5000,help='centers in the generated payload')
+    parser.add_argument('--repeat',type=int,default=20)
+    args = parser.parse_args()
+
+    if ( args.payload ):
+        with open(args.payload) as payload_file:
+            resp_obj = json.load(payload_file)
+    else :
+        resp_obj = generate_payload(args.centers)
+    session_count = sum(len(center['sessions']) for center in resp_obj['centers'])
+    print(f'{len(resp_obj["centers"])} centers, {session_count} sessions, {len(json.dumps(resp_obj))/1e6:.1f} MB of JSON')
+
+    old = comprehension_filter(resp_obj)
+    new = util_parse_calendar(resp_obj)
+    assert [ center['center_id'] for center, _ in old ] == [ center.center_id for center, _ in new ]
+
+    time_filters(resp_obj,args.repeat)
+
+    raw = json.dumps(resp_obj)
+    del resp_obj, old, new
+    for name, filter_calendar in (('comprehensions',comprehension_filter),('util_parse_calendar',util_parse_calendar)):
+        print(f'{name:<32} {retained_bytes(raw,filter_calendar)/1e6:8.2f} MB retained')
+
+
+if __name__ == '__main__':
+    main()
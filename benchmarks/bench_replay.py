@@ -0,0 +1,270 @@
+"""
+
+End to end benchmark replaying Telegram Updates through the bot's dispatcher and ConversationHandler
+
+The updater is built with create_updater exactly as App.run does, only its Bot API, CoWIN and India Post calls
+go to the local stand-ins in standins.py, which take --*-latency seconds and fail --*-errors of the calls
+Updates are fed into the dispatcher's update queue like polling does. Every chat is one simulated user
+sending its next update --think-time seconds after the bot finished handling the previous one
+(the end to end latency of an update runs from it being queued to its handler finishing and the outbound queue
+having delivered every message it sent)
+
+Without --updates a recording is generated that walks through every flow in the conversation:
+/start -> District -> state -> district, /start -> PIN-code -> pincode, /bydistrict <id>, /bypincode <pin>,
+/bystate <state>, /repeat, a district typed straight at the state prompt and misspelled state and district names.
+--save writes it as JSON lines of Update objects, the same format --updates replays,
+so an Update log captured from getUpdates or the webhook can be replayed too
+
+It reports updates per second, p50/p99 end to end latency, upstream calls per calendar query and peak RSS,
+--result saves them as JSON and --baseline prints the change against an earlier --result
+
+usage       :   python benchmarks/bench_replay.py [--users 50] [--conversations 200] [--cowin-latency 0.2] [--baseline base.json]
+
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from collections import defaultdict
+
+from telegram import Update
+from telegram.utils.deprecate import TelegramDeprecationWarning
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+from _common import load_app
+from standins import StandIns, StandInConfig
+from vaxonbot.instrumentation import metrics
+from vaxonbot.persistence import SqlitePersistence
+from vaxonbot.pincodes import PincodeIndex
+
+BENCH_TOKEN = '123456:BENCHMARK-TOKEN'
+QUERY_HANDLERS = ('find_calendar_bydistrict','find_calendar_bypincode','find_calendar_bystate')
+
+
+def make_update(update_id,chat_id,text):
+    message = {
+        'message_id'    : update_id,
+        'date'          : int(time.time()),
+        'chat'          : {'id' : chat_id, 'type' : 'private'},
+        'from'          : {'id' : chat_id, 'is_bot' : False, 'first_name' : f'user{chat_id}'},
+        'text'          : text,
+    }
+    if ( text.startswith('/') ):
+        message['entities'] = [{'type' : 'bot_command', 'offset' : 0, 'length' : len(text.split()[0])}]
+    return {'update_id' : update_id, 'message' : message}
+
+
+def misspell(rng,name):
+    ## Drops one letter from the middle of longer names, the way a hurried user types them
+    if ( len(name) < 6 ):
+        return name
+    position = rng.randrange(2,len(name) - 2)
+    return name[:position] + name[position + 1:]
+
+
+def generate_updates(app,conversations,users,pincodes,seed=11):
+    rng = random.Random(seed)
+    districts = sorted(app.district_metadata.district_by_id.items())
+    flows = []
+    for conversation in range(conversations):
+        district_id, (state, district) = rng.choice(districts)
+        pincode = rng.choice(pincodes)
+        flows.append(rng.choice((
+            ['/start', 'District', state, district],
+            ['/start', 'PIN-code', pincode],
+            [f'/bydistrict {district_id}'],
+            [f'/bypincode {pincode}'],
+            ['/start', 'District', district],
+            [f'/bydistrict {district_id}', '/repeat'],
+            [f'/bystate {state}'],
+            ['/start', 'District', misspell(rng,state), misspell(rng,district)],
+        )))
+    updates = []
+    for conversation, flow in enumerate(flows):
+        chat_id = 1000 + conversation % users
+        for text in flow:
+            updates.append(make_update(len(updates) + 1,chat_id,text))
+    return updates
+
+
+def util_chat_id(update):
+    return update['message']['chat']['id']
+
+
+class UpdateTracker:
+    ## Wraps the dispatcher so the harness knows when an update and all the async handlers it started are done
+    def __init__(self,dispatcher):
+        self.processed = defaultdict(threading.Event)
+        self.promises = defaultdict(list)
+        self.lock = threading.Lock()
+        self.failed = 0
+        process_update, run_async = dispatcher.process_update, dispatcher.run_async
+
+        def tracked_run_async(func,*args,update=None,**kwargs):
+            promise = run_async(func,*args,update=update,**kwargs)
+            if ( update is not None ):
+                with self.lock:
+                    self.promises[update.update_id].append(promise)
+            return promise
+
+        def tracked_process_update(update):
+            try :
+                process_update(update)
+            finally :
+                if ( hasattr(update,'update_id') ):
+                    with self.lock:
+                        event = self.processed[update.update_id]
+                    event.set()
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',TelegramDeprecationWarning)
+            dispatcher.run_async = tracked_run_async
+            dispatcher.process_update = tracked_process_update
+
+    def wait(self,update_id):
+        with self.lock:
+            event = self.processed[update_id]
+        event.wait()
+        with self.lock:
+            promises = self.promises.pop(update_id,[])
+            del self.processed[update_id]
+        for promise in promises:
+            promise.done.wait()
+            if ( promise.exception is not None ):
+                self.failed += 1
+
+
+def percentile(values,fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1,int(fraction * len(values)))] if values else 0
+
+
+def replay(app,updater,updates,think_time):
+    tracker = UpdateTracker(updater.dispatcher)
+    dispatch_thread = threading.Thread(target=updater.dispatcher.start,daemon=True)
+    dispatch_thread.start()
+    while ( not updater.dispatcher.running ):
+        time.sleep(0.01)
+
+    by_chat = defaultdict(list)
+    for update in updates:
+        by_chat[util_chat_id(update)].append(update)
+    latencies = []
+
+    def user(chat_updates):
+        for update in chat_updates:
+            started = time.perf_counter()
+            updater.dispatcher.update_queue.put(Update.de_json(update,updater.bot))
+            tracker.wait(update['update_id'])
+            app.outbound.drain(util_chat_id(update))
+            latencies.append(time.perf_counter() - started)
+            time.sleep(think_time)
+
+    users = [ threading.Thread(target=user,args=(chat_updates,)) for chat_updates in by_chat.values() ]
+    started = time.perf_counter()
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    updater.dispatcher.stop()
+    return elapsed, latencies, tracker.failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates',help='JSON lines of Telegram Update objects to replay instead of generated ones')
+    parser.add_argument('--save',help='write the replayed updates to this file as JSON lines')
+    parser.add_argument('--conversations',type=int,default=200,help='generated conversations')
+    parser.add_argument('--users',type=int,default=50,help='distinct chats the generated conversations are spread over')
+    parser.add_argument('--think-time',type=float,default=0.0,help='seconds a user waits after a reply before sending the next update')
+    parser.add_argument('--centers',type=int,default=40,help='centers per generated calendar')
+    for name in ('cowin','postal','telegram'):
+        parser.add_argument(f'--{name}-latency',type=float,default=0.2 if 'cowin' == name else 0.05,help=f'seconds the {name} stand-in takes')
+        parser.add_argument(f'--{name}-errors',type=float,default=0.0,help=f'fraction of {name} calls that fail')
+    parser.add_argument('--port',type=int,default=51200,help='first of the three stand-in ports')
+    parser.add_argument('--result',help='save the results as JSON')
+    parser.add_argument('--baseline',help='results of an earlier run saved with --result to compare against')
+    args = parser.parse_args()
+
+    app = load_app()
+    logging.disable(logging.CRITICAL)
+
+    ## Pincodes the postal stand-in knows, the offline index is left empty so validation goes upstream
+    rng = random.Random(3)
+    districts = list(app.district_metadata.district_by_id.values())
+    pincode_districts = { str(110000 + pin) : rng.choice(districts) for pin in range(200) }
+    app.pincode_index = PincodeIndex({})
+
+    configs = {
+        'cowin'         : StandInConfig(args.cowin_latency,args.cowin_errors),
+        'postalpincode' : StandInConfig(args.postal_latency,args.postal_errors),
+        'telegram'      : StandInConfig(args.telegram_latency,args.telegram_errors),
+    }
+    standins = StandIns(configs,args.centers,pincode_districts,args.port)
+    ## The stand-ins only know their ports once started, after the app was needed for their pincodes
+    vars(app.config).update(standins.settings())
+
+    if ( args.updates ):
+        with open(args.updates) as updates_file:
+            updates = [ json.loads(line) for line in updates_file if line.strip() ]
+    else :
+        updates = generate_updates(app,args.conversations,args.users,sorted(pincode_districts))
+    if ( args.save ):
+        with open(args.save,'w') as save_file:
+            save_file.writelines(json.dumps(update) + '\n' for update in updates)
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        ## Subscriptions are kept in the persistence file as well
+        app.config.PERSISTENCE_FILE = os.path.join(state_dir,'replay.sqlite3')
+        app.config.OUTBOUND_QUEUE_FILE = os.path.join(state_dir,'replay-outbound.sqlite3')
+        persistence = SqlitePersistence(app.config.PERSISTENCE_FILE)
+        updater = app.create_updater(BENCH_TOKEN,persistence=persistence)
+        elapsed, latencies, failed = replay(app,updater,updates,args.think_time)
+        persistence.flush()
+        app.outbound.stop()
+
+    counts = standins.counts()
+    standins.stop()
+    ## Every calendar lookup goes through one of the query handlers, counted by their latency histograms
+    queries = sum(histogram['count'] for (name, labels), histogram in metrics.histograms.items()
+                  if name == 'vaxonbot_handler_seconds' and dict(labels)['handler'] in QUERY_HANDLERS)
+    upstream_calls = sum(value for key, value in counts.items() if key.split()[0] in ('cowin','postalpincode') and not key.endswith('errors'))
+
+    results = {
+        'updates'               : len(latencies),
+        'failed'                : failed,
+        'updates_per_second'    : len(latencies) / elapsed,
+        'p50_ms'                : percentile(latencies,0.5) * 1000,
+        'p99_ms'                : percentile(latencies,0.99) * 1000,
+        'queries'               : queries,
+        'upstream_per_query'    : upstream_calls / queries if queries else 0,
+        'bot_api_calls'         : sum(value for key, value in counts.items() if key.startswith('telegram') and not key.endswith('errors')),
+        'peak_rss_mb'           : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    baseline = {}
+    if ( args.baseline ):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    for key, value in results.items():
+        change = ''
+        if ( baseline.get(key) ):
+            change = f'{(value - baseline[key]) / baseline[key] * 100:+8.1f} %'
+        print(f'{key:<22} {value:>12.2f} {change}')
+    for key in sorted(counts):
+        print(f'  {key:<32} {counts[key]:>8}')
+    if ( args.result ):
+        with open(args.result,'w') as result_file:
+            json.dump(results,result_file,indent=1)
+
+
+if __name__ == '__main__':
+    main()
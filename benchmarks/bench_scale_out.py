@@ -0,0 +1,212 @@
+"""
+
+Load test of the multi worker mode
+
+Runs the cluster the way python -m vaxonbot --cluster does, a shared store, 1, 2, 4... webhook workers each running
+App.run with its own updater and the UpdateRouter in front of them, with CoWIN and the Bot API replaced by the stand-ins
+in standins.py (CoWIN takes --upstream-latency seconds)
+--clients threads POST /bydistrict <id> updates of --chats chats to the router, so every query goes through the router,
+the webhook queue of a worker, the dispatcher and find_calendar_bydistrict, the shared calendar cache and the shared
+upstream budget of --budget CoWIN calls a second. Replies go to the outbound queues as they do in production
+
+For every worker count it reports queries per second over all workers (until the workers' /metrics count every query
+as handled), the CoWIN calls made, and the calls that waited on the shared budget longer than UPSTREAM_MAX_WAIT.
+The upstream calls should stay at about one per district per --cache-ttl however many workers run. The queries per
+second only grow with the workers while there are CPUs left for them, the router and the clients (os.cpu_count is
+printed first)
+
+usage       :   python benchmarks/bench_scale_out.py [--workers 1,2,4] [--queries 500] [--districts 50] [--budget 20]
+
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import http.client
+from collections import defaultdict
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+from _common import load_app
+from standins import StandIns, StandInConfig
+from vaxonbot.cluster import UpdateRouter, run_shared_store
+
+BENCH_TOKEN = '123456:BENCHMARK-TOKEN'
+WEBHOOK_PATH = 'bench'
+STORE_AUTHKEY = b'bench'
+METRIC_LINE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+
+
+def run_worker(settings,shard):
+    app = load_app(**settings)
+    logging.disable(logging.CRITICAL)
+    app.run('webhook',shard)
+
+
+def run_router(workers,port):
+    logging.disable(logging.CRITICAL)
+    UpdateRouter(workers,'127.0.0.1',port,WEBHOOK_PATH).serve()
+
+
+def scrape(port):
+    ## Samples of the /metrics of a worker as {name : [(labels, value)]}
+    connection = http.client.HTTPConnection('127.0.0.1',port,timeout=5)
+    connection.request('GET','/metrics')
+    text = connection.getresponse().read().decode()
+    connection.close()
+    samples = defaultdict(list)
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if ( match is not None ):
+            name, labels, value = match.groups()
+            samples[name].append((dict(re.findall(r'(\w+)="([^"]*)"',labels or '')), float(value)))
+    return samples
+
+
+def total(samples,name,**labels):
+    return sum(value for sample_labels, value in samples.get(name,[]) if all(sample_labels.get(label) == wanted for label, wanted in labels.items()))
+
+
+def scrape_all(ports):
+    scraped = [ scrape(port) for port in ports ]
+    return lambda name, **labels : sum(total(samples,name,**labels) for samples in scraped)
+
+
+def post_update(port,update_id,chat_id,text):
+    ## POSTs an update to the router, again after a moment whenever the worker asks for redelivery
+    body = json.dumps({'update_id' : update_id, 'message' : {
+        'message_id'    : update_id,
+        'date'          : int(time.time()),
+        'chat'          : {'id' : chat_id, 'type' : 'private'},
+        'from'          : {'id' : chat_id, 'is_bot' : False, 'first_name' : f'user{chat_id}'},
+        'text'          : text,
+        'entities'      : [{'type' : 'bot_command', 'offset' : 0, 'length' : len(text.split()[0])}],
+    }})
+    while True:
+        connection = http.client.HTTPConnection('127.0.0.1',port,timeout=30)
+        connection.request('POST',f'/{WEBHOOK_PATH}',body,{'Content-Type' : 'application/json'})
+        status = connection.getresponse().status
+        connection.close()
+        if ( 200 == status ):
+            return
+        time.sleep(0.05)
+
+
+def measure(workers,args,district_ids,standins,port):
+    context = multiprocessing.get_context('fork')
+    address = ('127.0.0.1',port)
+    store = context.Process(target=run_shared_store,args=(address,STORE_AUTHKEY),daemon=True)
+    store.start()
+    time.sleep(0.5)
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        settings = dict(standins.settings(),
+            TELEGRAM_TOKEN              = BENCH_TOKEN,
+            BOT_MODE                    = 'webhook',
+            WEBHOOK_LISTEN              = '127.0.0.1',
+            WEBHOOK_PORT                = port + 1,
+            WEBHOOK_PATH                = WEBHOOK_PATH,
+            METRICS_PORT                = port + 100,
+            CLUSTER_WORKERS             = workers,
+            SHARED_STORE_ADDRESS        = address,
+            SHARED_STORE_AUTHKEY        = STORE_AUTHKEY,
+            PERSISTENCE_FILE            = os.path.join(state_dir,'bench.sqlite3'),
+            OUTBOUND_QUEUE_FILE         = os.path.join(state_dir,'bench-outbound.sqlite3'),
+            ARCHIVE_DIR                 = os.path.join(state_dir,'archive'),
+            UPSTREAM_BUDGETS            = {'cowin' : (args.budget, args.budget)},
+            CACHE_TTL_SECONDS           = args.cache_ttl,
+            HOT_DISTRICTS               = (),
+        )
+        ## The router runs in a process of its own as in python -m vaxonbot --cluster, not sharing the GIL with the clients
+        processes = [ context.Process(target=run_worker,args=(settings,shard)) for shard in range(workers) ]
+        router = context.Process(target=run_router,args=(workers,settings['WEBHOOK_PORT']))
+        for process in processes + [router]:
+            process.start()
+        metrics_ports = [ settings['METRICS_PORT'] + 1 + shard for shard in range(workers) ]
+
+        ## A worker is up once it serves its metrics
+        for process, metrics_port in zip(processes,metrics_ports):
+            while True:
+                try :
+                    scrape(metrics_port)
+                    break
+                except OSError:
+                    if ( not process.is_alive() ):
+                        raise RuntimeError(f'Worker on metrics port {metrics_port} exited')
+                    time.sleep(0.1)
+
+        calls_before = standins.counts().get('cowin calendarByDistrict',0)
+        queries = workers * args.queries
+        rng = random.Random(workers)
+        load = [ (update_id, 1000 + rng.randrange(args.chats), f'/bydistrict {rng.choice(district_ids)}') for update_id in range(1,queries + 1) ]
+
+        def client(share):
+            for update_id, chat_id, text in share:
+                post_update(settings['WEBHOOK_PORT'],update_id,chat_id,text)
+
+        started = time.perf_counter()
+        clients = [ threading.Thread(target=client,args=(load[offset::args.clients],)) for offset in range(args.clients) ]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        while True:
+            metric = scrape_all(metrics_ports)
+            if ( metric('vaxonbot_handler_seconds_count',handler='find_calendar_bydistrict') >= queries ):
+                break
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - started
+
+        results = {
+            'queries_per_second'    : queries / elapsed,
+            'upstream_calls'        : standins.counts().get('cowin calendarByDistrict',0) - calls_before,
+            'budget_exhausted'      : metric('vaxonbot_upstream_budget_exhausted'),
+        }
+        for process in processes + [router]:
+            process.terminate()
+        for process in processes + [router]:
+            process.join()
+    store.terminate()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers',default='1,2,4',help='comma separated worker counts to measure')
+    parser.add_argument('--queries',type=int,default=500,help='queries per worker')
+    parser.add_argument('--clients',type=int,default=32,help='threads POSTing updates to the router')
+    parser.add_argument('--chats',type=int,default=500,help='distinct chats the updates come from')
+    parser.add_argument('--districts',type=int,default=50,help='distinct districts queried')
+    parser.add_argument('--centers',type=int,default=40,help='centers per district calendar')
+    parser.add_argument('--upstream-latency',type=float,default=0.2,help='seconds the CoWIN stand-in takes')
+    parser.add_argument('--budget',type=float,default=20,help='CoWIN calls per second all workers share, also the burst')
+    parser.add_argument('--cache-ttl',type=float,default=10,help='seconds a calendar is served from the shared cache')
+    parser.add_argument('--port',type=int,default=20900,help='first port of the store, router, workers, their metrics and the stand-ins, '
+                        'below the ephemeral ports so the clients\' connections never take one of them')
+    args = parser.parse_args()
+
+    app = load_app()
+    logging.disable(logging.CRITICAL)
+    district_ids = sorted(app.district_metadata.district_by_id)[:args.districts]
+    standins = StandIns({'cowin' : StandInConfig(args.upstream_latency), 'postalpincode' : StandInConfig(), 'telegram' : StandInConfig()},
+                        args.centers,base_port=args.port + 200)
+
+    print(f'{os.cpu_count()} CPUs')
+    print(f'{"workers":>8} {"queries/s":>12} {"upstream calls":>16} {"out of budget":>14}')
+    try :
+        for run, workers in enumerate(int(workers) for workers in args.workers.split(',')):
+            results = measure(workers,args,district_ids,standins,args.port + 300 * run)
+            print(f'{workers:>8} {results["queries_per_second"]:>12.0f} {results["upstream_calls"]:>16} {results["budget_exhausted"]:>14.0f}')
+    finally :
+        standins.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+
+Benchmark of the fuzzy state and district search
+
+Builds queries from state-dist-map.json the way users type them: names as they are, misspelled by a dropped,
+doubled or swapped letter, cut short to a prefix, and the NAME_ALIASES spellings, and times resolve, search and
+the full inline query lookup (suggest) over every query. It also reports how long the index takes to build from the
+JSON and to load from the compiled state-dist-map.bin, and how many of the misspelled names still resolve to the
+district they came from
+
+usage       :   python benchmarks/bench_search.py [--queries 2000] [--baseline base.json]
+
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+from _common import load_app
+from vaxonbot.metadata import NAME_ALIASES, util_index_metadata, util_load_metadata
+
+
+def misspell(rng,name):
+    position = rng.randrange(1,len(name) - 1)
+    edit = rng.choice(('drop','double','swap'))
+    if ( 'drop' == edit ):
+        return name[:position] + name[position + 1:]
+    if ( 'double' == edit ):
+        return name[:position] + name[position] + name[position:]
+    return name[:position - 1] + name[position] + name[position - 1] + name[position + 1:]
+
+
+def make_queries(district_metadata,count,seed=5):
+    rng = random.Random(seed)
+    districts = sorted(district_metadata.district_by_id.items())
+    queries = []
+    while ( len(queries) < count ):
+        district_id, (state, district) = rng.choice(districts)
+        kind = rng.choice(('exact','misspelled','prefix','alias','state'))
+        if ( 'exact' == kind ):
+            queries.append((kind, district, district_id))
+        elif ( 'misspelled' == kind and len(district) > 5 ):
+            queries.append((kind, misspell(rng,district), district_id))
+        elif ( 'prefix' == kind ):
+            queries.append((kind, district[:rng.randint(2,max(2,len(district) - 1))], None))
+        elif ( 'alias' == kind ):
+            queries.append((kind, rng.choice(sorted(NAME_ALIASES)), None))
+        elif ( 'state' == kind ):
+            queries.append((kind, misspell(rng,state), state))
+    return queries
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return { point : samples[min(len(samples) - 1,len(samples) * point // 100)] * 1e6 for point in (50,99) }
+
+
+def time_calls(func,queries):
+    samples = []
+    for _, text, _ in queries:
+        started = time.perf_counter()
+        func(text)
+        samples.append(time.perf_counter() - started)
+    return percentiles(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries',type=int,default=2000,help='queries generated from the state and district list')
+    parser.add_argument('--result',help='save the results as JSON')
+    parser.add_argument('--baseline',help='results of an earlier run saved with --result to compare against')
+    args = parser.parse_args()
+
+    app = load_app()
+    district_metadata = app.district_metadata
+    queries = make_queries(district_metadata,args.queries)
+
+    started = time.perf_counter()
+    util_index_metadata(district_metadata.state_dist_map)
+    build = time.perf_counter() - started
+    started = time.perf_counter()
+    util_load_metadata(app.config.STATE_DIST_MAP_FILE)
+    load = time.perf_counter() - started
+
+    results = {'index_build_ms' : build * 1000, 'compiled_load_ms' : load * 1000}
+    for name, func in (('resolve', district_metadata.resolve), ('search', district_metadata.search), ('suggest', district_metadata.suggest)):
+        for point, micros in time_calls(func,queries).items():
+            results[f'{name}_p{point}_us'] = micros
+
+    ## How often a misspelled name is taken without asking, and how often it is at least among the suggestions
+    misspelled = [ (text, expected) for kind, text, expected in queries if 'misspelled' == kind ]
+    resolved = sum(1 for text, expected in misspelled if district_metadata.resolve(text) == expected)
+    suggested = sum(1 for text, expected in misspelled if expected in district_metadata.suggest(text))
+    results['misspelled_resolved_pct'] = resolved * 100 / len(misspelled) if misspelled else 0
+    results['misspelled_suggested_pct'] = suggested * 100 / len(misspelled) if misspelled else 0
+
+    baseline = {}
+    if ( args.baseline ):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    for key, value in results.items():
+        change = ''
+        if ( baseline.get(key) ):
+            change = f'{(value - baseline[key]) / baseline[key] * 100:+8.1f} %'
+        print(f'{key:<30} {value:>10.1f} {change}')
+    if ( args.result ):
+        with open(args.result,'w') as result_file:
+            json.dump(results,result_file,indent=1)
+
+
+if __name__ == '__main__':
+    main()
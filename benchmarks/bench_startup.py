@@ -0,0 +1,104 @@
+"""
+
+Cold start benchmark of the bot
+
+Every case runs in a fresh interpreter, --repeat times, and the median wall time of the process is reported
+along with the time over a bare interpreter start. The cases build up to a bot ready to take updates:
+
+    python          :   python -c pass, the floor every case includes
+    import          :   import vaxonbot
+    metadata        :   create_app().district_metadata from the compiled state-dist-map.bin
+    metadata_json   :   the same with no compiled file, so state-dist-map.json is parsed and indexed
+    updater         :   create_app().create_updater(token), every handler and job registered
+
+It also lists the heavy modules (telegram, requests, sqlite3) that import vaxonbot pulls in, which should be none
+--result saves the timings as JSON and --baseline prints the change against an earlier --result
+
+usage       :   python benchmarks/bench_startup.py [--repeat 15] [--baseline base.json]
+
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_TOKEN = '123456:BENCHMARK-TOKEN'
+HEAVY_MODULES = ('telegram', 'requests', 'sqlite3')
+
+
+def cases(state_dir):
+    metadata_file = os.path.join(state_dir,'state-dist-map.json')
+    persistence_file = os.path.join(state_dir,'startup.sqlite3')
+    outbound_file = os.path.join(state_dir,'startup-outbound.sqlite3')
+    return {
+        'python'        : 'pass',
+        'import'        : 'import vaxonbot',
+        'metadata'      : 'import vaxonbot; vaxonbot.create_app().district_metadata',
+        'metadata_json' : f'import vaxonbot; vaxonbot.create_app(STATE_DIST_MAP_FILE={metadata_file!r}).district_metadata',
+        'updater'       : f'import vaxonbot; vaxonbot.create_app(PERSISTENCE_FILE={persistence_file!r},OUTBOUND_QUEUE_FILE={outbound_file!r}).create_updater({BENCH_TOKEN!r})',
+    }
+
+
+def run(code,before=None):
+    if ( before is not None ):
+        before()
+    started = time.perf_counter()
+    subprocess.run([sys.executable,'-c',code],cwd=REPO_ROOT,check=True)
+    return time.perf_counter() - started
+
+
+def heavy_imports():
+    code = f'import sys, vaxonbot; print(",".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))'
+    output = subprocess.run([sys.executable,'-c',code],cwd=REPO_ROOT,check=True,capture_output=True,text=True).stdout.strip()
+    return output.split(',') if output else []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat',type=int,default=15,help='runs of every case, the median is reported')
+    parser.add_argument('--result',help='save the results as JSON')
+    parser.add_argument('--baseline',help='results of an earlier run saved with --result to compare against')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        metadata_file = os.path.join(state_dir,'state-dist-map.json')
+        shutil.copy(os.path.join(REPO_ROOT,'state-dist-map.json'),metadata_file)
+        compiled_file = os.path.join(state_dir,'state-dist-map.bin')
+
+        def uncompile():
+            if ( os.path.exists(compiled_file) ):
+                os.remove(compiled_file)
+
+        ## Makes sure the repository's compiled metadata is current before it is timed
+        run('import vaxonbot; vaxonbot.create_app().district_metadata')
+        timings = {}
+        for name, code in cases(state_dir).items():
+            before = uncompile if 'metadata_json' == name else None
+            timings[name] = statistics.median(run(code,before) for _ in range(args.repeat))
+
+    results = { f'{name}_ms' : seconds * 1000 for name, seconds in timings.items() }
+    results.update({ f'{name}_over_python_ms' : (seconds - timings['python']) * 1000 for name, seconds in timings.items() if 'python' != name })
+    baseline = {}
+    if ( args.baseline ):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    for key, value in results.items():
+        change = ''
+        if ( baseline.get(key) ):
+            change = f'{(value - baseline[key]) / baseline[key] * 100:+8.1f} %'
+        print(f'{key:<30} {value:>10.1f} {change}')
+    print(f'heavy modules imported by import vaxonbot :: {", ".join(heavy_imports()) or "none"}')
+    if ( args.result ):
+        with open(args.result,'w') as result_file:
+            json.dump(results,result_file,indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+
+Local stand-ins for the APIs the bot talks to, so benchmarks never hit CoWIN, India Post or Telegram
+
+    CoWIN           :   calendarByDistrict / calendarByPin return a generated calendar (see generate_payload)
+    postalpincode   :   /pincode/<pin> answers like api.postalpincode.in, pincodes in pincode_districts are valid
+    Bot API         :   /bot<token>/<method> accepts every call, sendMessage echoes a Message back
+
+Every stand-in sleeps for its configured latency before answering and fails a configured fraction of calls,
+the upstream APIs with a 503, the Bot API with a 429 carrying retry_after like Telegram's flood control
+Calls are counted per stand-in and method, the counts are read back with StandIns.counts()
+
+"""
+
+import json
+import multiprocessing
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from bench_calendar_filter import generate_payload
+
+
+class StandInConfig:
+    def __init__(self,latency=0.0,error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+
+
+def make_handler(name,config,counts,answer):
+    counts_lock = threading.Lock()
+
+    def count(key):
+        with counts_lock:
+            counts[key] = counts.get(key,0) + 1
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def reply(self,status,body,headers=()):
+            body = body if isinstance(body,bytes) else json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(body)))
+            for header in headers:
+                self.send_header(*header)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def handle_call(self,payload):
+            path = urlsplit(self.path).path
+            method = path.rstrip('/').rsplit('/',1)[-1]
+            method = 'pincode' if method.isdigit() else method
+            count(f'{name} {method}')
+            if ( config.latency ):
+                time.sleep(config.latency)
+            if ( random.random() < config.error_rate ):
+                count(f'{name} errors')
+                if ( 'telegram' == name ):
+                    self.reply(429,{'ok' : False, 'error_code' : 429, 'description' : 'Too Many Requests: retry after 1', 'parameters' : {'retry_after' : 1}})
+                else :
+                    self.reply(503,b'{}',[('Retry-After','0')])
+                return
+            self.reply(200,answer(path,method,payload))
+
+        def do_GET(self):
+            self.handle_call({})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length',0)))
+            try :
+                payload = json.loads(body) if body else {}
+            except ValueError:
+                payload = {}
+            self.handle_call(payload)
+
+        def log_message(self,format,*args):
+            pass
+
+    return StandInHandler
+
+
+def cowin_answer(centers):
+    calendar = json.dumps(generate_payload(centers)).encode()
+
+    def answer(path,method,payload):
+        return calendar if method in ('calendarByDistrict','calendarByPin') else {}
+    return answer
+
+
+def postal_answer(pincode_districts):
+    def answer(path,method,payload):
+        pincode = path.rsplit('/',1)[-1]
+        if ( pincode not in pincode_districts ):
+            return [{'Message' : 'No records found', 'Status' : 'Error', 'PostOffice' : None}]
+        state, district = pincode_districts[pincode]
+        return [{'Message' : 'Number of pincode(s) found:1', 'Status' : 'Success', 'PostOffice' : [{'Name' : 'Head Office', 'District' : district, 'State' : state}]}]
+    return answer
+
+
+def telegram_answer():
+    message_ids = iter(range(1,1 << 62))
+
+    def answer(path,method,payload):
+        if ( 'getMe' == method ):
+            result = {'id' : 1, 'is_bot' : True, 'first_name' : 'bench', 'username' : 'bench_bot'}
+        elif ( method in ('sendMessage','editMessageText') ):
+            result = {'message_id' : next(message_ids), 'date' : int(time.time()), 'text' : payload.get('text',''),
+                      'chat' : {'id' : int(payload.get('chat_id',0)), 'type' : 'private'}}
+        else :
+            result = True
+        return {'ok' : True, 'result' : result}
+    return answer
+
+
+def serve(configs,centers,pincode_districts,ports,counts,ready):
+    answers = {'cowin' : cowin_answer(centers), 'postalpincode' : postal_answer(pincode_districts), 'telegram' : telegram_answer()}
+    for name, port in ports.items():
+        local_counts = {}
+        httpd = ThreadingHTTPServer(('127.0.0.1',port),make_handler(name,configs[name],local_counts,answers[name]))
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever,daemon=True).start()
+        threading.Thread(target=sync_counts,args=(local_counts,counts),daemon=True).start()
+    ready.set()
+    threading.Event().wait()
+
+
+def sync_counts(local_counts,counts):
+    ## Publishes the counts to the parent through the manager dict without a round trip per call
+    while True:
+        counts.update(dict(local_counts))
+        time.sleep(0.05)
+
+
+class StandIns:
+    def __init__(self,configs,centers=40,pincode_districts=None,base_port=51200):
+        self.ports = {'cowin' : base_port, 'postalpincode' : base_port + 1, 'telegram' : base_port + 2}
+        context = multiprocessing.get_context('fork')
+        self.manager = context.Manager()
+        self.shared_counts = self.manager.dict()
+        ready = context.Event()
+        self.process = context.Process(target=serve,args=(configs,centers,pincode_districts or {},self.ports,self.shared_counts,ready),daemon=True)
+        self.process.start()
+        ready.wait()
+
+    def url(self,name):
+        return f'http://127.0.0.1:{self.ports[name]}'
+
+    def settings(self):
+        ## create_app settings sending every upstream and Bot API call of the app to the stand-ins
+        return {
+            'CALENDAR_API'          : self.url('cowin') + '/api/v2/appointment/sessions/public',
+            'METADATA_API'          : self.url('cowin') + '/api/v2/admin/location',
+            'POSTAL_PINCODE_API'    : self.url('postalpincode') + '/pincode',
+            'TELEGRAM_BASE_URL'     : self.url('telegram') + '/bot',
+        }
+
+    def counts(self):
+        time.sleep(0.1)
+        return dict(self.shared_counts)
+
+    def stop(self):
+        self.process.terminate()
+        self.manager.shutdown()
@@ -0,0 +1,51 @@
+import pytest
+import requests
+from requests.exceptions import HTTPError
+
+from vaxonbot import create_app
+from vaxonbot.upstream import UpstreamBudgetExhausted, http_get
+
+
+class UnavailableSession:
+    def __init__(self):
+        self.timeouts = []
+
+    def get(self,url,timeout=None):
+        self.timeouts.append(timeout)
+        response = requests.Response()
+        response.status_code = 503
+        response.url = url
+        return response
+
+
+def test_http_settings_are_read_from_the_app_config():
+    app = create_app(HTTP_MAX_RETRIES=1,HTTP_BACKOFF_BASE=0,HTTP_TIMEOUT=(1, 2),UPSTREAM_BUDGETS={})
+    app.http_session = UnavailableSession()
+
+    with pytest.raises(HTTPError):
+        http_get(app,'http://cowin.invalid/calendarByDistrict?district_id=1','cowin')
+    assert app.http_session.timeouts == [(1, 2), (1, 2)]
+
+
+def test_fixed_names_can_not_be_overridden():
+    with pytest.raises(TypeError):
+        create_app(TELEGRAM_MAX_MESSAGE_LENGTH=100)
+    with pytest.raises(TypeError):
+        create_app(NOT_A_SETTING=1)
+
+
+class RetryLaterSession(UnavailableSession):
+    def get(self,url,timeout=None):
+        response = super().get(url,timeout)
+        response.status_code = 429
+        response.headers['Retry-After'] = '60'
+        return response
+
+
+def test_a_retry_after_longer_than_the_backoff_is_not_retried_early():
+    app = create_app(HTTP_MAX_RETRIES=3,HTTP_BACKOFF_MAX=8,UPSTREAM_BUDGETS={})
+    app.http_session = RetryLaterSession()
+
+    with pytest.raises(UpstreamBudgetExhausted):
+        http_get(app,'http://cowin.invalid/calendarByDistrict?district_id=1','cowin')
+    assert len(app.http_session.timeouts) == 1
@@ -0,0 +1,62 @@
+import multiprocessing
+import pickle
+import socket
+import time
+
+from vaxonbot.cluster import SharedResponseCache, run_shared_store
+from vaxonbot.upstream import CalendarResponse
+
+AUTHKEY = b'test'
+
+
+def free_port():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1',0))
+        return listener.getsockname()[1]
+
+
+def test_the_shared_cache_keeps_the_parsed_calendar_only():
+    address = ('127.0.0.1',free_port())
+    store = multiprocessing.get_context('fork').Process(target=run_shared_store,args=(address,AUTHKEY),daemon=True)
+    store.start()
+    try :
+        cache = None
+        for _ in range(50):
+            try :
+                cache = SharedResponseCache(address,AUTHKEY,ttl=60)
+                cache.store()
+                break
+            except OSError:
+                time.sleep(0.1)
+        calendar = CalendarResponse(200,{'centers' : [{'center_id' : 1, 'sessions' : []}]},time.time())
+        assert cache.get_or_fetch('key',lambda : calendar) == (calendar, 0)
+
+        response, age = cache.get_or_fetch('key',lambda : None)
+        assert response.json() == calendar.payload
+        assert age < 60
+        assert len(pickle.dumps(response)) < 200
+    finally :
+        store.terminate()
+        store.join()
+
+
+def test_cluster_children_run_with_the_settings_of_the_app(tmp_path):
+    from vaxonbot import create_app
+    from vaxonbot.cluster import util_connect_shared_store, util_run_cluster_child
+
+    address = ('127.0.0.1',free_port())
+    app = create_app(SHARED_STORE_ADDRESS=address,SHARED_STORE_AUTHKEY=AUTHKEY,LOG_FILE=str(tmp_path / 'store.log'))
+    store = multiprocessing.get_context('spawn').Process(target=util_run_cluster_child,args=(app.settings,None,2),daemon=True)
+    store.start()
+    try :
+        for _ in range(100):
+            try :
+                assert util_connect_shared_store(address,AUTHKEY).stats()['size'] == 0
+                break
+            except OSError:
+                time.sleep(0.1)
+        else :
+            raise AssertionError(f'No shared store on {address}')
+    finally :
+        store.terminate()
+        store.join()
@@ -0,0 +1,82 @@
+import json
+
+from vaxonbot.calendars import CalendarSession
+from vaxonbot.config import BY_DIST
+from vaxonbot.feed import (
+    CAPACITY_CHANGED, CENTER_ADDED, CENTER_REMOVED, SESSION_CLOSED, SESSION_OPENED, AvailabilityArchive, ChangeFeed,
+    util_ist_day, util_opened_doses, util_session_change,
+)
+
+T0 = 1620000000
+
+
+def calendar(*sessions):
+    ## calendarByDistrict JSON of one center, sessions are (session_id, dose1, dose2)
+    return json.dumps({'centers' : [{
+        'center_id' : 1234, 'name' : 'PHC', 'pincode' : 110001, 'fee_type' : 'Free',
+        'sessions' : [ {'session_id' : session_id, 'date' : '05-05-2021', 'vaccine' : 'COVISHIELD', 'min_age_limit' : 18,
+                        'available_capacity_dose1' : dose1, 'available_capacity_dose2' : dose2} for session_id, dose1, dose2 in sessions ],
+    }]}).encode()
+
+
+def test_workers_diffing_their_own_fetches_archive_an_opening_once(tmp_path):
+    key = (BY_DIST, '140')
+    workers = [ (ChangeFeed(), AvailabilityArchive(str(tmp_path))) for _ in range(2) ]
+
+    ## Worker 0 fetches at T0 and T0+20, worker 1 at T0+10 and T0+30, the session opens between T0+10 and T0+20
+    fetches = [ (0, 0, 0), (1, 10, 0), (0, 20, 10), (1, 30, 10), (1, 40, 15) ]
+    for worker, offset, dose1 in fetches:
+        change_feed, archive = workers[worker]
+        delta = change_feed.diff(key,calendar(('s1', dose1, 0)),T0 + offset)
+        if ( delta is not None ):
+            archive.append(delta)
+
+    day = util_ist_day(T0)
+    reader = AvailabilityArchive(str(tmp_path))
+    assert len(reader.opening_times(140,[day])) == 1
+    assert reader.capacity_added(140,[day]) == {day : 15}
+
+
+def session(dose1,dose2):
+    return CalendarSession('s1','05-05-2021','COVISHIELD',18,dose1,dose2)
+
+
+def test_session_changes_are_classified_by_total_capacity():
+    assert util_session_change(None,session(0,0)) is None
+    assert util_session_change(None,session(0,3)) == SESSION_OPENED
+    assert util_session_change(session(0,0),session(2,0)) == SESSION_OPENED
+    assert util_session_change(session(2,0),session(0,0)) == SESSION_CLOSED
+    assert util_session_change(session(2,0),session(1,0)) == CAPACITY_CHANGED
+    assert util_session_change(session(2,0),session(0,2)) == CAPACITY_CHANGED
+    assert util_session_change(session(2,1),session(2,1)) is None
+
+
+def test_opened_doses_are_the_ones_that_had_no_capacity_before():
+    feed = ChangeFeed()
+    key = (BY_DIST, '140')
+    feed.diff(key,calendar(('s1', 0, 4)))
+    (change,) = feed.diff(key,calendar(('s1', 5, 2))).changes
+    assert change.kind == CAPACITY_CHANGED
+    assert util_opened_doses(change) == {1}
+
+    (change,) = feed.diff(key,calendar(('s1', 0, 0))).changes
+    assert change.kind == SESSION_CLOSED
+    assert util_opened_doses(change) == set()
+
+
+def test_diff_reports_what_changed_since_the_last_fetch_of_the_same_calendar():
+    feed = ChangeFeed()
+    key = (BY_DIST, '140')
+    assert feed.diff(key,calendar(('s1', 0, 0), ('s2', 5, 0)),T0) is None
+    assert feed.diff(key,calendar(('s1', 0, 0), ('s2', 5, 0)),T0 + 10) is None
+    assert feed.diff((BY_DIST, '141'),calendar(('s1', 3, 0)),T0 + 10) is None
+
+    delta = feed.diff(key,calendar(('s1', 2, 0), ('s3', 1, 1)),T0 + 20)
+    assert delta.key == key and delta.fetched_at == T0 + 20
+    changes = sorted((change.kind, (change.before or change.after).session_id) for change in delta.changes)
+    assert changes == [(SESSION_CLOSED, 's2'), (SESSION_OPENED, 's1'), (SESSION_OPENED, 's3')]
+
+    delta = feed.diff(key,json.dumps({'centers' : []}).encode(),T0 + 30)
+    assert [ change.kind for change in delta.changes ] == [SESSION_CLOSED, SESSION_CLOSED, CENTER_REMOVED]
+    delta = feed.diff(key,calendar(('s1', 0, 0)),T0 + 40)
+    assert [ change.kind for change in delta.changes ] == [CENTER_ADDED]
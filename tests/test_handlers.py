@@ -0,0 +1,23 @@
+from datetime import date
+
+from vaxonbot import create_app, handlers
+from vaxonbot.config import BY_DIST
+from vaxonbot.upstream import util_calendar_key
+
+
+def test_a_fan_out_fetches_at_most_fanout_max_fetches_uncached_districts(monkeypatch):
+    app = create_app(FANOUT_MAX_FETCHES=2)
+    app.calendar_cache.get_or_fetch(util_calendar_key(BY_DIST,'5',date.today().strftime("%d-%m-%Y")),lambda : 'cached')
+    fetched = []
+
+    def district_availability(app,district_id):
+        fetched.append(district_id)
+        return ({}, 0)
+
+    monkeypatch.setattr(handlers,'util_district_availability',district_availability)
+    calendars, missing, pending = handlers.util_fetch_districts(app,['1', '2', '3', '4', '5'],deadline=5)
+
+    assert sorted(fetched) == ['1', '2', '5']
+    assert sorted(calendars) == ['1', '2', '5']
+    assert missing == []
+    assert pending == ['3', '4']
@@ -0,0 +1,30 @@
+import json
+import logging
+import queue
+from logging.handlers import QueueListener
+
+from vaxonbot.instrumentation import JsonLogFormatter, LogQueueHandler
+
+
+def test_a_logged_exception_reaches_the_json_log(tmp_path):
+    path = tmp_path / 'vaxonbot.log'
+    log_queue = queue.SimpleQueue()
+    file_handler = logging.FileHandler(path)
+    file_handler.setFormatter(JsonLogFormatter())
+    listener = QueueListener(log_queue,file_handler)
+    logger = logging.getLogger('vaxonbot.test')
+    logger.propagate = False
+    logger.addHandler(LogQueueHandler(log_queue))
+    listener.start()
+    try :
+        try :
+            {}['district']
+        except KeyError:
+            logger.exception('Lookup of %s failed','district')
+    finally :
+        listener.stop()
+        file_handler.close()
+
+    entry = json.loads(path.read_text())
+    assert entry['message'] == 'Lookup of district failed'
+    assert 'KeyError' in entry['exception']
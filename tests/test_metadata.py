@@ -0,0 +1,102 @@
+import json
+import os
+import shutil
+from types import SimpleNamespace
+
+import requests
+
+from vaxonbot import create_app, metadata
+from vaxonbot.config import PRIORITY_BACKGROUND
+from vaxonbot.metadata import refresh_metadata, reload_metadata, util_compiled_metadata_path, util_load_metadata
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class MetadataSession:
+    ## Answers the CoWIN metadata API with one state of two districts
+    def get(self,url,timeout=None):
+        response = requests.Response()
+        response.status_code = 200
+        if ( url.endswith('/states') ):
+            response._content = json.dumps({'states' : [{'state_id' : 99, 'state_name' : 'Testland'}]}).encode()
+        else :
+            response._content = json.dumps({'districts' : [{'district_id' : 9901, 'district_name' : 'North'},
+                                                           {'district_id' : 9902, 'district_name' : 'South'}]}).encode()
+        return response
+
+
+class ExhaustedBudget:
+    def __init__(self):
+        self.priorities = []
+
+    def acquire(self,upstream,priority,timeout=None):
+        self.priorities.append(priority)
+        return False
+
+
+def test_refresh_keeps_the_metadata_when_the_budget_is_exhausted(tmp_path):
+    path = str(tmp_path / 'state-dist-map.json')
+    shutil.copy(os.path.join(REPO_ROOT,'state-dist-map.json'),path)
+    app = create_app(STATE_DIST_MAP_FILE=path)
+    district_metadata = app.district_metadata
+    app.upstream_budget = ExhaustedBudget()
+
+    refresh_metadata(SimpleNamespace(job=SimpleNamespace(context=app)))
+    assert app.district_metadata is district_metadata
+    assert app.upstream_budget.priorities == [PRIORITY_BACKGROUND]
+
+
+def test_refresh_replaces_the_file_and_other_workers_reload_it(tmp_path):
+    path = str(tmp_path / 'state-dist-map.json')
+    shutil.copy(os.path.join(REPO_ROOT,'state-dist-map.json'),path)
+    refreshing = create_app(STATE_DIST_MAP_FILE=path,UPSTREAM_BUDGETS={})
+    reloading = create_app(STATE_DIST_MAP_FILE=path)
+    assert 9901 not in reloading.district_metadata.district_by_id
+    refreshing.http_session = MetadataSession()
+
+    refresh_metadata(SimpleNamespace(job=SimpleNamespace(context=refreshing)))
+    with open(path) as json_file:
+        assert list(json.load(json_file)) == ['Testland']
+    assert sorted(os.listdir(tmp_path)) == ['state-dist-map.bin', 'state-dist-map.json']
+
+    reload_metadata(SimpleNamespace(job=SimpleNamespace(context=reloading)))
+    assert reloading.district_metadata.district_by_id == {9901 : ('Testland', 'North'), 9902 : ('Testland', 'South')}
+    district_metadata = reloading.district_metadata
+    reload_metadata(SimpleNamespace(job=SimpleNamespace(context=reloading)))
+    assert reloading.district_metadata is district_metadata
+
+
+def test_misspelled_names_rank_the_district_they_came_from_first(tmp_path):
+    path = str(tmp_path / 'state-dist-map.json')
+    shutil.copy(os.path.join(REPO_ROOT,'state-dist-map.json'),path)
+    district_metadata = util_load_metadata(path)
+    assert district_metadata.resolve('Anantpur') == 9
+    assert district_metadata.resolve('Chitoor') == 10
+    assert district_metadata.resolve('east godavri') == 11
+    assert district_metadata.resolve('Andhra Pradsh') == 'Andhra Pradesh'
+    assert [ target for _, target in district_metadata.search('Chitoor',limit=2) ] == [10, 642]
+    assert district_metadata.search('xyzzy') == []
+
+    ## Two districts of the same name don't resolve, both are suggested with labels that resolve back to each
+    assert district_metadata.resolve('Aurangabad') is None
+    suggestions = district_metadata.suggest('Aurangabad',kind='district')
+    assert sorted(suggestions[:2]) == [77, 397]
+    for district_id in suggestions[:2]:
+        assert district_metadata.resolve_district(district_metadata.label(district_id)) == district_id
+
+
+def test_the_compiled_index_is_loaded_without_indexing_again(tmp_path,monkeypatch):
+    path = str(tmp_path / 'state-dist-map.json')
+    shutil.copy(os.path.join(REPO_ROOT,'state-dist-map.json'),path)
+    built = util_load_metadata(path)
+    assert os.path.exists(util_compiled_metadata_path(path))
+
+    def util_index_metadata(state_dist_map):
+        raise AssertionError('the compiled index should have been loaded')
+
+    monkeypatch.setattr(metadata,'util_index_metadata',util_index_metadata)
+    loaded = util_load_metadata(path)
+    assert loaded.source_key == built.source_key
+    assert loaded.district_by_id == built.district_by_id
+    assert loaded.search('Chitoor') == built.search('Chitoor')
+    assert loaded.suggest('Aurangabad') == built.suggest('Aurangabad')
@@ -0,0 +1,87 @@
+import threading
+import time
+
+from telegram.error import RetryAfter
+
+from vaxonbot.config import PRIORITY_BACKGROUND
+from vaxonbot.outbound import OutboundQueue
+
+
+class RecordingBot:
+    ## Records (chat_id, text, monotonic time) of every send, chats in retry_after get one RetryAfter first
+    def __init__(self,retry_after=None):
+        self.sent = []
+        self.retry_after = dict(retry_after or {})
+        self.lock = threading.Lock()
+
+    def send_message(self,chat_id,text,**kwargs):
+        with self.lock:
+            if ( chat_id in self.retry_after ):
+                raise RetryAfter(self.retry_after.pop(chat_id))
+            self.sent.append((chat_id, text, time.monotonic()))
+
+
+def outbound_queue(tmp_path,workers=4,interactive_workers=1):
+    return OutboundQueue(str(tmp_path / 'outbound.sqlite3'),workers,interactive_workers,global_rate=1000,chat_rate=1000,chat_burst=100,
+                         broadcast_rate=1000,flush_seconds=0.05)
+
+
+def test_messages_to_a_chat_arrive_in_order(tmp_path):
+    outbound = outbound_queue(tmp_path)
+    bot = RecordingBot()
+    for n in range(20):
+        outbound.send(1,f'message {n}')
+        outbound.send(2,f'message {n}')
+    outbound.start(bot)
+    assert outbound.drain(timeout=5)
+    outbound.stop()
+
+    for chat_id in (1, 2):
+        assert [ text for sent_to, text, _ in bot.sent if sent_to == chat_id ] == [ f'message {n}' for n in range(20) ]
+
+
+def test_replies_go_before_queued_broadcasts(tmp_path):
+    outbound = outbound_queue(tmp_path,workers=1,interactive_workers=0)
+    bot = RecordingBot()
+    outbound.broadcast(range(100,110),'broadcast')
+    outbound.send(1,'reply')
+    outbound.start(bot)
+    assert outbound.drain(timeout=5)
+    outbound.stop()
+
+    assert bot.sent[0][:2] == (1, 'reply')
+    assert len(bot.sent) == 11
+
+
+def test_a_retry_after_pauses_the_chat_and_the_broadcast_lane(tmp_path):
+    outbound = outbound_queue(tmp_path,workers=2,interactive_workers=1)
+    bot = RecordingBot(retry_after={100 : 0.5})
+    started = time.monotonic()
+    outbound.broadcast([100],'first')
+    outbound.start(bot)
+    time.sleep(0.1)
+    outbound.broadcast([101],'second')
+    outbound.send(1,'reply')
+    assert outbound.drain(timeout=5)
+    outbound.stop()
+
+    sent = { chat_id : (text, at - started) for chat_id, text, at in bot.sent }
+    assert sent[1][1] < 0.4
+    assert sent[100][0] == 'first' and sent[100][1] >= 0.5
+    assert sent[101][1] >= 0.5
+
+
+def test_pending_messages_are_sent_after_a_restart(tmp_path):
+    outbound = outbound_queue(tmp_path)
+    outbound.send(1,'before the restart')
+    outbound.broadcast([2, 3],'broadcast',priority=PRIORITY_BACKGROUND)
+    outbound.stop()
+
+    bot = RecordingBot()
+    restarted = outbound_queue(tmp_path)
+    restarted.start(bot)
+    assert restarted.drain(timeout=5)
+    restarted.stop()
+    assert sorted((chat_id, text) for chat_id, text, _ in bot.sent) == [(1, 'before the restart'), (2, 'broadcast'), (3, 'broadcast')]
+
+    assert outbound_queue(tmp_path).stats()['queued'] == {'interactive' : 0, 'broadcast' : 0}
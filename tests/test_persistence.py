@@ -0,0 +1,107 @@
+import time
+import threading
+from queue import Queue
+
+from telegram import Bot, Update
+from telegram.ext import CommandHandler, ConversationHandler, Dispatcher, Filters, MessageHandler
+from telegram.utils.request import Request
+
+from vaxonbot.persistence import SqlitePersistence
+
+CHAT_ID = 1001
+ASKED, ANSWERED = range(2)
+
+
+def make_update(update_id,bot,text):
+    message = {
+        'message_id'    : update_id,
+        'date'          : int(time.time()),
+        'chat'          : {'id' : CHAT_ID, 'type' : 'private'},
+        'from'          : {'id' : CHAT_ID, 'is_bot' : False, 'first_name' : 'user'},
+        'text'          : text,
+    }
+    if ( text.startswith('/') ):
+        message['entities'] = [{'type' : 'bot_command', 'offset' : 0, 'length' : len(text)}]
+    return Update.de_json({'update_id' : update_id, 'message' : message},bot)
+
+
+def ask(update,cb_context):
+    cb_context.user_data['asked'] = True
+    return ASKED
+
+
+def answer(update,cb_context):
+    return ANSWERED
+
+
+def finish(update,cb_context):
+    return ConversationHandler.END
+
+
+class OfflineRequest(Request):
+    ## The handlers here never send, the only Bot API call is getMe for the username commands are matched against
+    def post(self,url,data,timeout=None):
+        return {'id' : 1, 'is_bot' : True, 'first_name' : 'test', 'username' : 'test_bot'}
+
+
+def make_dispatcher(path,run_async=False):
+    bot = Bot('123456:TEST-TOKEN',request=OfflineRequest())
+    persistence = SqlitePersistence(path,flush_interval=3600)
+    dispatcher = Dispatcher(bot,Queue(),workers=2,persistence=persistence,use_context=True)
+    dispatcher.add_handler(ConversationHandler(
+        entry_points=[CommandHandler('start',ask,run_async=run_async)],
+        states={
+            ASKED       : [MessageHandler(Filters.text & ~Filters.command,answer,run_async=run_async)],
+            ANSWERED    : [CommandHandler('done',finish,run_async=run_async)],
+        },
+        fallbacks=[],
+        name='conversation',
+        persistent=True,
+    ))
+    return dispatcher, persistence
+
+
+def restored_conversation(path):
+    persistence = SqlitePersistence(path,flush_interval=3600)
+    try :
+        return persistence.get_conversations('conversation'), persistence.get_user_data()[CHAT_ID]
+    finally :
+        persistence.flush()
+
+
+def test_conversation_steps_are_restored(tmp_path):
+    path = str(tmp_path / 'bot.sqlite3')
+    dispatcher, persistence = make_dispatcher(path)
+    dispatcher.process_update(make_update(1,dispatcher.bot,'/start'))
+    persistence.write_dirty()
+    assert restored_conversation(path) == ({(CHAT_ID, CHAT_ID) : ASKED}, {'asked' : True})
+
+    dispatcher.process_update(make_update(2,dispatcher.bot,'Kerala'))
+    persistence.write_dirty()
+    assert restored_conversation(path)[0] == {(CHAT_ID, CHAT_ID) : ANSWERED}
+
+    dispatcher.process_update(make_update(3,dispatcher.bot,'/done'))
+    persistence.flush()
+    assert restored_conversation(path)[0] == {}
+
+
+def test_run_async_step_is_stored_once_the_handler_is_done(tmp_path):
+    path = str(tmp_path / 'bot.sqlite3')
+    dispatcher, persistence = make_dispatcher(path,run_async=True)
+    ## The run_async worker threads only start with the dispatcher
+    started = threading.Event()
+    threading.Thread(target=dispatcher.start,args=(started,),daemon=True).start()
+    started.wait(5)
+    dispatcher.process_update(make_update(1,dispatcher.bot,'/start'))
+    ## No later update resolves the handler's Promise in the ConversationHandler, the writer has to
+    state = persistence.get_conversations('conversation')[(CHAT_ID, CHAT_ID)]
+    assert state[1].done.wait(5)
+    dispatcher.stop()
+    persistence.flush()
+    assert restored_conversation(path)[0] == {(CHAT_ID, CHAT_ID) : ASKED}
+
+    ## Restored into a new ConversationHandler the conversation goes on from there
+    dispatcher, persistence = make_dispatcher(path)
+    dispatcher.process_update(make_update(2,dispatcher.bot,'Kerala'))
+    persistence.flush()
+    assert restored_conversation(path)[0] == {(CHAT_ID, CHAT_ID) : ANSWERED}
@@ -0,0 +1,69 @@
+from vaxonbot.calendars import CalendarCenter, CalendarSession
+from vaxonbot.config import BY_DIST, BY_PIN
+from vaxonbot.feed import CAPACITY_CHANGED, SESSION_CLOSED, SESSION_OPENED, CalendarChange
+from vaxonbot.subscriptions import Subscription, SubscriptionRegistry, util_matching_alerts
+
+
+def test_subscriptions_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'bot.sqlite3')
+    registry = SubscriptionRegistry(path)
+    registry.add((BY_DIST, '140'),Subscription(11,None,18,1))
+    registry.add((BY_DIST, '140'),Subscription(11,None,18,1))
+    registry.add((BY_PIN, '110001'),Subscription(12,'110001',None,None))
+    registry.add((BY_DIST, '140'),Subscription(13,None,None,2))
+    assert 1 == registry.remove_chat(13)
+
+    restarted = SubscriptionRegistry(path)
+    assert restarted.targets() == {
+        (BY_DIST, '140')    : [Subscription(11,None,18,1)],
+        (BY_PIN, '110001')  : [Subscription(12,'110001',None,None)],
+    }
+
+
+def test_cluster_worker_loads_only_its_own_chats(tmp_path):
+    path = str(tmp_path / 'bot.sqlite3')
+    registry = SubscriptionRegistry(path)
+    for chat_id in range(10,16):
+        registry.add((BY_DIST, '140'),Subscription(chat_id,None,None,None))
+
+    shards = [ SubscriptionRegistry(path,(shard, 3)) for shard in range(3) ]
+    chat_ids = [ sorted(subscription.chat_id for subscription in shard.subscriptions((BY_DIST, '140'))) for shard in shards ]
+    assert chat_ids == [[12, 15], [10, 13], [11, 14]]
+
+
+def test_a_chat_holds_at_most_limit_subscriptions(tmp_path):
+    registry = SubscriptionRegistry(str(tmp_path / 'bot.sqlite3'))
+    assert registry.add((BY_PIN, '110001'),Subscription(11,'110001',None,None),2)
+    assert registry.add((BY_PIN, '110002'),Subscription(11,'110002',None,None),2)
+    assert registry.add((BY_PIN, '110002'),Subscription(11,'110002',None,None),2)
+    assert not registry.add((BY_PIN, '110003'),Subscription(11,'110003',None,None),2)
+    assert registry.add((BY_PIN, '110003'),Subscription(12,'110003',None,None),2)
+
+    registry.remove_chat(11)
+    assert registry.add((BY_PIN, '110003'),Subscription(11,'110003',None,None),2)
+
+
+def test_alerts_match_the_pincode_min_age_and_dose_of_each_subscription():
+    center = CalendarCenter(1234,'PHC',110001,'Free')
+    other_center = CalendarCenter(1235,'CHC',110002,'Free')
+    opened_18 = CalendarSession('s1','05-05-2021','COVISHIELD',18,5,0)
+    opened_45 = CalendarSession('s2','05-05-2021','COVAXIN',45,0,3)
+    changes = [
+        CalendarChange(SESSION_OPENED,center,None,opened_18),
+        CalendarChange(CAPACITY_CHANGED,other_center,CalendarSession('s2','05-05-2021','COVAXIN',45,2,0),opened_45),
+        CalendarChange(SESSION_CLOSED,center,opened_18,None),
+    ]
+    subscriptions = [
+        Subscription(11,None,None,None),
+        Subscription(12,'110001',None,None),
+        Subscription(13,None,45,None),
+        Subscription(14,None,None,1),
+        Subscription(15,'110002',18,None),
+    ]
+
+    assert util_matching_alerts(subscriptions,changes) == {
+        11  : [(center, opened_18), (other_center, opened_45)],
+        12  : [(center, opened_18)],
+        13  : [(other_center, opened_45)],
+        14  : [(center, opened_18)],
+    }
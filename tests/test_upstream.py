@@ -0,0 +1,50 @@
+import threading
+import time
+
+import pytest
+
+from vaxonbot.upstream import ResponseCache
+
+
+def test_a_failed_fetch_does_not_leave_the_key_in_flight():
+    cache = ResponseCache(ttl=60)
+
+    def failing_fetch():
+        raise ConnectionError('upstream went away')
+
+    with pytest.raises(ConnectionError):
+        cache.get_or_fetch('key',failing_fetch)
+
+    results = []
+    caller = threading.Thread(target=lambda : results.append(cache.get_or_fetch('key',lambda : 'fresh')),daemon=True)
+    caller.start()
+    caller.join(2)
+    assert results == [('fresh', 0)]
+    assert cache.in_flight == {}
+
+
+def test_a_waiting_caller_serves_stale_data_after_max_wait():
+    cache = ResponseCache(ttl=0.05,stale_ttl=60)
+    cache.get_or_fetch('key',lambda : 'old')
+    time.sleep(0.1)
+
+    release = threading.Event()
+    fetching = threading.Event()
+
+    def slow_fetch():
+        fetching.set()
+        release.wait(5)
+        return 'new'
+
+    leader = threading.Thread(target=cache.get_or_fetch,args=('key',slow_fetch),daemon=True)
+    leader.start()
+    fetching.wait(1)
+
+    started = time.monotonic()
+    value, age = cache.get_or_fetch('key',lambda : 'unused',max_wait=0.1)
+    assert time.monotonic() - started < 1
+    assert value == 'old'
+    assert age > 0
+    release.set()
+    leader.join(1)
+    assert cache.get_or_fetch('key',lambda : 'unused')[0] == 'new'
@@ -0,0 +1,69 @@
+import json
+import time
+import threading
+import http.client
+
+from vaxonbot.webhook import WebhookServer
+
+
+class RecordingDispatcher:
+    ## Takes a while over every update so updates of one chat would overlap if they ran concurrently
+    bot = None
+
+    def __init__(self):
+        self.handled = []
+        self.running = set()
+        self.overlapped = False
+        self.lock = threading.Lock()
+
+    def process_update(self,update):
+        chat_id = update.effective_chat.id
+        with self.lock:
+            self.overlapped = self.overlapped or chat_id in self.running
+            self.running.add(chat_id)
+        time.sleep(0.02)
+        with self.lock:
+            self.running.discard(chat_id)
+            self.handled.append((chat_id, update.update_id))
+
+
+def post(port,update_id,chat_id):
+    body = json.dumps({'update_id' : update_id, 'message' : {'message_id' : update_id, 'date' : 0, 'text' : 'District',
+                                                             'chat' : {'id' : chat_id, 'type' : 'private'}}})
+    connection = http.client.HTTPConnection('127.0.0.1',port)
+    connection.request('POST','/hook',body,{'Content-Type' : 'application/json'})
+    status = connection.getresponse().status
+    connection.close()
+    return status
+
+
+def test_updates_of_a_chat_are_handled_one_at_a_time_in_order():
+    dispatcher = RecordingDispatcher()
+    webhook = WebhookServer(dispatcher,'127.0.0.1',0,'hook',queue_size=64,workers=4)
+    webhook.start()
+    port = webhook.httpd.server_address[1]
+    chat_ids = [ 1000 + chat for chat in range(3) ]
+    for update_id in range(1,31):
+        assert 200 == post(port,update_id,chat_ids[update_id % len(chat_ids)])
+    webhook.stop()
+
+    assert not dispatcher.overlapped
+    assert len(dispatcher.handled) == 30
+    for chat_id in chat_ids:
+        update_ids = [ update_id for handled_chat_id, update_id in dispatcher.handled if handled_chat_id == chat_id ]
+        assert update_ids == sorted(update_ids)
+
+
+def test_intake_to_handled_latency_is_exported():
+    from vaxonbot.instrumentation import Metrics
+
+    webhook = WebhookServer(RecordingDispatcher(),'127.0.0.1',0,'hook',queue_size=8,workers=2)
+    webhook.start()
+    assert 200 == post(webhook.httpd.server_address[1],1,1000)
+    webhook.stop()
+
+    exported = Metrics()
+    exported.add_collector(webhook.runtime_gauges)
+    text = exported.render()
+    assert 'vaxonbot_webhook_latency_seconds{quantile="0.5",stage="intake_to_handled"}' in text
+    assert 'vaxonbot_webhook_queued 0' in text
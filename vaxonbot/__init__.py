@@ -0,0 +1,16 @@
+"""
+
+Vaxonbot, Telegram bot for hassle free access to the CoWin vaccine calendar
+
+    create_app(**settings)      ->  App holding the bot's state, see vaxonbot.app
+    app.create_updater(token)   ->  the python-telegram-bot Updater with every handler and job registered
+    app.run(mode)               ->  runs the bot, python -m vaxonbot does this
+
+Importing the package only imports vaxonbot.app and vaxonbot.config, telegram, requests and the
+metadata files are loaded when first needed
+
+"""
+
+from .app import App, create_app
+
+__all__ = ['App', 'create_app']
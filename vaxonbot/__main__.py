@@ -0,0 +1,49 @@
+"""
+
+Command line of the bot
+
+usage       :   python -m vaxonbot                                              poll for updates
+                python -m vaxonbot --webhook                                    serve updates on the webhook
+                python -m vaxonbot --cluster [workers]                          router, shared store and webhook workers
+                python -m vaxonbot --shared-store                               shared store of a cluster
+                python -m vaxonbot --worker <shard> [workers]                   webhook worker of a cluster
+                python -m vaxonbot --build-pincode-index <csv_path> [out_path]  build the offline pincode index
+                python -m vaxonbot --compile-metadata                           compile state-dist-map.json for a fast start
+
+"""
+
+import sys
+
+from .app import create_app
+from .instrumentation import util_setup_logging
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    app = create_app()
+    util_setup_logging(app.config.LOG_FILE)
+    if ( len(argv) > 1 and argv[0] == '--build-pincode-index' ):
+        from .pincodes import util_build_pincode_index
+        util_build_pincode_index(app.district_metadata,*argv[1:3])
+    elif ( len(argv) > 0 and argv[0] == '--compile-metadata' ):
+        from .metadata import util_compile_metadata
+        util_compile_metadata(app.district_metadata,app.config.STATE_DIST_MAP_FILE)
+    elif ( len(argv) > 0 and argv[0] == '--webhook' ):
+        app.run('webhook')
+    elif ( len(argv) > 0 and argv[0] == '--shared-store' ):
+        from .cluster import run_shared_store
+        run_shared_store(app.config.SHARED_STORE_ADDRESS,app.config.SHARED_STORE_AUTHKEY)
+    elif ( len(argv) > 1 and argv[0] == '--worker' ):
+        ## The worker count decides which chats are the worker's own, it has to be the router's
+        if ( len(argv) > 2 ):
+            app.config.CLUSTER_WORKERS = int(argv[2])
+        app.run('webhook',int(argv[1]))
+    elif ( len(argv) > 0 and argv[0] == '--cluster' ):
+        from .cluster import run_cluster
+        run_cluster(app,*map(int,argv[1:2]))
+    else :
+        app.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+## Includes for Utils
+import logging
+import os
+import threading
+from types import SimpleNamespace
+
+from . import config as default_config
+
+
+
+
+"""
+
+class_name          :   component
+input               :   build       ->  method building the component from the App
+description         :   Decorator for the parts of an App, a component is built the first time it is read and then kept as
+                        a plain attribute so later reads cost nothing. Builds happen under the App's lock so threads reading a
+                        component together get the same one. A component can be replaced by assigning to it, which is how
+                        refresh jobs swap in new data
+
+"""
+
+class component:
+    def __init__(self,build):
+        self.build = build
+        self.name = build.__name__
+        self.__doc__ = build.__doc__
+
+    def __get__(self,app,owner=None):
+        if ( app is None ):
+            return self
+        with app.lock:
+            if ( self.name not in app.__dict__ ):
+                app.__dict__[self.name] = self.build(app)
+        return app.__dict__[self.name]
+
+
+
+
+## Names in vaxonbot.config that are limits of Telegram, the IST offset or enums the code compares against rather than
+## settings, they are read from vaxonbot.config directly and can't be overridden. Every other name is read from app.config
+FIXED_SETTINGS = frozenset((
+    'TELEGRAM_MAX_MESSAGE_LENGTH', 'IST_OFFSET_SECONDS', 'CHOOSE_QUERY_METHOD', 'CHOOSE_STATE', 'CHOOSE_PIN', 'CHOOSE_DISTRICT',
+    'FINISH', 'HELP', 'BY_DIST', 'BY_PIN', 'BY_STATE', 'PRIORITY_INTERACTIVE', 'PRIORITY_BACKGROUND',
+))
+
+
+
+
+"""
+
+class_name          :   App
+input               :   settings    ->  overrides of the defaults in vaxonbot.config, by name
+description         :   Everything the bot shares between handlers, jobs and upstream calls, in place of module globals
+                        Creating an App loads and imports nothing, the metadata files, the HTTP session and the modules
+                        behind each component are only loaded when the component is first used, and telegram only
+                        when create_updater is called
+
+"""
+
+class App:
+    def __init__(self,**settings):
+        self.config = SimpleNamespace(**{ name : value for name, value in vars(default_config).items() if name.isupper() })
+        for name, value in settings.items():
+            if ( not hasattr(self.config,name) ):
+                raise TypeError(f'Unknown setting {name}')
+            if ( name in FIXED_SETTINGS ):
+                raise TypeError(f'{name} is fixed and can not be overridden')
+            setattr(self.config,name,value)
+        ## The overrides as given, run_cluster builds the Apps of its child processes from them
+        self.settings = dict(settings)
+        self.lock = threading.RLock()
+        ## Set by run to the number of the cluster worker this App runs as
+        self.shard = None
+
+    @component
+    def district_metadata(self):
+        from .metadata import util_load_metadata
+        return util_load_metadata(self.config.STATE_DIST_MAP_FILE)
+
+    @component
+    def pincode_index(self):
+        from .pincodes import util_load_pincode_index
+        return util_load_pincode_index(self.config.PINCODE_INDEX_FILE)
+
+    @component
+    def http_session(self):
+        from .upstream import util_http_session
+        return util_http_session(self.config.HTTP_POOL_SIZE)
+
+    @component
+    def upstream_slots(self):
+        ## Bounds the handlers blocked on upstream so a slow API can't hold every dispatcher worker
+        return threading.BoundedSemaphore(self.config.UPSTREAM_CONCURRENCY)
+
+    @component
+    def upstream_latency(self):
+        from .instrumentation import LatencyRecorder
+        return LatencyRecorder()
+
+    @component
+    def upstream_budget(self):
+        from .upstream import UpstreamBudget
+        return UpstreamBudget(self.config.UPSTREAM_BUDGETS)
+
+    @component
+    def calendar_cache(self):
+        from .upstream import ResponseCache
+        return ResponseCache(self.config.CACHE_TTL_SECONDS,self.config.CACHE_MAX_ENTRIES,self.config.CACHE_STALE_SECONDS)
+
+    @component
+    def change_feed(self):
+        from .feed import ChangeFeed, util_count_changes
+        change_feed = ChangeFeed(self.config.FEED_MAX_KEYS,self.config.FEED_QUEUE_SIZE)
+        change_feed.subscribe(util_count_changes)
+        change_feed.subscribe(self.availability_archive.append)
+        return change_feed
+
+    @component
+    def availability_archive(self):
+        from .feed import AvailabilityArchive
+        return AvailabilityArchive(self.config.ARCHIVE_DIR)
+
+    @component
+    def availability_snapshot(self):
+        from .snapshot import AvailabilitySnapshot
+        return AvailabilitySnapshot()
+
+    @component
+    def subscription_registry(self):
+        from .subscriptions import SubscriptionRegistry
+        shard = (self.shard, self.config.CLUSTER_WORKERS) if self.shard is not None else None
+        return SubscriptionRegistry(self.config.PERSISTENCE_FILE,shard)
+
+    @component
+    def outbound(self):
+        from .outbound import OutboundQueue
+        config = self.config
+        outbound = OutboundQueue(config.OUTBOUND_QUEUE_FILE,config.OUTBOUND_WORKERS,config.OUTBOUND_INTERACTIVE_WORKERS,
+                                 config.TELEGRAM_GLOBAL_RATE,config.TELEGRAM_CHAT_RATE,config.TELEGRAM_CHAT_BURST,
+                                 config.OUTBOUND_BROADCAST_RATE,config.OUTBOUND_MAX_ATTEMPTS,config.PERSISTENCE_FLUSH_SECONDS,
+                                 config.HTTP_BACKOFF_BASE,config.HTTP_BACKOFF_MAX)
+        ## With a shared store every worker takes from the same global Telegram budget
+        if ( self.upstream_budget.store is not None ):
+            outbound.use_store(self.upstream_budget.store)
+        return outbound
+
+    @component
+    def fanout_pool(self):
+        from concurrent.futures import ThreadPoolExecutor
+        return ThreadPoolExecutor(max_workers=self.config.FANOUT_WORKERS,thread_name_prefix='fanout')
+
+    def create_updater(self,token=None,mode=None,persistence=None):
+        ## See vaxonbot.bot.create_updater, this is the first point telegram is imported
+        from .bot import create_updater
+        return create_updater(self,token,mode,persistence)
+
+    def use_shared_store(self,address=None,authkey=None):
+        ## Switches this App over to the calendar cache and upstream budget of a running shared store
+        from .cluster import SharedResponseCache
+        address = address or self.config.SHARED_STORE_ADDRESS
+        self.calendar_cache = SharedResponseCache(address,authkey or self.config.SHARED_STORE_AUTHKEY,self.config.CACHE_TTL_SECONDS,
+                                                  self.config.SHARED_STORE_LEASE_SECONDS,self.config.CACHE_STALE_SECONDS)
+        self.upstream_budget.use_store(self.calendar_cache.store)
+        logging.info(f'Using shared store at {address}')
+
+    def runtime_gauges(self):
+        ## Metrics collector reading the stats the cache, the availability snapshot and the budget already keep, so the hot
+        ## path isn't instrumented twice. Reads the components at scrape time since workers swap in the shared cache
+        cache_stats = self.calendar_cache.stats()
+        lookups = cache_stats['hits'] + cache_stats['misses']
+        samples = [
+            ('vaxonbot_cache_hit_ratio', {}, cache_stats['hits'] / lookups if lookups else 0),
+            ('vaxonbot_cache_hits', {}, cache_stats['hits']),
+            ('vaxonbot_cache_misses', {}, cache_stats['misses']),
+        ]
+        for key in ('evictions','stale_served','size'):
+            if ( key in cache_stats ):
+                samples.append((f'vaxonbot_cache_{key}', {}, cache_stats[key]))
+        snapshot_stats = self.availability_snapshot.stats()
+        for key in ('districts','sessions','bytes','age'):
+            samples.append((f'vaxonbot_snapshot_{key}', {}, snapshot_stats[key]))
+        budget_stats = self.upstream_budget.stats()
+        samples.append(('vaxonbot_upstream_budget_exhausted', {}, budget_stats['exhausted']))
+        for upstream, queued in budget_stats['queued'].items():
+            samples.append(('vaxonbot_upstream_budget_queued', {'upstream' : upstream}, queued))
+        ## How long calls waited for a token over the last LatencyRecorder window, as the quantiles of a summary
+        for (upstream, priority), wait in budget_stats['wait'].items():
+            for point in (50,90,99):
+                samples.append(('vaxonbot_upstream_budget_wait_seconds', {'upstream' : upstream, 'priority' : priority, 'quantile' : point / 100}, wait[f'p{point}']))
+        outbound_stats = self.outbound.stats()
+        ## The lag of a lane is how long its oldest pending message has been waiting
+        for key, name in (('queued','queued'), ('in_flight','in_flight'), ('lag','lag_oldest_seconds')):
+            for lane, value in outbound_stats[key].items():
+                samples.append((f'vaxonbot_outbound_{name}', {'lane' : lane}, value))
+        samples.append(('vaxonbot_outbound_delivered_per_second', {}, outbound_stats['delivered_per_second']))
+        return samples
+
+    def run(self,mode=None,shard=None):
+        ## Runs the bot until it is stopped, as one of the cluster workers if shard is given
+        from .instrumentation import metrics, MetricsServer
+        config = self.config
+        mode = mode or config.BOT_MODE
+
+        # As one of the cluster workers the cache and upstream budget are shared with the other workers,
+        # the outbound queue is the worker's own and only the subscriptions of its own chats are loaded
+        if ( shard is not None ):
+            self.shard = shard
+            self.use_shared_store()
+            queue_file, extension = os.path.splitext(config.OUTBOUND_QUEUE_FILE)
+            config.OUTBOUND_QUEUE_FILE = f'{queue_file}-{shard}{extension}'
+
+        updater = self.create_updater(mode=mode)
+
+        # Expose the metrics to Prometheus, every cluster worker on its own port
+        metrics.add_collector(self.runtime_gauges)
+        MetricsServer(config.METRICS_PORT if shard is None else config.METRICS_PORT + 1 + shard).start()
+
+        # Receive updates over a webhook instead of polling for them
+        if ( 'webhook' == mode ):
+            from .webhook import run_webhook
+            run_webhook(self,updater,config.WEBHOOK_PORT if shard is None else config.WEBHOOK_PORT + 1 + shard)
+            return
+
+        # Start the Bot
+        updater.start_polling()
+
+        # Run the bot until you press Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT. This should be used most of the time, since
+        # start_polling() is non-blocking and will stop the bot gracefully.
+        updater.idle()
+        self.outbound.stop()
+
+
+
+
+"""
+
+function_name       :   create_app
+input               :   settings    ->  overrides of the defaults in vaxonbot.config, by name
+output              :   a new App
+description         :   The app factory, every process, test and benchmark builds its bot from one of these
+
+"""
+
+def create_app(**settings):
+    return App(**settings)
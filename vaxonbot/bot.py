@@ -0,0 +1,150 @@
+## Includes for Utils
+import time
+import functools
+
+## Includes for Telegram API etc
+from telegram.utils.request import Request
+from telegram.ext import (
+    ExtBot,
+    Updater, 
+    CommandHandler, 
+    MessageHandler, 
+    Filters, 
+    ConversationHandler,
+    InlineQueryHandler,
+)
+
+from .config import CHOOSE_QUERY_METHOD, CHOOSE_STATE, CHOOSE_PIN, CHOOSE_DISTRICT, HELP
+from .instrumentation import metrics
+from .metadata import refresh_metadata, reload_metadata
+from .snapshot import refresh_snapshot
+from .subscriptions import poll_subscriptions, send_alerts
+from .persistence import SqlitePersistence
+from .handlers import (
+    start, choose_state, choose_district, find_calendar_bydistrict, enter_pincode, find_calendar_bypincode,
+    find_calendar_bystate, show_trends, repeat_last_query, subscribe, unsubscribe, broadcast, inline_search, cleanup, about,
+)
+
+
+
+
+"""
+
+class_name          :   InstrumentedRequest
+description         :   The python-telegram-bot Request used by the bot, counts and times every Bot API call by method
+
+"""
+
+class InstrumentedRequest(Request):
+    def post(self,url,data,timeout=None):
+        method = url.rsplit('/',1)[-1]
+        started = time.perf_counter()
+        result = 'error'
+        try :
+            response = super().post(url,data,timeout)
+            result = 'ok'
+            return response
+        finally :
+            metrics.inc('vaxonbot_telegram_requests_total',method=method,result=result)
+            metrics.observe('vaxonbot_upstream_seconds',time.perf_counter() - started,endpoint=f'telegram/{method}')
+
+
+
+
+def create_updater(app,token=None,mode=None,persistence=None) -> Updater:
+    """Create the Updater of app with every handler and job registered, without starting it."""
+    config = app.config
+    token = token or config.TELEGRAM_TOKEN
+    mode = mode or config.BOT_MODE
+
+    # Bot API calls go through InstrumentedRequest so sends are counted and timed
+    bot = ExtBot(token,base_url=config.TELEGRAM_BASE_URL,request=InstrumentedRequest(con_pool_size=config.DISPATCHER_WORKERS + 4))
+    updater = Updater(bot=bot,use_context=True,workers=config.DISPATCHER_WORKERS,
+                      persistence=persistence or SqlitePersistence(config.PERSISTENCE_FILE,config.PERSISTENCE_FLUSH_SECONDS))
+
+    # Handlers find the app in bot_data, jobs in their context
+    updater.dispatcher.bot_data['app'] = app
+
+    # Every message goes out through the outbound queue, which sends with this bot
+    app.outbound.start(updater.bot)
+
+    # The webhook runs each chat's updates in order on one of its workers and different chats concurrently,
+    # handlers only need to be async when polling
+    run_async = config.ASYNC_HANDLERS and 'webhook' != mode
+
+
+    # Get the dispatcher to register handlers
+    dispatcher = updater.dispatcher
+    
+    # Creating a conversation handler to split up the functionalities as states in a conversation
+    conv_handler = ConversationHandler(
+        entry_points    =   [   CommandHandler('start',start,run_async=run_async),
+                                CommandHandler('bydistrict',find_calendar_bydistrict,run_async=run_async),
+                                CommandHandler('bypincode',find_calendar_bypincode,run_async=run_async),
+                                CommandHandler('bystate',find_calendar_bystate,run_async=run_async),
+                                CommandHandler('trends',show_trends,run_async=run_async),
+                                CommandHandler('repeat',repeat_last_query,run_async=run_async),
+                                CommandHandler('subscribe',subscribe,run_async=run_async),
+                                CommandHandler('unsubscribe',unsubscribe,run_async=run_async),
+                                CommandHandler('cancel',cleanup,run_async=run_async),
+                                CommandHandler('exit',cleanup,run_async=run_async),
+                                CommandHandler('about',about,run_async=run_async)
+                            ],
+                            
+        states          =   {
+                                CHOOSE_QUERY_METHOD :   [
+                                                            MessageHandler(Filters.regex('^(District)$'),choose_state,run_async=run_async),
+                                                            MessageHandler(Filters.regex('^PIN-code$'),enter_pincode,run_async=run_async),
+                                                            MessageHandler(Filters.regex('^Repeat last search$'),repeat_last_query,run_async=run_async),
+                                                            CommandHandler('cancel',cleanup,run_async=run_async),
+                                                            CommandHandler('exit',cleanup,run_async=run_async)
+                                                        ],
+                                CHOOSE_STATE        :   [
+                                                            MessageHandler(~Filters.command,choose_district,run_async=run_async),
+                                                            CommandHandler('cancel',cleanup,run_async=run_async),
+                                                            CommandHandler('exit',cleanup,run_async=run_async),
+                                                        ],
+                                CHOOSE_DISTRICT     :   [
+                                                            MessageHandler(~Filters.command,find_calendar_bydistrict,run_async=run_async),
+                                                            CommandHandler('cancel',cleanup,run_async=run_async),
+                                                            CommandHandler('exit',cleanup,run_async=run_async)
+                                                        ],
+                                CHOOSE_PIN          :   [
+                                                            MessageHandler(~Filters.command,find_calendar_bypincode,run_async=run_async),
+                                                            CommandHandler('cancel',cleanup,run_async=run_async),
+                                                            CommandHandler('exit',cleanup,run_async=run_async)
+                                                        ],
+                                HELP                :   [
+                                                            MessageHandler(~Filters.command,cleanup,run_async=run_async),
+                                                            CommandHandler('exit',cleanup,run_async=run_async),
+                                                            CommandHandler('cancel',cleanup,run_async=run_async)
+                                                        ]
+                            },
+        fallbacks=[CommandHandler('cancel',cleanup,run_async=run_async)],
+        name='vaccine_query',
+        persistent=True,
+    )
+
+    #  Adding the conversation handler to the Dispatcher
+    dispatcher.add_handler(conv_handler)
+
+    # Admin announcements sit outside the conversation so they don't disturb the admin's own
+    dispatcher.add_handler(CommandHandler('broadcast',broadcast,run_async=run_async))
+
+    # @bot <name> autocompletes states and districts, no conversation involved either
+    dispatcher.add_handler(InlineQueryHandler(inline_search,run_async=run_async))
+
+    # Poll the subscribed districts in the background, alerts are sent for the changes any fetch finds
+    updater.job_queue.run_repeating(poll_subscriptions,interval=config.SUBSCRIPTION_POLL_SECONDS,first=10,context=app)
+    app.change_feed.subscribe(functools.partial(send_alerts,app))
+
+    # Keep the availability of the hot districts in memory
+    updater.job_queue.run_repeating(refresh_snapshot,interval=config.SNAPSHOT_REFRESH_SECONDS,first=0,context=app)
+
+    # Keep the state and district list in sync with CoWIN, in a cluster only shard 0 fetches and rewrites it
+    # and the other workers load the file again once it changed
+    if ( app.shard in (None,0) ):
+        updater.job_queue.run_repeating(refresh_metadata,interval=config.METADATA_REFRESH_SECONDS,first=config.METADATA_REFRESH_SECONDS,context=app)
+    else :
+        updater.job_queue.run_repeating(reload_metadata,interval=config.METADATA_RELOAD_SECONDS,first=config.METADATA_RELOAD_SECONDS,context=app)
+    return updater
@@ -0,0 +1,159 @@
+from .config import TELEGRAM_MAX_MESSAGE_LENGTH
+
+
+
+
+"""
+class_name          :   CalendarCenter, CalendarSession
+description         :   Slotted records holding only the fields the bot uses of a center and of one of its sessions,
+                        a fraction of the size of the parsed JSON dicts they are built from
+"""
+
+class CalendarCenter:
+    __slots__ = ('center_id', 'name', 'pincode', 'fee_type')
+
+    def __init__(self,center_id,name,pincode,fee_type):
+        self.center_id = center_id
+        self.name = name
+        self.pincode = pincode
+        self.fee_type = fee_type
+
+    @classmethod
+    def from_json(cls,center):
+        return cls(center['center_id'],center['name'],center['pincode'],center['fee_type'])
+
+
+class CalendarSession:
+    __slots__ = ('session_id', 'date', 'vaccine', 'min_age', 'dose1', 'dose2')
+
+    def __init__(self,session_id,date,vaccine,min_age,dose1,dose2):
+        self.session_id = session_id
+        self.date = date
+        self.vaccine = vaccine
+        self.min_age = min_age
+        self.dose1 = dose1
+        self.dose2 = dose2
+
+    @classmethod
+    def from_json(cls,session):
+        return cls(session['session_id'],session['date'],session['vaccine'],session['min_age_limit'],
+                   session['available_capacity_dose1'],session['available_capacity_dose2'])
+
+
+
+
+"""
+function_name       :   util_parse_calendar
+input               :   resp_obj    ->  calendar JSON from calendarByDistrict or calendarByPin
+                        min_age     ->  only keep sessions with this min_age_limit if given
+                        dose        ->  1 or 2 to only keep sessions with capacity for that dose, either dose if None
+                        vaccine     ->  only keep sessions of this vaccine if given, any case
+                        fee_type    ->  only keep centers with this fee type (Free/Paid) if given, any case
+output              :   list of (CalendarCenter, [CalendarSession]) for the centers with at least one matching session
+description         :   Walks the calendar once, checking each session against the filters as it goes
+                        and only building records for what is kept
+"""
+
+def util_parse_calendar(resp_obj,min_age=None,dose=None,vaccine=None,fee_type=None):
+    if ( vaccine is not None ):
+        vaccine = vaccine.upper()
+    if ( fee_type is not None ):
+        fee_type = fee_type.lower()
+    capacity_key = 'available_capacity_dose1' if dose == 1 else 'available_capacity_dose2' if dose == 2 else None
+    available = []
+    for center in resp_obj['centers']:
+        if ( fee_type is not None and center['fee_type'].lower() != fee_type ):
+            continue
+        sessions = None
+        for session in center['sessions']:
+            dose1 = session['available_capacity_dose1']
+            dose2 = session['available_capacity_dose2']
+            if ( capacity_key is None ):
+                if ( dose1 + dose2 <= 0 ):
+                    continue
+            elif ( session[capacity_key] <= 0 ):
+                continue
+            if ( min_age is not None and session['min_age_limit'] != min_age ):
+                continue
+            if ( vaccine is not None and session['vaccine'].upper() != vaccine ):
+                continue
+            record = CalendarSession(session['session_id'],session['date'],session['vaccine'],session['min_age_limit'],dose1,dose2)
+            if ( sessions is None ):
+                sessions = [record]
+            else :
+                sessions.append(record)
+        if ( sessions is not None ):
+            available.append((CalendarCenter(center['center_id'],center['name'],center['pincode'],center['fee_type']),sessions))
+    return available
+
+
+
+
+"""
+function_name       :   util_render_center
+input               :   center      ->  CalendarCenter to render
+                        sessions    ->  the CalendarSession records of the center to list
+output              :   text with a header line for the center and one row per session
+description         :   Compact tabular rendering used by calendar replies and alerts
+"""
+
+def util_render_center(center,sessions):
+    rows = [f'{center.name}, {center.pincode} ({center.fee_type})']
+    for session in sessions:
+        rows += [f'{session.date}  {session.vaccine:<11} {session.min_age}+  D1 {session.dose1:<4} D2 {session.dose2}']
+    return '\n'.join(rows)
+
+
+
+
+"""
+function_name       :   util_pack_messages
+input               :   blocks      ->  texts to send, a block is never split unless it is longer than limit by itself
+                        limit       ->  maximum characters per message
+output              :   list of messages, each at most limit characters
+description         :   Greedily packs blocks separated by blank lines into as few messages as possible
+"""
+
+def util_pack_messages(blocks,limit=TELEGRAM_MAX_MESSAGE_LENGTH):
+    messages = []
+    current = ''
+    for block in blocks:
+        while ( len(block) > limit ):
+            if ( current ):
+                messages += [current]
+                current = ''
+            messages += [block[:limit]]
+            block = block[limit:]
+        if ( current and len(current) + 2 + len(block) > limit ):
+            messages += [current]
+            current = ''
+        current = f'{current}\n\n{block}' if current else block
+    if ( current ):
+        messages += [current]
+    return messages
+
+
+
+
+"""
+
+function_name       :   util_rank_centers
+input               :   calendars   ->  dict of district id -> (open centers, age) from util_fetch_districts
+output              :   list of (district id, CalendarCenter, [CalendarSession]) of the centers with open slots,
+                        the center with the earliest session first, more capacity first on the same day
+description         :   Merges several district calendars into one list, sessions of a center are sorted by date
+
+"""
+
+def util_session_rank(session):
+    day, month, year = session.date.split('-')
+    return (year, month, day, -(session.dose1 + session.dose2))
+
+def util_rank_centers(calendars):
+    ranked = []
+    for district_id, (available, age) in calendars.items():
+        for center, sessions in available:
+            sessions.sort(key=util_session_rank)
+            ranked.append((util_session_rank(sessions[0]), district_id, center, sessions))
+    ranked.sort(key=lambda entry : entry[0])
+    return [ (district_id, center, sessions) for _, district_id, center, sessions in ranked ]
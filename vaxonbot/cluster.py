@@ -0,0 +1,399 @@
+## Includes for Utils
+import logging
+import json
+import time
+import threading
+import multiprocessing
+import http.client
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .config import (
+    CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS, CACHE_STALE_SECONDS, SHARED_STORE_ADDRESS, SHARED_STORE_AUTHKEY,
+    SHARED_STORE_LEASE_SECONDS, CLUSTER_WORKERS, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, HTTP_TIMEOUT,
+)
+from .upstream import TokenBucket, UpstreamBudgetExhausted
+
+
+
+
+"""
+
+class_name          :   SharedState
+description         :   The state workers share, served to them by the shared store process over a socket
+                        Holds calendar responses with an expiry, short leases so only one worker fetches a missing key
+                        and the upstream token buckets, all methods are called through a manager proxy
+
+"""
+
+class SharedState:
+    def __init__(self,max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.leases = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.counters = {'hits' : 0, 'misses' : 0, 'stores' : 0, 'evictions' : 0}
+
+    def get(self,key,max_age):
+        ## Returns (value, age) if the key was stored less than max_age seconds ago, None otherwise
+        with self.lock:
+            entry = self.entries.get(key)
+            age = time.monotonic() - entry[0] if entry is not None else None
+            if ( entry is None or age >= max_age ):
+                self.counters['misses'] += 1
+                return None
+            self.counters['hits'] += 1
+            self.entries.move_to_end(key)
+            return (entry[1], age)
+
+    def contains(self,key,max_age):
+        ## Like get without counting a hit or miss and without sending the value back
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and time.monotonic() - entry[0] < max_age
+
+    def put(self,key,value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            self.counters['stores'] += 1
+            while ( len(self.entries) > self.max_entries ):
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def claim(self,key,lease_seconds):
+        ## True for exactly one caller until it releases the key or the lease runs out
+        with self.lock:
+            now = time.monotonic()
+            if ( self.leases.get(key,0) > now ):
+                return False
+            self.leases[key] = now + lease_seconds
+            return True
+
+    def release(self,key):
+        with self.lock:
+            self.leases.pop(key,None)
+
+    def take_token(self,name,rate,capacity):
+        with self.lock:
+            if ( name not in self.buckets ):
+                self.buckets[name] = TokenBucket(rate,capacity)
+        return self.buckets[name].try_acquire()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters,size=len(self.entries))
+
+
+"""
+
+class_name          :   UpdateHTTPServer
+description         :   Threaded HTTP server the router and the webhook workers receive updates on
+                        Telegram opens up to 40 connections at once (max_connections of setWebhook) and the router one per
+                        update it forwards, the listen backlog of 5 connections http.server keeps by default resets the rest
+
+"""
+
+class UpdateHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 128
+    daemon_threads = True
+
+
+## Separate manager classes for the serving and the connecting side since register() is per class
+class SharedStoreServer(BaseManager):
+    pass
+
+
+class SharedStoreClient(BaseManager):
+    pass
+
+
+
+
+"""
+
+function_name       :   run_shared_store
+input               :   address     ->  (host, port) to serve on
+                        authkey     ->  key workers must present
+output              :   None, serves until killed
+description         :   Runs the shared store process, started with python -m vaxonbot --shared-store
+
+"""
+
+def run_shared_store(address=SHARED_STORE_ADDRESS,authkey=SHARED_STORE_AUTHKEY):
+    shared_state = SharedState()
+    SharedStoreServer.register('shared_state',callable=lambda : shared_state)
+    manager = SharedStoreServer(address=address,authkey=authkey)
+    logging.info(f'Shared store serving on {address}')
+    manager.get_server().serve_forever()
+
+
+
+
+"""
+
+function_name       :   util_connect_shared_store
+input               :   address     ->  (host, port) of the shared store
+                        authkey     ->  key the store was started with
+output              :   proxy to the SharedState of the store
+description         :   Connects to a running shared store
+
+"""
+
+def util_connect_shared_store(address=SHARED_STORE_ADDRESS,authkey=SHARED_STORE_AUTHKEY):
+    SharedStoreClient.register('shared_state')
+    manager = SharedStoreClient(address=address,authkey=authkey)
+    manager.connect()
+    return manager.shared_state()
+
+
+
+
+"""
+
+class_name          :   SharedResponseCache
+input               :   address     ->  (host, port) of the shared store
+                        authkey     ->  key the store was started with
+                        ttl         ->  seconds a stored response is served
+                        lease       ->  seconds other workers wait on a worker fetching a key before trying themselves
+                        stale_ttl   ->  how old a response may be to be served when the upstream budget is used up
+description         :   Drop in replacement for ResponseCache when several workers run, a response fetched by any
+                        worker is served to all of them and a missing key is fetched by one worker at a time,
+                        the others wait for it at most max_wait seconds and then serve the stale response or fetch it too
+                        Each thread keeps its own proxy connection since proxies are not thread safe
+
+"""
+
+class SharedResponseCache:
+    POLL_SECONDS = 0.05
+
+    def __init__(self,address=SHARED_STORE_ADDRESS,authkey=SHARED_STORE_AUTHKEY,ttl=CACHE_TTL_SECONDS,lease=SHARED_STORE_LEASE_SECONDS,stale_ttl=CACHE_STALE_SECONDS):
+        self.address = address
+        self.authkey = authkey
+        self.ttl = ttl
+        self.lease = lease
+        self.stale_ttl = stale_ttl
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def store(self):
+        if ( not hasattr(self.local,'store') ):
+            self.local.store = util_connect_shared_store(self.address,self.authkey)
+        return self.local.store
+
+    def count(self,hit):
+        with self.lock:
+            if ( hit ):
+                self.hits += 1
+            else :
+                self.misses += 1
+
+    def get_or_fetch(self,key,fetch,max_wait=None):
+        store = self.store()
+        result = store.get(key,self.ttl)
+        if ( result is not None ):
+            self.count(True)
+            return result
+        self.count(False)
+        deadline = time.monotonic() + max_wait if max_wait is not None else None
+        while True:
+            if ( store.claim(key,self.lease) ):
+                try :
+                    ## The previous holder of the lease may have stored it between our get and claim
+                    result = store.get(key,self.ttl)
+                    if ( result is not None ):
+                        return result
+                    return self.fetch_stale_on_exhausted(store,key,fetch)
+                finally :
+                    store.release(key)
+            ## Another worker is fetching it, wait for it to show up or for its lease to run out
+            time.sleep(self.POLL_SECONDS)
+            result = store.get(key,self.ttl)
+            if ( result is not None ):
+                return result
+            if ( deadline is not None and time.monotonic() >= deadline ):
+                stale = store.get(key,self.stale_ttl)
+                if ( stale is not None ):
+                    logging.warning(f'Fetch of {key} still running after {max_wait}s, serving stale')
+                    return stale
+                return self.fetch_stale_on_exhausted(store,key,fetch)
+
+    def cached(self,key):
+        return self.store().contains(key,self.ttl)
+
+    def fetch_stale_on_exhausted(self,store,key,fetch):
+        try :
+            value = fetch()
+        except UpstreamBudgetExhausted as err:
+            stale = store.get(key,self.stale_ttl)
+            logging.warning(f'{err}, {"serving stale" if stale else "nothing cached for"} {key}')
+            return stale or (None, 0)
+        if ( value is not None ):
+            store.put(key,value)
+        return (value, 0)
+
+    def stats(self):
+        with self.lock:
+            local = {'hits' : self.hits, 'misses' : self.misses}
+        local['shared'] = self.store().stats()
+        return local
+
+
+
+
+"""
+
+function_name       :   util_update_chat_id
+input               :   data        ->  Update JSON as a dict
+output              :   id of the chat the update belongs to, 0 if it has none
+description         :   Used by the router to send all updates of a chat to the same worker
+
+"""
+
+def util_update_chat_id(data):
+    for kind in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member', 'chat_member', 'chat_join_request'):
+        if ( kind in data ):
+            return data[kind]['chat']['id']
+    if ( 'callback_query' in data ):
+        callback_query = data['callback_query']
+        if ( 'message' in callback_query ):
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    for kind in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query'):
+        if ( kind in data ):
+            return data[kind]['from']['id']
+    return 0
+
+
+
+
+"""
+
+class_name          :   UpdateRouter
+input               :   workers     ->  number of workers, worker n listens on WEBHOOK_PORT+1+n
+                        listen      ->  address to listen on
+                        port        ->  port Telegram delivers to
+                        path        ->  webhook path, the same on the router and the workers
+                        timeout     ->  seconds to wait for a worker to take an update
+description         :   Front of the multi worker mode, forwards every POSTed update to the worker owning its chat
+                        (chat id modulo workers) so a conversation is only ever handled by one process
+                        The worker's status is passed back so a full worker queue still pushes back on Telegram
+
+"""
+
+class UpdateRouter:
+    def __init__(self,workers=CLUSTER_WORKERS,listen=WEBHOOK_LISTEN,port=WEBHOOK_PORT,path=WEBHOOK_PATH,timeout=HTTP_TIMEOUT[1]):
+        self.workers = workers
+        self.timeout = timeout
+        self.port = port
+        self.path = '/' + path.strip('/')
+        self.httpd = UpdateHTTPServer((listen,port),self.request_handler())
+
+    def request_handler(self):
+        router = self
+
+        class RouterRequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if ( self.path != router.path ):
+                    return self.reply(404)
+                body = self.rfile.read(int(self.headers.get('Content-Length',0)))
+                try :
+                    shard = util_update_chat_id(json.loads(body)) % router.workers
+                except (ValueError, TypeError, KeyError) as err:
+                    logging.warning(f'Bad update POSTed to the router :: {err}')
+                    return self.reply(400)
+                try :
+                    connection = http.client.HTTPConnection('127.0.0.1',router.port + 1 + shard,timeout=router.timeout)
+                    connection.request('POST',router.path,body,{'Content-Type' : 'application/json'})
+                    response = connection.getresponse()
+                    response.read()
+                    connection.close()
+                except OSError as err:
+                    logging.error(f'Worker {shard} unreachable :: {err}')
+                    return self.reply(503,{'Retry-After' : '1'})
+                retry_after = response.getheader('Retry-After')
+                self.reply(response.status,{'Retry-After' : retry_after} if retry_after else None)
+
+            def reply(self,status,headers=None):
+                self.send_response(status)
+                for header, value in (headers or {}).items():
+                    self.send_header(header,value)
+                self.send_header('Content-Length','0')
+                self.end_headers()
+
+            def log_message(self,format,*args):
+                logging.debug(f'router :: {format % args}')
+
+        return RouterRequestHandler
+
+    def serve(self):
+        logging.info(f'Routing {self.httpd.server_address} {self.path} to {self.workers} workers')
+        self.httpd.serve_forever()
+
+
+
+
+"""
+
+function_name       :   util_run_cluster_child
+input               :   settings    ->  overrides the App of the cluster was created with
+                        shard       ->  number of the worker to run, None for the shared store
+                        workers     ->  number of workers in the cluster
+output              :   None, runs until terminated
+description         :   Entry point of the child processes of run_cluster, what python -m vaxonbot --shared-store and
+                        --worker <shard> [workers] run but with the cluster's settings instead of the defaults
+
+"""
+
+def util_run_cluster_child(settings,shard,workers):
+    from .app import create_app
+    from .instrumentation import util_setup_logging
+    app = create_app(**settings)
+    app.config.CLUSTER_WORKERS = workers
+    util_setup_logging(app.config.LOG_FILE)
+    if ( shard is None ):
+        run_shared_store(app.config.SHARED_STORE_ADDRESS,app.config.SHARED_STORE_AUTHKEY)
+    else :
+        app.run('webhook',shard)
+
+
+
+
+"""
+
+function_name       :   run_cluster
+input               :   app         ->  the App whose config the router is set up from
+                        workers     ->  number of bot workers to start, app.config.CLUSTER_WORKERS if None
+output              :   None
+description         :   Starts the shared store and the workers as child processes, each with an App created from the
+                        settings app was created with, and routes updates to them until interrupted
+                        Started with python -m vaxonbot --cluster [workers]
+
+"""
+
+def run_cluster(app,workers=None):
+    config = app.config
+    workers = config.CLUSTER_WORKERS if workers is None else workers
+    ## Spawned rather than forked so the children start without the threads and sockets of this process
+    context = multiprocessing.get_context('spawn')
+    children = [ context.Process(target=util_run_cluster_child,args=(app.settings,None,workers),name='shared-store') ]
+    children += [ context.Process(target=util_run_cluster_child,args=(app.settings,shard,workers),name=f'worker-{shard}') for shard in range(workers) ]
+    children[0].start()
+    time.sleep(1)
+    for child in children[1:]:
+        child.start()
+    router = UpdateRouter(workers,config.WEBHOOK_LISTEN,config.WEBHOOK_PORT,config.WEBHOOK_PATH,config.HTTP_TIMEOUT[1])
+    try :
+        router.serve()
+    except KeyboardInterrupt:
+        pass
+    finally :
+        router.httpd.server_close()
+        ## Workers first so they drain and flush, the store last
+        for child in reversed(children):
+            child.terminate()
+            child.join()
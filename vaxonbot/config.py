@@ -0,0 +1,143 @@
+"""
+
+Settings of the bot
+
+Every upper case name here is a default, create_app(**settings) takes overrides for any of them
+and the running bot reads them from app.config. Nothing in this module imports or loads anything
+
+"""
+
+# Bot token, XXXTOKEN
+TELEGRAM_TOKEN = 'XXXPASTE_YOUR_TOKEN_HEREXXX'
+
+# Setting up logging, see util_setup_logging
+LOG_FILE = 'app.log'
+
+# Port the Prometheus metrics are served on at /metrics, cluster workers use the ports after it
+METRICS_PORT = 9108
+
+# A json file containing the state and district details, available in the COWIN API listed under metadata API
+# It is compiled once to STATE_DIST_MAP_FILE + '.bin' which is what the bot actually loads, see util_load_metadata
+# It is fetched again from METADATA_API every METADATA_REFRESH_SECONDS, in a cluster by shard 0 only and the other
+# workers check every METADATA_RELOAD_SECONDS whether the file changed
+STATE_DIST_MAP_FILE = 'state-dist-map.json'
+METADATA_API = 'https://cdn-api.co-vin.in/api/v2/admin/location'
+CALENDAR_API = 'https://cdn-api.co-vin.in/api/v2/appointment/sessions/public'
+POSTAL_PINCODE_API = 'https://api.postalpincode.in/pincode'
+METADATA_REFRESH_SECONDS = 24 * 60 * 60
+METADATA_RELOAD_SECONDS = 10 * 60
+
+# Offline pincode index generated from the India Post pincode directory, maps valid pincodes to CoWIN district ids
+PINCODE_INDEX_FILE = 'pincode-dist-map.json'
+
+
+# SQLite file the conversation states and user data are kept in, and how often pending writes are flushed to it
+PERSISTENCE_FILE = 'vaxonbot.sqlite3'
+PERSISTENCE_FLUSH_SECONDS = 1
+
+# How updates are received, 'polling' or 'webhook'
+# In webhook mode updates are POSTed to http://WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH, WEBHOOK_URL is the public
+# https address Telegram is told to deliver to, when None the webhook is not registered so recorded updates can be POSTed locally
+BOT_MODE = 'polling'
+WEBHOOK_LISTEN = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = 'XXXPASTE_A_SECRET_PATH_HEREXXX'
+WEBHOOK_URL = None
+WEBHOOK_QUEUE_SIZE = 256
+WEBHOOK_WORKERS = 32
+TELEGRAM_BASE_URL = 'https://api.telegram.org/bot'
+
+# Multi worker mode, a router on WEBHOOK_PORT hands each chat's updates to one of CLUSTER_WORKERS webhook workers
+# listening on WEBHOOK_PORT+1..., the workers share the calendar cache and upstream budget through the shared store
+CLUSTER_WORKERS = 4
+SHARED_STORE_ADDRESS = ('127.0.0.1', 50000)
+SHARED_STORE_AUTHKEY = b'XXXPASTE_A_SECRET_KEY_HEREXXX'
+SHARED_STORE_LEASE_SECONDS = 15
+
+# Telegram limits, characters per message and messages per second in total and to a single chat
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 3
+
+# Every message to Telegram is kept in OUTBOUND_QUEUE_FILE until delivered and sent by OUTBOUND_WORKERS threads,
+# broadcasts and alerts never take the last OUTBOUND_INTERACTIVE_WORKERS of them nor more than OUTBOUND_BROADCAST_RATE
+# of the TELEGRAM_GLOBAL_RATE messages a second, so replies always get through. ADMIN_CHAT_IDS may use /broadcast
+OUTBOUND_QUEUE_FILE = 'vaxonbot-outbound.sqlite3'
+OUTBOUND_WORKERS = 8
+OUTBOUND_INTERACTIVE_WORKERS = 2
+OUTBOUND_BROADCAST_RATE = 20
+OUTBOUND_MAX_ATTEMPTS = 5
+ADMIN_CHAT_IDS = ()
+
+# Seconds between two polls of the districts that have subscribers, the min_age_limit values CoWIN uses that a
+# subscription may filter on, and how many subscriptions a chat may hold since every pincode target costs a call per poll
+SUBSCRIPTION_POLL_SECONDS = 300
+SUBSCRIPTION_MIN_AGES = (18, 45)
+SUBSCRIPTIONS_PER_CHAT = 5
+
+# Calendars fetched from CoWIN wait in a queue of FEED_QUEUE_SIZE to be diffed by the change feed,
+# which remembers the last fetch of at most FEED_MAX_KEYS calendars
+FEED_QUEUE_SIZE = 256
+FEED_MAX_KEYS = 1024
+
+# The session changes of every district are archived under ARCHIVE_DIR/<yyyymmdd>/<district_id>.bin,
+# /trends looks back TRENDS_DAYS days, times of day are shown in IST
+ARCHIVE_DIR = 'archive'
+TRENDS_DAYS = 14
+IST_OFFSET_SECONDS = 5 * 3600 + 30 * 60
+
+# Inline queries (@bot <name>, inline mode has to be switched on with BotFather) are answered with up to INLINE_RESULTS
+# states and districts, which Telegram may cache for INLINE_CACHE_SECONDS
+INLINE_RESULTS = 10
+INLINE_CACHE_SECONDS = 300
+
+# Enum for conversation states
+CHOOSE_QUERY_METHOD ,CHOOSE_STATE ,CHOOSE_PIN ,CHOOSE_DISTRICT, FINISH, HELP = range(6)
+
+# Enum for request type for the function create_http_request, BY_STATE queries are answered from the BY_DIST calendars
+BY_DIST , BY_PIN, BY_STATE = range(3)
+
+# Calendar response cache settings, seconds a response stays fresh and max number of (type, id, date) keys kept
+CACHE_TTL_SECONDS = 60
+CACHE_MAX_ENTRIES = 1024
+
+# How old a cached response may be and still be served when the upstream budget is used up
+CACHE_STALE_SECONDS = 30 * 60
+
+# Upstream HTTP settings, (connect, read) timeouts in seconds, retry count and backoff bounds for 429/5xx/network errors
+HTTP_TIMEOUT = (3.05, 10)
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_BASE = 0.5
+HTTP_BACKOFF_MAX = 8
+HTTP_POOL_SIZE = 16
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Calls per second and burst allowed to each upstream, CoWIN allows about 100 calls per 5 minutes per IP
+UPSTREAM_BUDGETS = { 'cowin' : (100 / 300, 20) }
+
+# Priorities of upstream calls, lower goes first, and how long each may wait for the budget before giving up (None waits forever)
+# With CLUSTER_WORKERS the budget is shared but priority only orders the calls within each worker
+PRIORITY_INTERACTIVE , PRIORITY_BACKGROUND = range(2)
+UPSTREAM_MAX_WAIT = { PRIORITY_INTERACTIVE : 5, PRIORITY_BACKGROUND : None }
+
+# Handlers run on the dispatcher's worker pool instead of one at a time on the update thread,
+# at most UPSTREAM_CONCURRENCY of them may be waiting on an upstream API at once
+ASYNC_HANDLERS = True
+DISPATCHER_WORKERS = 32
+UPSTREAM_CONCURRENCY = HTTP_POOL_SIZE
+
+# /bystate and /bydistrict id1,id2 fetch their districts on FANOUT_WORKERS threads shared by every user,
+# the answer is sent with the districts fetched within FANOUT_DEADLINE_SECONDS and lists at most AGGREGATE_MAX_CENTERS centers
+# A query fetches at most FANOUT_MAX_FETCHES districts that aren't cached so one large state can't take the whole CoWIN budget,
+# the others are reported as pending and a /repeat fetches the next ones
+FANOUT_WORKERS = UPSTREAM_CONCURRENCY
+FANOUT_DEADLINE_SECONDS = 8
+FANOUT_MAX_FETCHES = 10
+AGGREGATE_MAX_CENTERS = 25
+
+# Availability of the HOT_DISTRICTS is kept in memory by a background job every SNAPSHOT_REFRESH_SECONDS,
+# queries for them are answered from it while its data is younger than CACHE_TTL_SECONDS
+# Every hot district costs one CoWIN call per CACHE_TTL_SECONDS of the upstream budget
+HOT_DISTRICTS = (140, 265, 294, 363, 395, 571, 581, 725)
+SNAPSHOT_REFRESH_SECONDS = 30
@@ -0,0 +1,347 @@
+## Includes for Utils
+import logging
+import json
+import time
+import threading
+import os
+import queue
+import mmap
+import fcntl
+from array import array
+from collections import OrderedDict, namedtuple, defaultdict
+
+from .config import FEED_MAX_KEYS, FEED_QUEUE_SIZE, ARCHIVE_DIR, IST_OFFSET_SECONDS, BY_DIST
+from .calendars import CalendarCenter, CalendarSession
+from .instrumentation import metrics
+
+
+
+
+"""
+class_name          :   CalendarChange, CalendarDelta
+description         :   A CalendarChange is one difference between two fetches of the same calendar, kind is one of
+                        CENTER_ADDED, CENTER_REMOVED, SESSION_OPENED, SESSION_CLOSED, CAPACITY_CHANGED, center the CalendarCenter,
+                        before and after the CalendarSession in the previous and the current fetch (None if it wasn't in it
+                        and for center changes). A CalendarDelta holds the changes of one fetch, key is (req_type, req_details)
+"""
+
+CENTER_ADDED, CENTER_REMOVED, SESSION_OPENED, SESSION_CLOSED, CAPACITY_CHANGED = 'center_added', 'center_removed', 'session_opened', 'session_closed', 'capacity_changed'
+
+CalendarChange = namedtuple('CalendarChange', ['kind', 'center', 'before', 'after'])
+CalendarDelta = namedtuple('CalendarDelta', ['key', 'changes', 'fetched_at'])
+
+
+
+
+"""
+function_name       :   util_session_change
+input               :   before      ->  CalendarSession of the previous fetch, None if the session is new
+                        after       ->  CalendarSession of the current fetch
+output              :   SESSION_OPENED, SESSION_CLOSED, CAPACITY_CHANGED or None if nothing a user would see changed
+"""
+
+def util_session_change(before,after):
+    open_after = after.dose1 + after.dose2 > 0
+    if ( before is None or before.dose1 + before.dose2 <= 0 ):
+        return SESSION_OPENED if open_after else None
+    if ( not open_after ):
+        return SESSION_CLOSED
+    if ( before.dose1 != after.dose1 or before.dose2 != after.dose2 ):
+        return CAPACITY_CHANGED
+    return None
+
+
+
+
+"""
+function_name       :   util_opened_doses
+input               :   change      ->  a CalendarChange
+output              :   set of the doses (1, 2) that had no capacity before the change and have some after it
+"""
+
+def util_opened_doses(change):
+    if ( change.after is None ):
+        return set()
+    before = (change.before.dose1, change.before.dose2) if change.before is not None else (0, 0)
+    after = (change.after.dose1, change.after.dose2)
+    return { dose for dose in (1,2) if before[dose-1] <= 0 and after[dose-1] > 0 }
+
+
+
+
+"""
+class_name          :   ChangeFeed
+input               :   max_keys    ->  calendars whose last fetch is remembered, least recently fetched is forgotten first
+                        queue_size  ->  fetched calendars waiting to be diffed, more are dropped and counted in dropped
+description         :   Turns the calendars fetched from CoWIN into a stream of CalendarDelta
+                        fetch_calendar_upstream hands every response to observe, which only queues it. A worker thread diffs it
+                        against the last fetch of the same calendar, kept as dicts of CalendarCenter by center_id and
+                        CalendarSession by session_id, and passes deltas with changes to every subscribed callback
+                        A response identical to the last one is recognised by its hash without parsing it,
+                        so subscribers only ever do work proportional to what changed
+"""
+
+class ChangeFeed:
+    def __init__(self,max_keys=FEED_MAX_KEYS,queue_size=FEED_QUEUE_SIZE):
+        self.max_keys = max_keys
+        self.previous = OrderedDict()
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.worker = None
+        self.dropped = 0
+
+    def subscribe(self,callback):
+        ## callback(delta) is called on the feed thread, it should hand slow work off
+        with self.lock:
+            self.subscribers.append(callback)
+            if ( self.worker is None ):
+                self.worker = threading.Thread(target=self.run,name='change-feed',daemon=True)
+                self.worker.start()
+
+    def observe(self,key,content):
+        if ( not self.subscribers ):
+            return
+        try :
+            self.pending.put_nowait((key,content,time.time()))
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            key, content, fetched_at = self.pending.get()
+            try :
+                delta = self.diff(key,content,fetched_at)
+            except (ValueError, KeyError, TypeError) as err:
+                logging.error(f'Could not diff calendar {key} :: {err}')
+                continue
+            if ( delta is None or not delta.changes ):
+                continue
+            for callback in list(self.subscribers):
+                try :
+                    callback(delta)
+                except Exception as err:
+                    logging.error(f'Change feed subscriber {callback} failed :: {err}')
+
+    def diff(self,key,content,fetched_at=None):
+        ## Returns the CalendarDelta against the last fetch of key, None for the first fetch or an unchanged response
+        digest = hash(content)
+        previous = self.previous.get(key)
+        if ( previous is not None and previous[0] == digest ):
+            self.previous.move_to_end(key)
+            return None
+        resp_obj = json.loads(content)
+        previous_centers, previous_sessions = previous[1:] if previous is not None else ({}, {})
+        centers = {}
+        sessions = {}
+        changes = []
+        for center_json in resp_obj.get('centers',[]):
+            center = CalendarCenter.from_json(center_json)
+            centers[center.center_id] = center
+            if ( previous is not None and center.center_id not in previous_centers ):
+                changes.append(CalendarChange(CENTER_ADDED,center,None,None))
+            for session_json in center_json['sessions']:
+                session = CalendarSession.from_json(session_json)
+                sessions[session.session_id] = (center.center_id, session)
+                if ( previous is None ):
+                    continue
+                before = previous_sessions.get(session.session_id)
+                before = before[1] if before is not None else None
+                kind = util_session_change(before,session)
+                if ( kind is not None ):
+                    changes.append(CalendarChange(kind,center,before,session))
+        for session_id, (center_id, before) in previous_sessions.items():
+            if ( session_id not in sessions and before.dose1 + before.dose2 > 0 ):
+                changes.append(CalendarChange(SESSION_CLOSED,previous_centers[center_id],before,None))
+        for center_id, center in previous_centers.items():
+            if ( center_id not in centers ):
+                changes.append(CalendarChange(CENTER_REMOVED,center,None,None))
+
+        self.previous[key] = (digest, centers, sessions)
+        self.previous.move_to_end(key)
+        while ( len(self.previous) > self.max_keys ):
+            self.previous.popitem(last=False)
+        if ( previous is None ):
+            return None
+        return CalendarDelta(key,changes,fetched_at if fetched_at is not None else time.time())
+
+
+
+
+"""
+function_name       :   util_count_changes
+input               :   delta       ->  CalendarDelta from change_feed
+output              :   None
+description         :   Change feed subscriber counting the changes by kind for the metrics and logging a summary
+"""
+
+def util_count_changes(delta):
+    kinds = defaultdict(int)
+    for change in delta.changes:
+        kinds[change.kind] += 1
+    for kind, count in kinds.items():
+        metrics.inc('vaxonbot_calendar_changes_total',count,kind=kind)
+    logging.info(f'Calendar {delta.key} changed :: {dict(kinds)}')
+
+
+
+
+"""
+class_name          :   AvailabilityArchive
+input               :   root        ->  directory the partitions are written under
+description         :   Append only archive of the session changes change_feed finds in district calendars
+                        Partitioned by the IST day of the fetch and district, ARCHIVE_DIR/<yyyymmdd>/<district_id>.bin
+                        Each change is a fixed size record of COLUMNS unsigned 32 bit ints in native byte order,
+                        a partition is read by memory mapping it and viewing the ints as one array, column k of the records is
+                        then the strided slice [k::len(COLUMNS)] so aggregations walk a column without unpacking whole records
+                        added is the capacity the change made available, the total capacity when a session opens
+                        Cluster workers each diff their own fetches but append to the same partitions under a file lock, every
+                        change is applied to the last record of its session in the partition so none is archived twice
+"""
+
+class AvailabilityArchive:
+    COLUMNS = ('time', 'center_id', 'date', 'kind', 'min_age', 'dose1', 'dose2', 'added')
+    KINDS = (SESSION_OPENED, SESSION_CLOSED, CAPACITY_CHANGED)
+
+    def __init__(self,root=ARCHIVE_DIR):
+        self.root = root
+        self.lock = threading.Lock()
+        self.session_states = {}
+        self.read_offsets = {}
+
+    def partition(self,day,district_id):
+        return os.path.join(self.root,str(day),f'{district_id}.bin')
+
+    def append(self,delta):
+        ## Change feed subscriber, only district calendars are archived
+        if ( BY_DIST != delta.key[0] ):
+            return
+        fetched_at = int(delta.fetched_at)
+        changes = [ change for change in delta.changes if change.kind in self.KINDS ]
+        if ( not changes ):
+            return
+        path = self.partition(util_ist_day(fetched_at),delta.key[1])
+        with self.lock:
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+            with open(path,'a+b') as partition_file:
+                ## Cluster workers append to the same partitions, the lock makes reading what the others wrote and appending one step
+                fcntl.flock(partition_file.fileno(),fcntl.LOCK_EX)
+                sessions = self.sessions(path,partition_file)
+                records = array('I')
+                for change in changes:
+                    session = change.after or change.before
+                    day, month, year = session.date.split('-')
+                    key = (change.center.center_id, int(year + month + day), session.min_age)
+                    total = change.after.dose1 + change.after.dose2 if change.after is not None else 0
+                    ## Each worker diffs against its own previous fetch, so the change is applied to what the archive already
+                    ## holds for the session, an opening or capacity another worker archived first isn't counted again
+                    if ( key in sessions ):
+                        archived_at, was_open, before = sessions[key]
+                        if ( archived_at > fetched_at ):
+                            continue
+                    else :
+                        before = change.before.dose1 + change.before.dose2 if change.before is not None else 0
+                        was_open = before > 0
+                    is_open = total > 0
+                    if ( is_open and not was_open ):
+                        kind = SESSION_OPENED
+                    elif ( was_open and not is_open ):
+                        kind = SESSION_CLOSED
+                    elif ( is_open and total != before ):
+                        kind = CAPACITY_CHANGED
+                    else :
+                        continue
+                    records.extend((fetched_at, key[0], key[1], self.KINDS.index(kind), session.min_age,
+                                    session.dose1 if is_open else 0, session.dose2 if is_open else 0, max(0,total - before) if is_open else 0))
+                    sessions[key] = (fetched_at, is_open, total)
+                if ( records ):
+                    partition_file.write(records.tobytes())
+                    self.read_offsets[path] += len(records) * records.itemsize
+
+    def sessions(self,path,partition_file):
+        ## (fetch time, open, capacity) of the last record of each (center_id, date, min_age) in the partition, reading
+        ## only the records appended since the last call. Partitions of other days are forgotten
+        if ( path not in self.session_states ):
+            for other in [ other for other in self.session_states if os.path.dirname(other) != os.path.dirname(path) ]:
+                del self.session_states[other], self.read_offsets[other]
+            self.session_states[path] = {}
+            self.read_offsets[path] = 0
+        sessions = self.session_states[path]
+        width = len(self.COLUMNS)
+        partition_file.seek(self.read_offsets[path])
+        data = partition_file.read()
+        data = data[:len(data) - len(data) % (4 * width)]
+        self.read_offsets[path] += len(data)
+        records = array('I',data)
+        closed = self.KINDS.index(SESSION_CLOSED)
+        for start in range(0,len(records),width):
+            fetched_at, center_id, date, kind, min_age, dose1, dose2, _ = records[start:start + width]
+            sessions[(center_id, date, min_age)] = (fetched_at, kind != closed, dose1 + dose2)
+        return sessions
+
+    def columns(self,district_id,days):
+        ## Yields a dict of column name -> memoryview of the column for each partition of the district in days
+        width = len(self.COLUMNS)
+        for day in days:
+            path = self.partition(day,district_id)
+            try :
+                partition_file = open(path,'rb')
+            except FileNotFoundError:
+                continue
+            with partition_file:
+                size = os.fstat(partition_file.fileno()).st_size
+                ## A record cut short by a crash mid write is left out
+                size -= size % (4 * width)
+                if ( 0 == size ):
+                    continue
+                with mmap.mmap(partition_file.fileno(),0,access=mmap.ACCESS_READ) as mapped:
+                    ## The views must be released before the map is closed, callers can't keep them past their iteration
+                    raw = memoryview(mapped)
+                    view = raw[:size].cast('I')
+                    columns = { name : view[column::width] for column, name in enumerate(self.COLUMNS) }
+                    try :
+                        yield columns
+                    finally :
+                        for column in columns.values():
+                            column.release()
+                        view.release()
+                        raw.release()
+
+    def opening_times(self,district_id,days):
+        ## Seconds after IST midnight of every time a session opened
+        times = []
+        opened = self.KINDS.index(SESSION_OPENED)
+        for columns in self.columns(district_id,days):
+            times += [ (fetched_at + IST_OFFSET_SECONDS) % 86400 for fetched_at, kind in zip(columns['time'],columns['kind']) if kind == opened ]
+        return times
+
+    def capacity_added(self,district_id,days,min_age=None):
+        ## dict of day -> capacity made available that day
+        added = {}
+        for day in days:
+            total = 0
+            for columns in self.columns(district_id,[day]):
+                if ( min_age is None ):
+                    total += sum(columns['added'])
+                else :
+                    total += sum(capacity for capacity, age in zip(columns['added'],columns['min_age']) if age == min_age)
+            added[day] = total
+        return added
+
+
+
+
+"""
+function_name       :   util_ist_day, util_recent_days
+input               :   timestamp   ->  unix time
+                        count       ->  number of days
+output              :   the IST day of timestamp as yyyymmdd, the last count IST days as yyyymmdd oldest first
+"""
+
+def util_ist_day(timestamp):
+    return int(time.strftime('%Y%m%d',time.gmtime(timestamp + IST_OFFSET_SECONDS)))
+
+def util_recent_days(count,now=None):
+    now = time.time() if now is None else now
+    return [ util_ist_day(now - days * 86400) for days in range(count - 1,-1,-1) ]
+
@@ -0,0 +1,903 @@
+## Includes for Utils
+import logging
+import re
+import threading
+import functools
+from concurrent.futures import wait as wait_futures
+
+## Includes for Telegram API etc
+from telegram import (
+    ForceReply, ParseMode, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineQueryResultArticle, InputTextMessageContent,
+)
+from telegram.ext import ConversationHandler
+
+from .config import (
+    CHOOSE_QUERY_METHOD, CHOOSE_STATE, CHOOSE_PIN, CHOOSE_DISTRICT, FINISH, HELP, BY_DIST, BY_PIN, BY_STATE,
+)
+from .instrumentation import metrics, timed
+from .calendars import util_parse_calendar, util_render_center, util_pack_messages, util_rank_centers
+from .feed import util_recent_days
+from .upstream import send_http_request_with_age, util_calendar_cached
+from .pincodes import util_validate_pincode, util_calendar_by_pincode
+from .snapshot import util_snapshot_lookup
+from .subscriptions import Subscription
+from .outbound import util_reply
+
+logger = logging.getLogger(__name__)
+
+
+
+
+"""
+
+function_name       :   util_state_name
+input               :   state - conversation state returned by a handler
+output              :   name of the state for metric labels
+
+"""
+
+STATE_NAMES = {
+    CHOOSE_QUERY_METHOD : 'CHOOSE_QUERY_METHOD', CHOOSE_STATE : 'CHOOSE_STATE', CHOOSE_PIN : 'CHOOSE_PIN',
+    CHOOSE_DISTRICT : 'CHOOSE_DISTRICT', FINISH : 'FINISH', HELP : 'HELP', ConversationHandler.END : 'END',
+}
+
+def util_state_name(state):
+    return STATE_NAMES.get(state,str(state))
+
+
+
+
+"""
+
+function_name       :   conversation_step
+input               :   handler - conversation handler returning the next conversation state
+output              :   wrapped handler
+description         :   Decorator timing a conversation handler and counting the state it returns
+                        Handlers calling each other (find_calendar_bydistrict ending in cleanup) only count
+                        the transition of the outermost handler
+
+"""
+
+handler_depth = threading.local()
+
+def conversation_step(handler):
+    timed_handler = timed(handler)
+
+    @functools.wraps(handler)
+    def wrapper(update,cb_context):
+        depth = getattr(handler_depth,'value',0)
+        handler_depth.value = depth + 1
+        try :
+            new_state = timed_handler(update,cb_context)
+        finally :
+            handler_depth.value = depth
+        if ( 0 == depth ):
+            metrics.inc('vaxonbot_conversation_transitions_total',handler=handler.__name__,state=util_state_name(new_state))
+        return new_state
+    return wrapper
+
+
+
+
+"""
+
+function_name       :   util_app
+input               :   cb_context      ->  callback context of a handler
+output              :   the App the handler runs in, create_updater keeps it in bot_data
+
+"""
+
+def util_app(cb_context):
+    return cb_context.bot_data['app']
+
+
+
+
+"""
+function_name       :   util_notify_stale
+input               :   app         ->  the App the reply goes out through
+                        update      ->  Updater context of the message to reply to
+                        age         ->  seconds since the calendar about to be shown was fetched
+output              :   None
+description         :   Tells the user how old the calendar is when it is older than CACHE_TTL_SECONDS,
+                        which only happens when the CoWIN budget ran out and cached data is served
+"""
+
+def util_notify_stale(app,update,age):
+    if ( age > app.config.CACHE_TTL_SECONDS ):
+        util_reply(app,update,f'CoWIN is busy right now, these slots are from {int(age // 60)} minutes ago')
+
+
+
+
+"""
+function_name       :   print_calendar
+input               :   app         ->  the App the reply goes out through
+                        resp_obj    ->  The Response object obtained from querying the calendar of  COWIN-api by district or pincode in JSON 
+                        update      ->  Updater context of current message received to provide replies to
+output              :   number of Telegram API calls used for the reply
+Description         :   This function takes a JSON response object and updater context and then notifies user of the Calendars of centers with atleast one open slot 
+                        The available sessions of every center are rendered as a table and packed into as few messages as possible
+"""
+
+@timed
+def print_calendar(app,resp_obj,update):
+    return print_centers(app,util_parse_calendar(resp_obj),update)
+
+
+
+
+"""
+
+function_name       :   print_centers
+input               :   app         ->  the App the reply goes out through
+                        available   ->  list of (CalendarCenter, [CalendarSession]) as returned by util_parse_calendar
+                        update      ->  Updater context of current message received to provide replies to
+output              :   number of Telegram API calls used for the reply
+description         :   The rendering half of print_calendar, also used for answers from the availability snapshot
+
+"""
+
+@timed
+def print_centers(app,available,update):
+    ## Render every center that has at least one session with either dose1 or dose 2 available
+    blocks = [ util_render_center(center,available_sessions) for center, available_sessions in available ]
+
+    ## If not centers with atleast one session available notify no sessions available
+    if ( [] == blocks):
+        util_reply(app,update,"No available vaccines in the next 7 days",reply_markup=ReplyKeyboardRemove())
+        return 1
+
+    blocks += ["Trying booking with the Cowin app :: https://selfregistration.cowin.gov.in "]
+    messages = util_pack_messages(blocks)
+    for message in messages:
+        util_reply(app,update,message,reply_markup=ReplyKeyboardRemove())
+    logging.info(f'Calendar of {len(blocks)-1} centers sent to {update.effective_user.name} in {len(messages)} messages')
+    return len(messages)
+
+
+
+
+"""
+
+function_name       :   util_fetch_districts
+input               :   app             ->  the App the calendars are fetched for
+                        district_ids    ->  CoWIN district ids to fetch the calendars of
+                        deadline        ->  seconds to wait for the calendars, app.config.FANOUT_DEADLINE_SECONDS if None
+output              :   (dict of district id -> (util_parse_calendar result, age), list of district ids that didn't arrive in time or failed,
+                         list of district ids not fetched since the query already had FANOUT_MAX_FETCHES districts to fetch from CoWIN)
+description         :   Districts in the availability snapshot are answered from it, the other lookups are fanned out on app.fanout_pool
+                        where cached districts come back at once and only the others wait on CoWIN, at most FANOUT_WORKERS at a time
+                        Lookups not started by the deadline are cancelled so they don't spend the upstream budget,
+                        the ones already running still fill the cache for the next query
+
+"""
+
+def util_district_availability(app,district_id):
+    response, age = send_http_request_with_age(app,BY_DIST,district_id)
+    if ( response is None ):
+        return (None, 0)
+    return (util_parse_calendar(response.json()), age)
+
+def util_fetch_districts(app,district_ids,deadline=None):
+    snapshot = app.availability_snapshot
+    max_age = app.config.CACHE_TTL_SECONDS
+    calendars = { district_id : (snapshot.lookup(district_id), snapshot.age(district_id)) for district_id in district_ids if snapshot.has_district(district_id,max_age) }
+    uncached = [ district_id for district_id in district_ids if district_id not in calendars and not util_calendar_cached(app,BY_DIST,district_id) ]
+    not_fetched = uncached[app.config.FANOUT_MAX_FETCHES:]
+    futures = { app.fanout_pool.submit(util_district_availability,app,district_id) : district_id for district_id in district_ids
+                if district_id not in calendars and district_id not in not_fetched }
+    done, late = wait_futures(futures,timeout=app.config.FANOUT_DEADLINE_SECONDS if deadline is None else deadline)
+    for future in late:
+        future.cancel()
+    missing = [ futures[future] for future in late ]
+    for future in done:
+        available, age = future.result()
+        if ( available is None ):
+            missing.append(futures[future])
+        else :
+            calendars[futures[future]] = (available, age)
+    return (calendars, missing, not_fetched)
+
+
+
+
+"""
+
+function_name       :   print_aggregate_calendar
+input               :   app             ->  the App the query is answered by
+                        district_ids    ->  districts of the query
+                        update          ->  Updater context of current message received to provide replies to
+output              :   True if at least one district calendar was fetched
+description         :   Answers /bystate and /bydistrict with several ids, the open centers of every district ranked by
+                        util_rank_centers, at most AGGREGATE_MAX_CENTERS of them, and the districts that couldn't be checked
+
+"""
+
+@timed
+def print_aggregate_calendar(app,district_ids,update):
+    district_metadata = app.district_metadata
+    calendars, missing, pending = util_fetch_districts(app,district_ids)
+    if ( not calendars ):
+        return False
+    util_notify_stale(app,update,max(age for _, age in calendars.values()))
+    ranked = util_rank_centers(calendars)
+    max_centers = app.config.AGGREGATE_MAX_CENTERS
+    blocks = [f'{len(ranked)} centers with open slots in {len(calendars)} districts, earliest first']
+    for district_id, center, sessions in ranked[:max_centers]:
+        blocks += [f'{district_metadata.district_by_id.get(district_id,("",district_id))[1]} :: {util_render_center(center,sessions)}']
+    if ( len(ranked) > max_centers ):
+        blocks += [f'... and {len(ranked) - max_centers} more centers, query a single district to see all of them']
+    if ( missing ):
+        names = ', '.join(str(district_metadata.district_by_id.get(district_id,("",district_id))[1]) for district_id in missing)
+        blocks += [f'Could not check {names} right now, press -> /repeat in a minute']
+    if ( pending ):
+        blocks += [f'{len(pending)} more districts are not checked yet so CoWIN stays available to everyone, press -> /repeat for the next ones']
+    if ( ranked ):
+        blocks += ["Trying booking with the Cowin app :: https://selfregistration.cowin.gov.in "]
+    messages = util_pack_messages(blocks)
+    for message in messages:
+        util_reply(app,update,message,reply_markup=ReplyKeyboardRemove())
+    logging.info(f'Calendar of {len(ranked)} centers in {len(calendars)} districts sent to {update.effective_user.name}, {len(missing)} districts missing {len(pending)} pending')
+    return True
+
+
+
+
+"""
+
+function_name       :   util_offer_suggestions
+input               :   app             ->  the App the reply goes out through
+                        update          ->  Updater context of the message to reply to
+                        suggestions     ->  state names and district ids from DistrictMetadata.suggest
+output              :   True if there was anything to offer
+description         :   Asks the user to pick one of the suggestions from a one time keyboard, the labels
+                        resolve back to the same state or district when sent
+
+"""
+
+def util_offer_suggestions(app,update,suggestions):
+    if ( not suggestions ):
+        return False
+    labels = [ [ app.district_metadata.label(suggestion) ] for suggestion in suggestions ]
+    util_reply(app,update,'Did you mean one of these?',reply_markup=ReplyKeyboardMarkup(labels,one_time_keyboard=True))
+    return True
+
+
+
+
+################################################################### Command handlers
+
+"""
+function_name       :   start
+input               :   update          ->  the updater context for the current message 
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   ENUM(CHOOSE_QUERY_METHOD) -> taking bot to conversation state registered in ConversationHandler
+description         :   This function handles the /start command and starts a conversation
+                        Provides custom keyboard with two options to continue the conversation and returns STATE CHOOSE_QUERY_METHOD
+"""
+@conversation_step
+def start(update,cb_context):
+    """Send a message when the command /start is issued."""
+    app = util_app(cb_context)
+    query_options = [["District","PIN-code"]]
+    if ('last_query' in cb_context.user_data):
+        query_options += [["Repeat last search"]]
+    user = update.effective_user
+    logger.info(f'New Conversation started by :: {user.name}')
+    ## Send a welcome message
+    util_reply(app,update,fr'Hey there {user.mention_markdown_v2()}\!',parse_mode=ParseMode.MARKDOWN_V2)
+    ##  Take input on what parameter to query by
+    util_reply(app,update,"choose how you'd like to find your vaccine slots",reply_markup=ReplyKeyboardMarkup(query_options,one_time_keyboard=True))
+    return CHOOSE_QUERY_METHOD
+
+
+
+
+############################################ Conversation handlers bydistrict case
+
+
+
+
+"""
+function_name       :   choose_state
+input               :   update          ->  the updater context for the current message 
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   ENUM(CHOOSE_STATE) -> taking bot to conversation state registered in ConversationHandler
+description         :   Continues conversation from when user chooses to query by district
+                        Provides custom keyboard with states in alphabetical order to choose from 
+                        return STATE CHOOSE_STATE
+"""
+
+
+@conversation_step
+def choose_state(update,cb_context):
+    """Find the vaccination calendar for the next 7 days, query by district id"""
+    app = util_app(cb_context)
+
+    ## Set query_option in user_data
+    cb_context.user_data['query_option'] = BY_DIST
+    ## List out the states vertically for the user to choose from and go to next state CHOOSE_STATE
+    util_reply(app,update,"Great, you've chosen to find the vaccines by district")
+    util_reply(app,update,"Find your state in the list below...",reply_markup=app.district_metadata.state_keyboard)
+
+    return CHOOSE_STATE
+
+
+
+
+"""
+function_name       :   choose_district
+input               :   update          ->  the updater context for the current message 
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   ENUM(CHOOSE_DISTRICT) -> taking bot to conversation state registered in ConversationHandler
+description         :   Continues conversation from when user chooses State to query 
+                        Provides custom keyboard with districts in the chosen state in alphabetical order to choose from 
+                        return STATE CHOOSE_DISTRICT
+                        If a district is typed instead of a state the calendar is looked up straight away
+                        Typed names are matched fuzzily, when no state or district clearly matches the closest ones are offered
+"""
+
+@conversation_step
+def choose_district(update,cb_context):
+    app = util_app(cb_context)
+    district_metadata = app.district_metadata
+    chosen_state = district_metadata.resolve(update.message.text)
+    
+    ##  A district typed in place of the state skips the CHOOSE_DISTRICT step
+    if ( isinstance(chosen_state,int) ):
+        cb_context.user_data['chosen_state'] = district_metadata.district_by_id[chosen_state][0]
+        return find_calendar_bydistrict(update,cb_context)
+
+    ##  Check if the Input is valid
+    if ( chosen_state is not None ):
+
+        ## If valid store in to callback context for later use
+        logging.info(f'The user :: {update.effective_user} has chosen the valid state {chosen_state}')
+        cb_context.user_data['chosen_state'] = chosen_state
+        util_reply(app,update,f'The state you have chosen is :: {chosen_state}')
+
+        ## Print the prebuilt vertical list of the districts in that state and go to the next state CHOOSE_DISTRICT
+        util_reply(app,update,"Now find your district in the list below",reply_markup=district_metadata.district_keyboard(chosen_state))
+        return CHOOSE_DISTRICT
+    else :
+        ## If an invalid state was chosen, offer the closest states and districts, this only happens when user doesn't use the provided one time keyboard
+        logging.warning(f'The user :: {update.effective_user} has chosen an invalid state {update.message.text}')
+        if ( util_offer_suggestions(app,update,district_metadata.suggest(update.message.text)) ):
+            return CHOOSE_STATE
+        util_reply(app,update,"That option was not in our list, could you please choose from the drop down list below rather than typing :)")
+        return CHOOSE_STATE
+
+
+
+
+"""
+function_name       :   find_calendar_bydistrict
+input               :   update          ->  the updater context for the current message 
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   ENUM(CHOOSE_DISTRICT)           -> In case the user entered Invalid district redirect to start of this state
+                        ENUM(ConversationHandler.END)   -> In case valid user Input and response creation was okay, Cleanup and end the conversation
+description         :   Continues conversation from when user chooses District to query 
+                        Validates the choices made till now
+                        create HTTP request with details provided if valid response received notify user
+"""
+
+
+@conversation_step
+def find_calendar_bydistrict(update,cb_context):
+    app = util_app(cb_context)
+
+    ## Check if input is valid and use the district id to create request
+
+    if ('query_option' not in cb_context.user_data):
+        ## command /bydistrict case
+        if ([] != cb_context.args):
+            district_details = cb_context.args[0]
+            logging.info(f'command call to /bydistrict by {update.effective_user.name} using dist-id {cb_context.args[0]}')
+            ## Several ids separated by commas or spaces are answered together
+            district_ids = [ district_id for district_id in re.split(r'[,\s]+',' '.join(cb_context.args)) if district_id ]
+            if ( len(district_ids) > 1 and all(district_id.isdigit() for district_id in district_ids) ):
+                return util_aggregate_query(update,cb_context,district_ids,[BY_DIST, ','.join(district_ids)])
+            ## A district name works as well as its id
+            if ( not district_details.isdigit() ):
+                district_name = ' '.join(cb_context.args)
+                district_details = app.district_metadata.resolve_district(district_name)
+                if ( district_details is None ):
+                    suggestions = app.district_metadata.suggest(district_name,kind='district')
+                    lines = [ f'/bydistrict {district_id}  {app.district_metadata.label(district_id)}' for district_id in suggestions ]
+                    util_reply(app,update,'\n'.join(['Did you mean'] + lines) if lines else 'You might have missed out the district id :( ')
+                    return cleanup(update,cb_context)
+            cb_context.user_data['chosen_district'] = district_details
+        else:
+            util_reply(app,update,'You might have missed out the district id :( ')
+            return cleanup(update,cb_context)
+    else :
+        ## ConversationHandler case
+        ## Get the chosen_state name from the callback context and the chosen_district from the update text
+        chosen_state = cb_context.user_data['chosen_state']
+        chosen_district = update.message.text
+
+        ## Get the district details from district_metadata using chosen_state and chosen_district
+        district_details = app.district_metadata.resolve_district(chosen_district,chosen_state)
+        if ( district_details is not None ):
+            ## If valid store in to callback context for later use
+            chosen_district = app.district_metadata.district_by_id[district_details][1]
+            logging.info(f'The user :: {update.effective_user} has chosen the valid district {chosen_district}')
+            util_reply(app,update,f'The district you have chosen is :: {chosen_district}')
+            cb_context.user_data['chosen_district'] = district_details
+        else :
+            ## If an invalid district was chosen, offer the closest districts of the state, this only happens when user doesn't use the provided one time keyboard
+            logging.warning(f'The user :: {update.effective_user} has chosen an invalid district {chosen_district}')
+            if ( util_offer_suggestions(app,update,app.district_metadata.suggest(chosen_district,chosen_state)) ):
+                return CHOOSE_DISTRICT
+            util_reply(app,update,'''
+That option was not in our list :(
+1. Try typing the district
+2. Choose the dropdown and try again
+3. Press -> /cancel and restart conversation 
+''')
+            return CHOOSE_DISTRICT
+
+    ## Hot districts are answered from the availability snapshot without going to CoWIN
+    available = util_snapshot_lookup(app,district_id=district_details)
+    if ( available is not None ):
+        print_centers(app,available,update)
+        cb_context.user_data['last_query'] = [BY_DIST, district_details]
+        return cleanup(update,cb_context)
+
+    ## Create and send a http request to get a response with vaccine data
+    response, age = send_http_request_with_age(app,BY_DIST,district_details)
+    if response == None:
+        ## If response not received log and notify error and exit
+        if ('query_option' not in cb_context.user_data):
+            logging.error('Error in either dist id or http error')
+            util_reply(app,update,f'Entered district ID maybe wrong start the app with /start')
+        logging.error("Error in creating response")
+        util_reply(app,update,'''
+Something went wrong :( ....
+try again later''')
+        return cleanup(update,cb_context)
+    else :
+        ## If valid response received notify user
+        logging.info("Received response")
+        resp_obj = response.json()
+        util_notify_stale(app,update,age)
+        print_calendar(app,resp_obj,update)
+        cb_context.user_data['last_query'] = [BY_DIST, district_details]
+        return cleanup(update,cb_context)
+
+
+####################################### Conversation handlers PINCODE case   
+
+
+
+
+'''
+
+function_name       :   enter_pincode
+input               :   update          ->  the updater context for the current message 
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   ENUM(CHOOSE_PIN)           -> In case the user entered Invalid district redirect to start of this state
+description         :   Continues conversation after user chooses to query by pincode, gets the user_data
+'''
+
+
+@conversation_step
+def enter_pincode(update,cb_context):
+    """Find the vaccination calendar for the next 7 days, query by district id"""
+    app = util_app(cb_context)
+    cb_context.user_data['query_option'] = BY_PIN
+    util_reply(app,update,fr'Enter the PINCODE',reply_markup=ForceReply(selective=True))
+
+    return CHOOSE_PIN
+
+
+
+
+'''
+
+
+function_name       :   find_calendar_bypincode
+input               :   update          ->  the updater context for the current message 
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   ENUM(ConversationHandler.END)           -> End the conversation as the last step
+description         :   Continues conversation after user chooses PINCODE
+                        Validates the PINCODE provided creates http request and sends if valid
+                        if valid response object received notifies user
+
+
+'''
+
+
+@conversation_step
+def find_calendar_bypincode(update,cb_context):
+    app = util_app(cb_context)
+    if ('query_option' not in cb_context.user_data):
+        if ( [] != cb_context.args):
+            logging.info(f'command call to /bypincode by user :: {update.effective_user.name} with pincode :: {cb_context.args[0]}')
+            chosen_pincode = cb_context.args[0]
+        else :
+            util_reply(app,update,'You might have missed out the PINCODE  :( ')
+            util_reply(app,update,'Type done and try again')
+            return cleanup(update,cb_context)
+            
+    elif (BY_PIN == cb_context.user_data['query_option']):
+        chosen_pincode = update.message.text
+    if (util_validate_pincode(app,chosen_pincode)):
+        logging.info(f'The user :: {update.effective_user} has entered a valid pin')
+        util_reply(app,update,f"The Entered PIN :: {chosen_pincode} is valid")
+        cb_context.user_data['chosen_pincode'] = chosen_pincode
+        available = util_snapshot_lookup(app,pincode=chosen_pincode)
+        if ( available is not None ):
+            print_centers(app,available,update)
+            cb_context.user_data['last_query'] = [BY_PIN, chosen_pincode]
+            return cleanup(update,cb_context)
+        resp_obj, age = util_calendar_by_pincode(app,chosen_pincode)
+        if resp_obj == None:
+            logging.error("Error in creating response")
+            util_reply(app,update,f'Unable to get response try again later')
+            return cleanup(update,cb_context)
+        else:
+            logging.info("Received valid response")
+            util_notify_stale(app,update,age)
+            print_calendar(app,resp_obj,update)
+            cb_context.user_data['last_query'] = [BY_PIN, chosen_pincode]
+            return cleanup(update,cb_context)
+            
+
+    else:
+        logging.warning(f'The user :: {update.effective_user} has entered an invalid pin')
+        util_reply(app,update,"The Entered PIN is incorrect, try again with valid PINCODE ..",reply_markup=ForceReply(selective=True))
+        return CHOOSE_PIN
+
+
+####################################### Conversation handlers aggregate case
+
+
+
+
+"""
+
+function_name       :   util_aggregate_query
+input               :   update          ->  the updater context for the current message
+                        cb_context      ->  callback context to get access to args and outside context
+                        district_ids    ->  district ids to answer for
+                        last_query      ->  the query stored for /repeat when it succeeds
+output              :   ENUM(ConversationHandler.END)           -> End the conversation as the last step
+description         :   Shared end of /bystate and /bydistrict with several ids
+
+"""
+
+def util_aggregate_query(update,cb_context,district_ids,last_query):
+    app = util_app(cb_context)
+    district_ids = [ int(district_id) for district_id in district_ids if str(district_id).isdigit() ]
+    if ( not district_ids ):
+        util_reply(app,update,'You might have missed out the district ids :( ')
+        return cleanup(update,cb_context)
+    if ( not print_aggregate_calendar(app,district_ids,update) ):
+        logging.error(f'No calendar of districts {district_ids} could be fetched')
+        util_reply(app,update,'''
+Something went wrong :( ....
+try again later''')
+        return cleanup(update,cb_context)
+    cb_context.user_data['last_query'] = last_query
+    return cleanup(update,cb_context)
+
+
+
+
+"""
+
+function_name       :   find_calendar_bystate
+input               :   update          ->  the updater context for the current message 
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   ENUM(ConversationHandler.END)           -> End the conversation as the last step
+description         :   Handles /bystate <state>, the open centers of every district of the state ranked by date and capacity
+
+"""
+
+@conversation_step
+def find_calendar_bystate(update,cb_context):
+    app = util_app(cb_context)
+    district_metadata = app.district_metadata
+    chosen_state = district_metadata.resolve_state(' '.join(cb_context.args or []))
+    if ( chosen_state is None ):
+        logging.warning(f'The user :: {update.effective_user} asked /bystate for an unknown state {cb_context.args}')
+        util_reply(app,update,'Usage :: /bystate <state name>, for example /bystate Kerala')
+        return cleanup(update,cb_context)
+    logging.info(f'command call to /bystate by {update.effective_user.name} for {chosen_state}')
+    district_ids = list(district_metadata.state_dist_map[chosen_state]['districts'].values())
+    return util_aggregate_query(update,cb_context,district_ids,[BY_STATE, chosen_state])
+
+
+
+
+"""
+
+function_name       :   show_trends
+input               :   update          ->  the updater context for the current message 
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   ENUM(ConversationHandler.END)           -> End the conversation as the last step
+description         :   Handles /trends <district-id|district name>, from the last TRENDS_DAYS days of app.availability_archive
+                        the median time of day slots opened at and the capacity made available every day
+
+"""
+
+@conversation_step
+def show_trends(update,cb_context):
+    app = util_app(cb_context)
+    district_id = app.district_metadata.resolve_district(' '.join(cb_context.args or []))
+    if ( district_id is None ):
+        util_reply(app,update,'Usage :: /trends <district-id|district name>, for example /trends 307')
+        return cleanup(update,cb_context)
+    district = app.district_metadata.district_by_id[district_id][1]
+    trends_days = app.config.TRENDS_DAYS
+    days = util_recent_days(trends_days)
+    opening_times = sorted(app.availability_archive.opening_times(district_id,days))
+    if ( not opening_times ):
+        util_reply(app,update,f'No slots have been seen opening in {district} in the last {trends_days} days yet')
+        return cleanup(update,cb_context)
+    median = opening_times[len(opening_times) // 2]
+    lines = [f'{district} over the last {trends_days} days',
+             f'Slots usually open around {median // 3600:02d}:{median % 3600 // 60:02d} IST (median of {len(opening_times)} openings)',
+             '',
+             'Capacity made available per day']
+    added = app.availability_archive.capacity_added(district_id,days)
+    peak = max(added.values()) or 1
+    for day, capacity in added.items():
+        lines += [f'{str(day)[6:]}-{str(day)[4:6]}  {"#" * round(capacity * 20 / peak):<20} {capacity}']
+    util_reply(app,update,'\n'.join(lines))
+    logging.info(f'Trends of {district} sent to {update.effective_user.name}')
+    return cleanup(update,cb_context)
+
+
+
+
+"""
+
+function_name       :   repeat_last_query
+input               :   update          ->  the updater context for the current message 
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   ENUM(ConversationHandler.END)           -> End the conversation as the last step
+description         :   Handles /repeat and the Repeat last search button, runs the last successful search of the user
+                        again as if /bydistrict, /bypincode or /bystate had been typed with the same district ids, PINCODE or state
+
+"""
+
+@conversation_step
+def repeat_last_query(update,cb_context):
+    app = util_app(cb_context)
+    if ('last_query' not in cb_context.user_data):
+        util_reply(app,update,'There is no earlier search to repeat, press -> /start to search')
+        return cleanup(update,cb_context)
+    query_option, query_details = cb_context.user_data['last_query']
+    logging.info(f'User :: {update.effective_user.name} repeated query {query_option} {query_details}')
+    if ('query_option' in cb_context.user_data):
+        del cb_context.user_data['query_option']
+    cb_context.args = [ str(query_details) ]
+    if (BY_DIST == query_option):
+        return find_calendar_bydistrict(update,cb_context)
+    if (BY_STATE == query_option):
+        return find_calendar_bystate(update,cb_context)
+    return find_calendar_bypincode(update,cb_context)
+
+
+
+
+"""
+
+function_name       :   subscribe
+input               :   update          ->  the updater context for the current message 
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   ENUM(ConversationHandler.END)           -> End the conversation as the last step
+description         :   Handles /subscribe <district-id|pincode> [min_age] [dose]
+                        Registers the chat for alerts whenever a matching slot opens up, min_age has to be one of the
+                        SUBSCRIPTION_MIN_AGES since it is matched against the session's min_age_limit exactly
+                        A chat holds at most SUBSCRIPTIONS_PER_CHAT subscriptions
+
+"""
+
+@conversation_step
+def subscribe(update,cb_context):
+    app = util_app(cb_context)
+    args = cb_context.args or []
+    if ( [] == args or not args[0].isdigit() or not all(arg.isdigit() for arg in args[1:3]) ):
+        util_reply(app,update,'Usage :: /subscribe <district-id|pincode> [min_age] [dose]')
+        return cleanup(update,cb_context)
+    min_age = int(args[1]) if len(args) > 1 else None
+    dose = int(args[2]) if len(args) > 2 else None
+    if ( min_age not in (None,) + tuple(app.config.SUBSCRIPTION_MIN_AGES) ):
+        util_reply(app,update,f'The min_age can only be {" or ".join(map(str,app.config.SUBSCRIPTION_MIN_AGES))}\n'
+                              'Usage :: /subscribe <district-id|pincode> [min_age] [dose]')
+        return cleanup(update,cb_context)
+    if ( dose not in (None,1,2) ):
+        util_reply(app,update,'The dose can only be 1 or 2')
+        return cleanup(update,cb_context)
+
+    if ( len(args[0]) == 6 ):
+        pincode = args[0]
+        if ( not util_validate_pincode(app,pincode) ):
+            util_reply(app,update,'The Entered PIN is incorrect, try again with valid PINCODE ..')
+            return cleanup(update,cb_context)
+        district_id = app.pincode_index.lookup(pincode)[1]
+        target = (BY_DIST, str(district_id)) if district_id is not None else (BY_PIN, pincode)
+    else :
+        pincode = None
+        district_id = int(args[0])
+        if ( district_id not in app.district_metadata.district_by_id ):
+            util_reply(app,update,'Entered district ID maybe wrong start the app with /start')
+            return cleanup(update,cb_context)
+        target = (BY_DIST, str(district_id))
+
+    if ( not app.subscription_registry.add(target,Subscription(update.effective_chat.id,pincode,min_age,dose),app.config.SUBSCRIPTIONS_PER_CHAT) ):
+        util_reply(app,update,f'You already have {app.config.SUBSCRIPTIONS_PER_CHAT} subscriptions, use /unsubscribe to remove them first')
+        return cleanup(update,cb_context)
+    logging.info(f'User :: {update.effective_user.name} subscribed to {target} min_age {min_age} dose {dose}')
+    util_reply(app,update,f'Subscribed to {args[0]}, you will get a message when new slots open up\nUse /unsubscribe to stop the alerts')
+    return cleanup(update,cb_context)
+
+
+
+
+"""
+
+function_name       :   unsubscribe
+input               :   update          ->  the updater context for the current message 
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   ENUM(ConversationHandler.END)           -> End the conversation as the last step
+description         :   Handles /unsubscribe, removes every subscription of the chat
+
+"""
+
+@conversation_step
+def unsubscribe(update,cb_context):
+    app = util_app(cb_context)
+    removed = app.subscription_registry.remove_chat(update.effective_chat.id)
+    logging.info(f'User :: {update.effective_user.name} removed {removed} subscriptions')
+    util_reply(app,update,f'Removed {removed} subscriptions')
+    return cleanup(update,cb_context)
+
+
+
+
+"""
+
+function_name       :   broadcast
+input               :   update          ->  the updater context for the current message
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   None
+description         :   Handles /broadcast <message> from the chats in ADMIN_CHAT_IDS, queues the message in the broadcast lane
+                        of app.outbound to every chat the bot knows, the users it keeps data for (user and chat ids
+                        are the same in private chats) and the subscribed chats. Not part of the conversation
+
+"""
+
+@timed
+def broadcast(update,cb_context):
+    app = util_app(cb_context)
+    if ( update.effective_chat.id not in app.config.ADMIN_CHAT_IDS ):
+        logging.warning(f'User :: {update.effective_user.name} tried to /broadcast without being an admin')
+        return
+    text = update.message.text.partition(' ')[2].strip()
+    if ( not text ):
+        util_reply(app,update,'Usage :: /broadcast <message>')
+        return
+    chat_ids = set(cb_context.dispatcher.user_data)
+    for subscriptions in app.subscription_registry.targets().values():
+        chat_ids.update(subscription.chat_id for subscription in subscriptions)
+    queued = app.outbound.broadcast(sorted(chat_ids),text)
+    logging.info(f'User :: {update.effective_user.name} broadcast a message to {queued} chats')
+    util_reply(app,update,f'Queued the message to {queued} chats')
+
+
+
+
+"""
+
+function_name       :   inline_search
+input               :   update          ->  the updater context for the inline query
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   None
+description         :   Autocompletes states and districts as they are typed after @bot, picking a district sends
+                        /bydistrict <id> and a state /bystate <state> so the calendar is one step away
+                        The answer goes straight to Telegram rather than through app.outbound, an inline query isn't a
+                        chat message and Telegram gives up on it within seconds
+
+"""
+
+@timed
+def inline_search(update,cb_context):
+    app = util_app(cb_context)
+    district_metadata = app.district_metadata
+    results = []
+    for target in district_metadata.suggest(update.inline_query.query,limit=app.config.INLINE_RESULTS):
+        if ( isinstance(target,int) ):
+            state, district = district_metadata.district_by_id[target]
+            results.append(InlineQueryResultArticle(id=f'district-{target}',title=district,description=f'{state}, district id {target}',
+                                                    input_message_content=InputTextMessageContent(f'/bydistrict {target}')))
+        else :
+            results.append(InlineQueryResultArticle(id=f'state-{district_metadata.state_dist_map[target]["state_id"]}',title=target,
+                                                    description='Every district of the state',
+                                                    input_message_content=InputTextMessageContent(f'/bystate {target}')))
+    update.inline_query.answer(results,cache_time=app.config.INLINE_CACHE_SECONDS)
+
+
+
+
+'''
+
+
+function_name       :   cleanup
+input               :   update          ->  the updater context for the current message 
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   ENUM(ConversationHandler.END)           -> End the conversation as the last step
+description         :   Last step in any conversation
+                        Cleanup the user context
+                        Provide usage information
+                        Ends conversation and takes state back to entry_point
+
+
+'''
+
+
+######################################### Miscellanous callback functions
+
+
+def cleanup(update,cb_context):
+    """Cleanup and provide command for how to repeat the search straight away"""
+    app = util_app(cb_context)
+    ### Thank you message
+    util_reply(app,update,"Hope this bot helped you") 
+
+    ### Message on how to replicate query without going through conversation
+    if ('chosen_district' in cb_context.user_data or 'chosen_pincode' in cb_context.user_data) and ('last_query' in cb_context.user_data):
+        util_reply(app,update,'press -> /repeat to run this search again')
+    util_reply(app,update,'''
+press -> /start to start conversation 
+press -> /cancel between query to force stop
+press -> /about for more info about the bot''')
+    if ([] != cb_context.args):
+        cb_context.args = []
+
+    ### Cleanup this conversation and end it
+    if ('chosen_district' in  cb_context.user_data):
+        del cb_context.user_data['chosen_district']
+    if ('chosen_state' in  cb_context.user_data):
+        del cb_context.user_data['chosen_state']
+    if ('chosen_pincode' in  cb_context.user_data):
+        del cb_context.user_data['chosen_pincode']
+    if ('query_option' in  cb_context.user_data):
+        del cb_context.user_data['query_option']
+    ### The last successful search is kept for /repeat
+    last_query = cb_context.user_data.get('last_query')
+    cb_context.user_data.clear()
+    if (last_query is not None):
+        cb_context.user_data['last_query'] = last_query
+    logging.info(f'Finished cleanup for {update.effective_user.name}')
+
+    return ConversationHandler.END
+    
+    
+"""
+
+function_name       :   about
+input               :   update          ->  the updater context for the current message 
+                        cb_context      ->  callback context to get access to args and outside context
+output              :   ENUM(ConversationHandler.END)           -> End the conversation as the last step
+description         :   This function provides the user with info about the bot
+
+"""
+
+def about(update,cb_context):
+    app = util_app(cb_context)
+    logging.info(f'User :: {update.effective_user.name} used /about')
+    util_reply(app,update,'''
+This bot was built using the python-telegram-bot  
+Using data from from COWIN/API-Setu
+
+Here\'s the free API on https://apisetu.gov.in/public/api/cowin''')
+    util_reply(app,update,'''
+Check out the source code on ::
+ https://github.com/arv-sajeev
+''') 
+    return cleanup()
@@ -0,0 +1,290 @@
+## Includes for Utils
+import logging
+import json
+import time
+import threading
+import queue
+import atexit
+import functools
+import copy
+from bisect import bisect_left
+from collections import defaultdict, deque
+from logging.handlers import QueueHandler, QueueListener
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .config import LOG_FILE, METRICS_PORT
+
+
+
+
+"""
+
+class_name          :   JsonLogFormatter
+description         :   Formats log records as one JSON object per line
+
+"""
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self,record):
+        entry = {
+            'time'      : self.formatTime(record),
+            'level'     : record.levelname,
+            'logger'    : record.name,
+            'thread'    : record.threadName,
+            'message'   : record.getMessage(),
+        }
+        if ( record.exc_info ):
+            entry['exception'] = self.formatException(record.exc_info)
+        elif ( record.exc_text ):
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+
+
+"""
+
+class_name          :   LogQueueHandler
+description         :   QueueHandler that keeps the traceback of a record, formatted into exc_text before it is queued
+                        since QueueHandler.prepare merges it into the message and drops exc_info
+
+"""
+
+class LogQueueHandler(QueueHandler):
+    def prepare(self,record):
+        record = copy.copy(record)
+        if ( record.exc_info ):
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+
+
+"""
+
+function_name       :   util_setup_logging
+input               :   path - file the log is written to
+output              :   the QueueListener writing the log
+description         :   Handlers only put records on a queue, a listener thread formats them as JSON and writes them
+                        to the file so logging never waits on disk I/O in a handler
+                        Called by main, importing the package leaves logging alone
+
+"""
+
+def util_setup_logging(path=LOG_FILE):
+    log_queue = queue.SimpleQueue()
+    file_handler = logging.FileHandler(path)
+    file_handler.setFormatter(JsonLogFormatter())
+    listener = QueueListener(log_queue,file_handler,respect_handler_level=True)
+    queue_handler = LogQueueHandler(log_queue)
+    logging.basicConfig(handlers=[queue_handler],level=logging.INFO)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+
+
+"""
+
+class_name          :   Metrics
+description         :   Counters and histograms rendered in the Prometheus text format
+                        Metrics are identified by name and a tuple of (label, value) pairs,
+                        collectors are functions called at render time that return extra (name, labels, value) samples
+
+"""
+
+class Metrics:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.collectors = []
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def describe(self,name,kind,text):
+        self.help[name] = (kind, text)
+
+    def inc(self,name,amount=1,**labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self,name,value,**labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if ( histogram is None ):
+                histogram = self.histograms[key] = {'buckets' : [0] * len(self.BUCKETS), 'sum' : 0.0, 'count' : 0}
+            bucket = bisect_left(self.BUCKETS,value)
+            if ( bucket < len(self.BUCKETS) ):
+                histogram['buckets'][bucket] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def add_collector(self,collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = { key : dict(value,buckets=list(value['buckets'])) for key, value in self.histograms.items() }
+        gauges = []
+        for collector in self.collectors:
+            try :
+                gauges += collector()
+            except Exception as err:
+                logging.error(f'Metrics collector {collector.__name__} failed :: {err}')
+
+        lines = []
+        described = set()
+        def header(name,default_kind):
+            if ( name not in described ):
+                described.add(name)
+                kind, text = self.help.get(name,(default_kind,name))
+                lines.extend([f'# HELP {name} {text}', f'# TYPE {name} {kind}'])
+        def label_text(labels):
+            return '{' + ','.join(f'{label}="{value}"' for label, value in labels) + '}' if labels else ''
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name,'counter')
+            lines.append(f'{name}{label_text(labels)} {value}')
+        for name, labels, value in gauges:
+            header(name,'gauge')
+            lines.append(f'{name}{label_text(tuple(sorted(labels.items())))} {value}')
+        for (name, labels), histogram in sorted(histograms.items()):
+            header(name,'histogram')
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS,histogram['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{label_text(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_bucket{label_text(labels + (("le", "+Inf"),))} {histogram["count"]}')
+            lines.append(f'{name}_sum{label_text(labels)} {histogram["sum"]}')
+            lines.append(f'{name}_count{label_text(labels)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('vaxonbot_handler_seconds','histogram','Time spent in each handler')
+metrics.describe('vaxonbot_conversation_transitions_total','counter','Conversation state each handler moved to')
+metrics.describe('vaxonbot_upstream_seconds','histogram','Latency of upstream API calls by endpoint')
+metrics.describe('vaxonbot_upstream_requests_total','counter','Upstream API calls by endpoint and HTTP status')
+metrics.describe('vaxonbot_telegram_requests_total','counter','Bot API calls by method and result')
+metrics.describe('vaxonbot_calendar_changes_total','counter','Changes between successive fetches of a calendar by kind')
+metrics.describe('vaxonbot_upstream_budget_wait_seconds','summary','Time upstream calls waited for the budget over the most recent calls')
+metrics.describe('vaxonbot_webhook_latency_seconds','summary','Time from a webhook update being accepted to its handler returning over the most recent updates')
+metrics.describe('vaxonbot_webhook_queued','gauge','Webhook updates accepted and waiting for a worker')
+
+
+
+
+"""
+
+function_name       :   timed
+input               :   func - function to time
+output              :   wrapped func
+description         :   Decorator recording the time func takes in vaxonbot_handler_seconds
+
+"""
+
+def timed(func):
+    @functools.wraps(func)
+    def wrapper(*args,**kwargs):
+        started = time.perf_counter()
+        try :
+            return func(*args,**kwargs)
+        finally :
+            metrics.observe('vaxonbot_handler_seconds',time.perf_counter() - started,handler=func.__name__)
+    return wrapper
+
+
+
+
+"""
+
+function_name       :   util_endpoint_name
+input               :   req_url - url of an upstream call
+output              :   endpoint label for the url, the last path segment that isn't an id
+description         :   Keeps ids and pincodes out of metric labels
+
+"""
+
+def util_endpoint_name(req_url):
+    segments = [ segment for segment in urlsplit(req_url).path.split('/') if segment and not segment.isdigit() ]
+    return f'{urlsplit(req_url).hostname}/{segments[-1] if segments else ""}'
+
+
+
+
+"""
+
+class_name          :   MetricsServer
+input               :   port    ->  port to serve /metrics on
+description         :   Serves metrics.render() to Prometheus
+
+"""
+
+class MetricsServer:
+    def __init__(self,port=METRICS_PORT,listen='0.0.0.0'):
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if ( self.path != '/metrics' ):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type','text/plain; version=0.0.4')
+                self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self,format,*args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((listen,port),MetricsRequestHandler)
+        self.httpd.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever,name='metrics-server',daemon=True).start()
+        logging.info(f'Metrics on {self.httpd.server_address}/metrics')
+
+
+
+
+"""
+
+class_name      :  LatencyRecorder
+input           :  window          ->   number of most recent samples kept per upstream
+description     :  Keeps a sliding window of request latencies per upstream host and reports percentiles over it
+
+"""
+
+class LatencyRecorder:
+    def __init__(self,window=1024):
+        self.window = window
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self,upstream,seconds):
+        with self.lock:
+            if ( upstream not in self.samples ):
+                self.samples[upstream] = deque(maxlen=self.window)
+            self.samples[upstream].append(seconds)
+
+    def percentiles(self,points=(50,90,99)):
+        with self.lock:
+            snapshot = { upstream : sorted(samples) for upstream, samples in self.samples.items() }
+        report = {}
+        for upstream, samples in snapshot.items():
+            if ( [] == samples ):
+                continue
+            report[upstream] = { f'p{point}' : samples[min(len(samples)-1,len(samples)*point//100)] for point in points }
+            report[upstream]['count'] = len(samples)
+        return report
+
@@ -0,0 +1,455 @@
+## Includes for Utils
+import logging
+import json
+import marshal
+import os
+import re
+import zlib
+
+from .config import STATE_DIST_MAP_FILE, PRIORITY_BACKGROUND
+
+# Bumped whenever the layout of the compiled metadata changes, older files are then recompiled
+METADATA_FORMAT = 2
+
+# Other names states and districts are known by, mostly their older or newer official names -> the name used in
+# state_dist_map. Aliases of names that aren't in state_dist_map are left out
+NAME_ALIASES = {
+    'Cuddapah' : 'YSR District, Kadapa (Cuddapah)', 'Kadapa' : 'YSR District, Kadapa (Cuddapah)',
+    'Nellore' : 'Sri Potti Sriramulu Nellore', 'Vizag' : 'Visakhapatnam',
+    'Bengaluru' : 'Bangalore Urban', 'Bengaluru Urban' : 'Bangalore Urban', 'Bengaluru Rural' : 'Bangalore Rural',
+    'Belagavi' : 'Belgaum', 'Ballari' : 'Bellary', 'Kalaburagi' : 'Gulbarga', 'Mysuru' : 'Mysore', 'Shivamogga' : 'Shimoga',
+    'Tumakuru' : 'Tumkur', 'Chikkamagaluru' : 'Chikamagalur', 'Bagalkote' : 'Bagalkot', 'Uttara Kannada' : 'Uttar Kannada',
+    'Mangalore' : 'Dakshina Kannada', 'Mangaluru' : 'Dakshina Kannada',
+    'Trivandrum' : 'Thiruvananthapuram', 'Calicut' : 'Kozhikode', 'Cochin' : 'Ernakulam', 'Kochi' : 'Ernakulam',
+    'Alleppey' : 'Alappuzha', 'Quilon' : 'Kollam', 'Trichur' : 'Thrissur', 'Palghat' : 'Palakkad', 'Cannanore' : 'Kannur',
+    'Madras' : 'Chennai', 'Tuticorin' : 'Thoothukudi (Tuticorin)', 'Trichy' : 'Tiruchirappalli', 'Ooty' : 'Nilgiris',
+    'Villupuram' : 'Viluppuram', 'Kanniyakumari' : 'Kanyakumari', 'Pondicherry' : 'Puducherry',
+    'Bombay' : 'Mumbai', 'Poona' : 'Pune', 'Baroda' : 'Vadodara', 'Calcutta' : 'Kolkata', 'Hooghly' : 'Hoogly',
+    'Gurugram' : 'Gurgaon', 'Mewat' : 'Nuh', 'Noida' : 'Gautam Buddha Nagar', 'Allahabad' : 'Prayagraj',
+    'Faizabad' : 'Ayodhya', 'Sant Ravidas Nagar' : 'Bhadohi', 'Bijnor' : 'Bijnour', 'Kabirdham' : 'Kawardha',
+    'Khordha' : 'Khurda', 'Baleshwar' : 'Balasore', 'Keonjhar' : 'Kendujhar', 'Bolangir' : 'Balangir', 'Sonepur' : 'Subarnapur',
+    'Orissa' : 'Odisha', 'Uttaranchal' : 'Uttarakhand',
+}
+
+# A fuzzy match is taken without asking when it scores at least MATCH_SCORE and MATCH_MARGIN more than the next candidate,
+# otherwise the candidates scoring at least SUGGEST_SCORE are offered
+MATCH_SCORE = 0.6
+MATCH_MARGIN = 0.1
+SUGGEST_SCORE = 0.3
+
+
+
+
+"""
+
+class_name          :   DistrictMetadata
+input               :   state_dist_map  ->  dict of state name -> {'state_id', 'districts' : {district name -> district id}}
+                        indexes         ->  (state_by_name, district_by_id, district_ids_by_name, trigram entries, trigram postings)
+                                            as built by util_index_metadata, built from state_dist_map when not given
+description         :   Everything derived from the state and district list. The indexes are built from the json only when
+                        state-dist-map.bin is missing or out of date with it or NAME_ALIASES (util_load_metadata) and on a metadata refresh,
+                        and then compiled into state-dist-map.bin, every other start loads them ready made from that file
+                        District ids map back to (state, district) and normalized names and NAME_ALIASES map to ids
+                        so that typed names can be matched without the exact spelling and case
+                        Names that don't match exactly are looked up in a TrigramIndex, a candidate is a state name
+                        or a district id and resolve_* only take one when it clearly beats the others (util_best_match)
+                        The state keyboard and the district keyboard of each state are built on first use and kept,
+                        which is also when telegram is first needed
+
+"""
+
+class DistrictMetadata:
+    def __init__(self,state_dist_map,indexes=None):
+        self.state_dist_map = state_dist_map
+        self.state_by_name, self.district_by_id, self.district_ids_by_name, entries, postings = indexes or util_index_metadata(state_dist_map)
+        self.name_index = TrigramIndex(entries,postings)
+        self.keyboards = {}
+        ## util_metadata_source_key of the file the list was loaded from or written to, for reload_metadata
+        self.source_key = None
+
+    def keyboard(self,key,options):
+        keyboard = self.keyboards.get(key)
+        if ( keyboard is None ):
+            from telegram import ReplyKeyboardMarkup
+            keyboard = self.keyboards[key] = ReplyKeyboardMarkup([ [ option ] for option in options ],one_time_keyboard=True)
+        return keyboard
+
+    @property
+    def state_keyboard(self):
+        return self.keyboard(None,self.state_dist_map)
+
+    def district_keyboard(self,state):
+        return self.keyboard(state,self.state_dist_map[state]['districts'])
+
+    def resolve_state(self,text,fuzzy=True):
+        ## Returns the state name as in state_dist_map or None
+        state = self.state_by_name.get(util_normalize_name(text))
+        if ( state is None and fuzzy ):
+            state = util_best_match(self.search(text,kind='state',limit=2))
+        return state
+
+    def resolve_district(self,text,state=None,fuzzy=True):
+        ## Returns the district id for a typed name or id, within state if given, None if unknown or ambiguous
+        text = text.strip()
+        if ( text.isdigit() ):
+            district_id = int(text)
+            if ( district_id in self.district_by_id and state in (None, self.district_by_id[district_id][0]) ):
+                return district_id
+            return None
+        district_ids = self.district_ids_by_name.get(util_normalize_name(text),[])
+        if ( state is not None ):
+            district_ids = [ district_id for district_id in district_ids if self.district_by_id[district_id][0] == state ]
+        if ( len(district_ids) == 1 ):
+            return district_ids[0]
+        if ( not district_ids and fuzzy ):
+            return util_best_match(self.search(text,state,'district',limit=2))
+        return None
+
+    def resolve(self,text):
+        ## A state or a district typed at the state prompt, returns the state name or the district id, None if neither is clear
+        state = self.resolve_state(text,fuzzy=False)
+        if ( state is not None ):
+            return state
+        district_id = self.resolve_district(text,fuzzy=False)
+        if ( district_id is not None ):
+            return district_id
+        return util_best_match(self.search(text,limit=2))
+
+    def search(self,text,state=None,kind=None,limit=5):
+        ## Ranked [(score, state name or district id)] for a typed name, kind 'state' or 'district' to only get those,
+        ## only the districts of state if given
+        if ( state is not None ):
+            accept = lambda target : isinstance(target,int) and self.district_by_id[target][0] == state
+        elif ( 'state' == kind ):
+            accept = lambda target : isinstance(target,str)
+        elif ( 'district' == kind ):
+            accept = lambda target : isinstance(target,int)
+        else :
+            accept = None
+        return self.name_index.search(text,accept,limit)
+
+    def suggest(self,text,state=None,kind=None,limit=5):
+        ## The candidates worth offering when a typed name didn't resolve, best first and no two with the same label
+        suggestions = {}
+        for score, target in self.search(text,state,kind,limit):
+            if ( score >= SUGGEST_SCORE ):
+                suggestions.setdefault(self.label(target),target)
+        return list(suggestions.values())
+
+    def label(self,target):
+        ## Text a candidate is offered as, a district sharing its name with another one is followed by its state
+        ## which util_index_metadata also indexes, so the label resolves back to the same district
+        if ( isinstance(target,str) ):
+            return target
+        state, district = self.district_by_id[target]
+        if ( len(self.district_ids_by_name.get(util_normalize_name(district),[])) > 1 ):
+            return f'{district} ({state})'
+        return district
+
+
+
+
+"""
+
+function_name       :   util_index_metadata
+input               :   state_dist_map  ->  dict of state name -> {'state_id', 'districts' : {district name -> district id}}
+output              :   (state_by_name, district_by_id, district_ids_by_name, trigram entries, trigram postings) indexes of DistrictMetadata
+description         :   Districts are indexed by name and by name followed by state, the way DistrictMetadata.label
+                        tells apart districts of the same name. NAME_ALIASES are indexed like the names they stand for
+
+"""
+
+def util_index_metadata(state_dist_map):
+    state_by_name = {}
+    district_by_id = {}
+    district_ids_by_name = {}
+    named = []
+    for state, state_details in state_dist_map.items():
+        state_by_name[util_normalize_name(state)] = state
+        named.append((state, state))
+        for district, district_id in state_details['districts'].items():
+            district_by_id[district_id] = (state, district)
+            district_ids_by_name.setdefault(util_normalize_name(district),[]).append(district_id)
+            district_ids_by_name.setdefault(util_normalize_name(f'{district} {state}'),[]).append(district_id)
+            named.append((district, district_id))
+
+    targets_by_name = {}
+    for name, target in named:
+        targets_by_name.setdefault(name,[]).append(target)
+    for alias, name in NAME_ALIASES.items():
+        for target in targets_by_name.get(name,[]):
+            if ( isinstance(target,str) ):
+                state_by_name.setdefault(util_normalize_name(alias),target)
+            else :
+                district_ids_by_name.setdefault(util_normalize_name(alias),[]).append(target)
+            named.append((alias, target))
+    entries, postings = util_index_trigrams(named)
+    return (state_by_name, district_by_id, district_ids_by_name, entries, postings)
+
+
+
+
+"""
+
+function_name       :   util_normalize_name
+input               :   name - a state or district name
+output              :   the name lower cased with runs of punctuation and spaces turned into single spaces
+description         :   Key used for matching typed state and district names
+
+"""
+
+def util_normalize_name(name):
+    return re.sub(r'[^a-z0-9]+',' ',name.lower()).strip()
+
+
+
+
+"""
+
+function_name       :   util_trigrams
+input               :   name - a normalized name
+output              :   set of the three letter substrings of name padded with two spaces in front and one behind,
+                        the padding gives the start of a name trigrams of its own so short prefixes still match
+
+"""
+
+def util_trigrams(name):
+    padded = f'  {name} '
+    return { padded[start:start+3] for start in range(len(padded) - 2) }
+
+
+
+
+"""
+
+function_name       :   util_index_trigrams
+input               :   named - list of (name, target) where the target is what a match on name stands for
+output              :   (entries, postings) of a TrigramIndex, entries is a list of (normalized name, number of trigrams, target)
+                        and postings maps every trigram to the tuple of positions of the entries containing it
+description         :   Only lists, tuples, dicts, strings and ints so util_compile_metadata can marshal it along with the rest
+
+"""
+
+def util_index_trigrams(named):
+    entries = []
+    postings = {}
+    for name, target in named:
+        name = util_normalize_name(name)
+        trigrams = util_trigrams(name)
+        for trigram in trigrams:
+            postings.setdefault(trigram,[]).append(len(entries))
+        entries.append((name, len(trigrams), target))
+    return entries, { trigram : tuple(positions) for trigram, positions in postings.items() }
+
+
+
+
+"""
+
+class_name          :   TrigramIndex
+input               :   entries     ->  list of (normalized name, number of trigrams, target) built by util_index_trigrams
+                        postings    ->  trigram -> positions of the entries containing it
+description         :   Fuzzy name search, a typed name is scored against every entry sharing a trigram with it by the
+                        Dice coefficient of their trigram sets, so a letter typed wrong or left out only costs the few
+                        trigrams around it. A name the text is a prefix of, or has a word starting with the text,
+                        scores at least 0.5 and more the more of the name was typed, so partial names rank well too
+                        search only touches the postings of the text's trigrams, a lookup takes around 150 microseconds and a few
+                        hundred at p99 with the full CoWIN list (benchmarks/bench_search.py)
+
+"""
+
+class TrigramIndex:
+    def __init__(self,entries,postings):
+        self.entries = entries
+        self.postings = postings
+
+    def search(self,text,accept=None,limit=5):
+        ## Returns up to limit [(score, target)] best first, each target once, accept filters the targets
+        query = util_normalize_name(text)
+        if ( '' == query ):
+            return []
+        trigrams = util_trigrams(query)
+        shared = {}
+        for trigram in trigrams:
+            for position in self.postings.get(trigram,()):
+                shared[position] = shared.get(position,0) + 1
+        best = {}
+        for position, count in shared.items():
+            name, size, target = self.entries[position]
+            if ( accept is not None and not accept(target) ):
+                continue
+            score = 2 * count / (len(trigrams) + size)
+            if ( name.startswith(query) or f' {query}' in name ):
+                score = max(score,0.5 + 0.5 * len(query) / len(name))
+            if ( score > best.get(target,0) ):
+                best[target] = score
+        ranked = sorted(best.items(),key=lambda candidate : (-candidate[1], str(candidate[0])))[:limit]
+        return [ (score, target) for target, score in ranked ]
+
+
+
+
+"""
+
+function_name       :   util_best_match
+input               :   candidates - ranked [(score, target)] from a search
+output              :   the first target if it scores at least MATCH_SCORE and by MATCH_MARGIN more than the second, otherwise None
+
+"""
+
+def util_best_match(candidates):
+    if ( candidates and candidates[0][0] >= MATCH_SCORE and (len(candidates) == 1 or candidates[0][0] - candidates[1][0] >= MATCH_MARGIN) ):
+        return candidates[0][1]
+    return None
+
+
+
+
+"""
+
+function_name       :   util_compiled_metadata_path, util_metadata_source_key
+input               :   path - location of the state and district json
+output              :   where the compiled form of path is kept, the key that tells whether it was compiled from path as it is now
+description         :   Like a .pyc the compiled file records the size and modification time of the json it was built from
+                        along with METADATA_FORMAT, a checksum of NAME_ALIASES and the marshal version, and is rebuilt when any of them differ
+
+"""
+
+def util_compiled_metadata_path(path):
+    return os.path.splitext(path)[0] + '.bin'
+
+def util_metadata_source_key(path):
+    source = os.stat(path)
+    aliases = zlib.crc32(repr(sorted(NAME_ALIASES.items())).encode())
+    return (METADATA_FORMAT, aliases, marshal.version, source.st_size, source.st_mtime_ns)
+
+
+
+
+"""
+
+function_name       :   util_compile_metadata
+input               :   metadata    ->  DistrictMetadata to compile
+                        path        ->  location of the json it was read from
+output              :   None
+description         :   Writes the state and district list with its lookup indexes in marshal format next to the json,
+                        loading it is a single marshal.loads with nothing left to parse or index
+                        The file is written aside and renamed into place so workers starting together never read half of it
+
+"""
+
+def util_compile_metadata(metadata,path=STATE_DIST_MAP_FILE):
+    compiled_path = util_compiled_metadata_path(path)
+    compiled = (util_metadata_source_key(path), metadata.state_dist_map, metadata.state_by_name, metadata.district_by_id,
+                metadata.district_ids_by_name, metadata.name_index.entries, metadata.name_index.postings)
+    try :
+        with open(f'{compiled_path}.{os.getpid()}','wb') as compiled_file:
+            compiled_file.write(marshal.dumps(compiled))
+        os.replace(f'{compiled_path}.{os.getpid()}',compiled_path)
+    except OSError as err:
+        logging.warning(f'Could not write compiled metadata {compiled_path} :: {err}')
+
+
+
+
+"""
+
+function_name       :   util_load_metadata
+input               :   path - location of the state and district json
+output              :   DistrictMetadata built from the file
+description         :   Loads the compiled form of the state and district list when it is up to date with the json,
+                        otherwise reads the json, closing the file once read, and compiles it for the next start
+
+"""
+
+def util_load_metadata(path=STATE_DIST_MAP_FILE):
+    source_key = util_metadata_source_key(path)
+    try :
+        with open(util_compiled_metadata_path(path),'rb') as compiled_file:
+            ## marshal.load reads a file object a few bytes at a time, one read and loads is several times faster
+            compiled = marshal.loads(compiled_file.read())
+        if ( compiled[0] == source_key ):
+            metadata = DistrictMetadata(compiled[1],compiled[2:])
+            metadata.source_key = source_key
+            return metadata
+    except (OSError, EOFError, ValueError, TypeError, IndexError):
+        pass
+    with open(path) as json_file:
+        metadata = DistrictMetadata(json.load(json_file))
+    util_compile_metadata(metadata,path)
+    metadata.source_key = source_key
+    return metadata
+
+
+
+
+"""
+
+function_name       :   refresh_metadata
+input               :   cb_context  ->  callback context of the repeating job, its context is the App
+output              :   None
+description         :   Fetches the states and their districts from the CoWIN metadata API and swaps in a new
+                        app.district_metadata, handlers read it on each call so they pick it up without a restart
+                        The fetched list is also written to STATE_DIST_MAP_FILE and compiled for the next start, both are
+                        written aside and renamed into place so a crash mid write never leaves a truncated file
+                        The calls wait for upstream budget behind user queries, when none is left the current list is kept
+                        Only one process runs this job, cluster workers other than shard 0 pick the file up with reload_metadata
+
+"""
+
+def refresh_metadata(cb_context):
+    from .upstream import http_get, RequestException, UpstreamBudgetExhausted
+    app = cb_context.job.context
+    metadata_api = app.config.METADATA_API
+    try :
+        state_dist_map = {}
+        states = http_get(app,f'{metadata_api}/states','cowin',PRIORITY_BACKGROUND).json()['states']
+        for state in sorted(states,key=lambda state : state['state_name']):
+            districts = http_get(app,f'{metadata_api}/districts/{state["state_id"]}','cowin',PRIORITY_BACKGROUND).json()['districts']
+            state_dist_map[state['state_name']] = {
+                'state_id'  : state['state_id'],
+                'districts' : { district['district_name'] : district['district_id'] for district in sorted(districts,key=lambda district : district['district_name']) },
+            }
+    except (RequestException, UpstreamBudgetExhausted, ValueError, KeyError) as err:
+        logging.error(f'Could not refresh metadata, keeping the current list :: {err}')
+        return
+    if ( {} == state_dist_map ):
+        logging.error('Metadata API returned no states, keeping the current list')
+        return
+    district_metadata = DistrictMetadata(state_dist_map)
+    path = app.config.STATE_DIST_MAP_FILE
+    try :
+        with open(f'{path}.{os.getpid()}','w') as json_file:
+            json.dump(state_dist_map,json_file,indent=4)
+        os.replace(f'{path}.{os.getpid()}',path)
+        util_compile_metadata(district_metadata,path)
+        district_metadata.source_key = util_metadata_source_key(path)
+    except OSError as err:
+        logging.warning(f'Could not write metadata {path}, serving the refreshed list from memory only :: {err}')
+    app.district_metadata = district_metadata
+    logging.info(f'Refreshed metadata, {len(state_dist_map)} states {len(district_metadata.district_by_id)} districts')
+
+
+
+
+"""
+
+function_name       :   reload_metadata
+input               :   cb_context  ->  callback context of the repeating job, its context is the App
+output              :   None
+description         :   Run by the cluster workers that don't refresh the metadata themselves, loads STATE_DIST_MAP_FILE
+                        again once refresh_metadata of shard 0 has replaced it
+
+"""
+
+def reload_metadata(cb_context):
+    app = cb_context.job.context
+    path = app.config.STATE_DIST_MAP_FILE
+    try :
+        if ( util_metadata_source_key(path) == app.district_metadata.source_key ):
+            return
+        app.district_metadata = district_metadata = util_load_metadata(path)
+    except (OSError, ValueError) as err:
+        logging.error(f'Could not reload metadata, keeping the current list :: {err}')
+        return
+    logging.info(f'Reloaded metadata, {len(district_metadata.state_dist_map)} states {len(district_metadata.district_by_id)} districts')
@@ -0,0 +1,395 @@
+## Includes for Utils
+import logging
+import json
+import time
+import threading
+import sqlite3
+import heapq
+import itertools
+from collections import OrderedDict, deque
+
+## Includes for Telegram API etc
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from .config import (
+    OUTBOUND_QUEUE_FILE, OUTBOUND_WORKERS, OUTBOUND_INTERACTIVE_WORKERS, OUTBOUND_BROADCAST_RATE, OUTBOUND_MAX_ATTEMPTS,
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, PERSISTENCE_FLUSH_SECONDS, HTTP_BACKOFF_BASE,
+    HTTP_BACKOFF_MAX, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND,
+)
+from .instrumentation import metrics
+from .upstream import TokenBucket
+
+LANE_NAMES = { PRIORITY_INTERACTIVE : 'interactive', PRIORITY_BACKGROUND : 'broadcast' }
+
+metrics.describe('vaxonbot_outbound_messages_total','counter','Outbound messages by lane and what became of each send')
+metrics.describe('vaxonbot_outbound_lag_seconds','histogram','Time from a message being queued to it being delivered by lane')
+
+
+
+
+"""
+
+class_name          :   OutboundMessage
+description         :   One queued Bot API call, method is the Bot method called with chat_id and kwargs
+                        enqueued is wall clock time so the lag of messages loaded after a restart is still right
+
+"""
+
+class OutboundMessage:
+    __slots__ = ('message_id', 'priority', 'chat_id', 'method', 'kwargs', 'enqueued', 'attempts')
+
+    def __init__(self,message_id,priority,chat_id,method,kwargs,enqueued,attempts=0):
+        self.message_id = message_id
+        self.priority = priority
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.enqueued = enqueued
+        self.attempts = attempts
+
+
+
+
+"""
+
+class_name          :   OutboundQueue
+input               :   path            ->  SQLite database file the queue is kept in
+                        workers         ->  threads sending to Telegram
+                        interactive_workers, global_rate, chat_rate, chat_burst, broadcast_rate, max_attempts, flush_seconds,
+                        backoff_base, backoff_max   ->  the OUTBOUND_, TELEGRAM_ and HTTP_BACKOFF_ settings named below, App passes its config
+flow                :   send / broadcast -> SQLite -> lane of the chat -> worker -> Bot API
+description         :   Every message the bot sends goes through here, handler replies in the PRIORITY_INTERACTIVE lane
+                        and alerts and broadcasts in the PRIORITY_BACKGROUND lane
+                        send only queues the message in memory, the flush thread writes it to SQLite as soon as it is free
+                        in one transaction with every other message queued meanwhile, so handlers never wait on SQLite
+                        Messages are removed once delivered (removals are batched every PERSISTENCE_FLUSH_SECONDS), whatever
+                        was pending is loaded again on the next start so a restart loses nothing, a crash loses at most the
+                        messages of the transaction being written and a message delivered just before a crash may go out twice
+                        Workers take the oldest message of the next chat in line, interactive lane first, once the chat's
+                        bucket (TELEGRAM_CHAT_RATE) and the global bucket (TELEGRAM_GLOBAL_RATE) both have a token
+                        A chat has one send in flight at a time so its messages arrive in order
+                        Broadcasts also need a token of their own bucket (OUTBOUND_BROADCAST_RATE) and never hold the last
+                        OUTBOUND_INTERACTIVE_WORKERS workers, so replies are never stuck behind a broadcast
+                        A 429 pauses the chat for its retry_after and the broadcast lane with it, network errors are retried
+                        with backoff up to OUTBOUND_MAX_ATTEMPTS times, anything else Telegram refuses is dropped
+                        Nothing is sent until start is given the bot
+
+"""
+
+class OutboundQueue:
+    MAX_IDLE_CHATS = 10000
+    RATE_WINDOW = 10
+
+    def __init__(self,path=OUTBOUND_QUEUE_FILE,workers=OUTBOUND_WORKERS,interactive_workers=OUTBOUND_INTERACTIVE_WORKERS,
+                 global_rate=TELEGRAM_GLOBAL_RATE,chat_rate=TELEGRAM_CHAT_RATE,chat_burst=TELEGRAM_CHAT_BURST,
+                 broadcast_rate=OUTBOUND_BROADCAST_RATE,max_attempts=OUTBOUND_MAX_ATTEMPTS,flush_seconds=PERSISTENCE_FLUSH_SECONDS,
+                 backoff_base=HTTP_BACKOFF_BASE,backoff_max=HTTP_BACKOFF_MAX):
+        self.path = path
+        self.workers = workers
+        self.interactive_workers = interactive_workers
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.flush_seconds = flush_seconds
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.bot = None
+        self.threads = []
+        self.stopping = False
+        ## No bursts overall, a full bucket on top of the rate would let twice the limit out in a second
+        self.global_bucket = TokenBucket(global_rate,1)
+        self.broadcast_bucket = TokenBucket(broadcast_rate,1)
+        self.chat_buckets = OrderedDict()
+        self.store = None
+
+        self.condition = threading.Condition()
+        self.pending = { priority : {} for priority in LANE_NAMES }     # lane -> chat id -> deque of messages
+        self.ready = { priority : deque() for priority in LANE_NAMES }  # lane -> chats whose next message may go now
+        self.scheduled = set()                                          # (lane, chat id) in ready or delayed
+        self.delayed = []                                               # heap of (monotonic time, sequence, lane, chat id)
+        self.paused = {}                                                # chat id -> monotonic time it may send again after a 429
+        self.broadcasts_paused = 0
+        self.busy = set()
+        self.in_flight = { priority : 0 for priority in LANE_NAMES }
+        self.chat_counts = {}
+        self.delivered_times = deque()
+        self.sequence = itertools.count()
+
+        self.db = sqlite3.connect(path,check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS outbound (message_id INTEGER PRIMARY KEY, priority INTEGER NOT NULL, chat_id INTEGER NOT NULL, '
+                        'method TEXT NOT NULL, kwargs TEXT NOT NULL, enqueued REAL NOT NULL)')
+        self.db.commit()
+        self.db_lock = threading.Lock()
+        self.new_rows = []
+        self.done_ids = []
+
+        rows = self.db.execute('SELECT message_id, priority, chat_id, method, kwargs, enqueued FROM outbound ORDER BY message_id').fetchall()
+        self.message_ids = itertools.count(rows[-1][0] + 1 if rows else 1)
+        with self.condition:
+            for message_id, priority, chat_id, method, kwargs, enqueued in rows:
+                self.push(OutboundMessage(message_id,priority,chat_id,method,json.loads(kwargs),enqueued))
+        if ( rows ):
+            logging.info(f'Loaded {len(rows)} pending outbound messages from {path}')
+
+    def use_store(self,store_for_thread):
+        ## Takes the global tokens from a shared store so every cluster worker together stays under TELEGRAM_GLOBAL_RATE
+        self.store = store_for_thread
+
+    def start(self,bot):
+        with self.condition:
+            self.bot = bot
+            if ( self.threads ):
+                return
+            self.threads = [ threading.Thread(target=self.deliver_loop,name=f'outbound-{n}',daemon=True) for n in range(self.workers) ]
+            self.threads.append(threading.Thread(target=self.flush_loop,name='outbound-flush',daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def send(self,chat_id,text,priority=PRIORITY_INTERACTIVE,**kwargs):
+        ## Queues bot.send_message(chat_id, text, **kwargs), returns the id of the queued message
+        return self.enqueue(priority,[chat_id],'send_message',dict(kwargs,text=text))[0]
+
+    def broadcast(self,chat_ids,text,priority=PRIORITY_BACKGROUND,**kwargs):
+        ## Queues the same message to every chat in one write, returns the number queued
+        return len(self.enqueue(priority,chat_ids,'send_message',dict(kwargs,text=text)))
+
+    def enqueue(self,priority,chat_ids,method,kwargs):
+        ## Reply markups are stored as the JSON the Bot API takes, which the Bot passes through as it is
+        kwargs = { name : value.to_json() if hasattr(value,'to_json') else value for name, value in kwargs.items() }
+        encoded = json.dumps(kwargs)
+        enqueued = time.time()
+        with self.condition:
+            messages = [ OutboundMessage(next(self.message_ids),priority,chat_id,method,kwargs,enqueued) for chat_id in chat_ids ]
+            self.new_rows += [ (message.message_id, priority, message.chat_id, method, encoded, enqueued) for message in messages ]
+            for message in messages:
+                self.push(message)
+            self.condition.notify_all()
+        return [ message.message_id for message in messages ]
+
+    def push(self,message,first=False):
+        chat_queue = self.pending[message.priority].setdefault(message.chat_id,deque())
+        if ( first ):
+            chat_queue.appendleft(message)
+        else :
+            chat_queue.append(message)
+            self.chat_counts[message.chat_id] = self.chat_counts.get(message.chat_id,0) + 1
+        self.schedule(message.priority,message.chat_id)
+
+    def schedule(self,priority,chat_id,not_before=0):
+        ## Puts a chat with messages pending in the lane in line, unless it already is or has a send in flight
+        if ( (priority, chat_id) in self.scheduled or chat_id in self.busy or chat_id not in self.pending[priority] ):
+            return
+        self.scheduled.add((priority, chat_id))
+        if ( not_before > time.monotonic() ):
+            heapq.heappush(self.delayed,(not_before, next(self.sequence), priority, chat_id))
+        else :
+            self.ready[priority].append(chat_id)
+
+    def chat_bucket(self,chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if ( bucket is None ):
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate,self.chat_burst)
+            while ( len(self.chat_buckets) > self.MAX_IDLE_CHATS ):
+                self.chat_buckets.popitem(last=False)
+        self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def take_global(self):
+        if ( self.store is not None ):
+            return self.store().take_token('telegram',self.global_rate,1)
+        return self.global_bucket.try_acquire()
+
+    def take(self):
+        ## Called holding the condition, returns (message, None) or (None, seconds until one may be ready or None)
+        now = time.monotonic()
+        while ( self.delayed and self.delayed[0][0] <= now ):
+            _, _, priority, chat_id = heapq.heappop(self.delayed)
+            self.ready[priority].append(chat_id)
+        waits = [ self.delayed[0][0] - now ] if self.delayed else []
+
+        for priority in sorted(LANE_NAMES):
+            ready = self.ready[priority]
+            if ( not ready ):
+                continue
+            lane_bucket = None
+            if ( PRIORITY_INTERACTIVE != priority ):
+                if ( self.in_flight[priority] >= self.workers - self.interactive_workers ):
+                    continue
+                if ( self.broadcasts_paused > now ):
+                    waits.append(self.broadcasts_paused - now)
+                    continue
+                lane_bucket = self.broadcast_bucket
+            for _ in range(len(ready)):
+                chat_id = ready.popleft()
+                if ( chat_id in self.busy ):
+                    self.scheduled.discard((priority, chat_id))
+                    continue
+                if ( self.paused.get(chat_id,0) > now ):
+                    heapq.heappush(self.delayed,(self.paused[chat_id], next(self.sequence), priority, chat_id))
+                    waits.append(self.paused[chat_id] - now)
+                    continue
+                chat_bucket = self.chat_bucket(chat_id)
+                wait = chat_bucket.try_acquire()
+                if ( wait > 0 ):
+                    heapq.heappush(self.delayed,(now + wait, next(self.sequence), priority, chat_id))
+                    waits.append(wait)
+                    continue
+                ## The chat may send, the lane and global tokens are only taken now so none are wasted on chats that can't
+                wait = lane_bucket.try_acquire() if lane_bucket is not None else 0
+                if ( wait <= 0 ):
+                    wait = self.take_global()
+                    if ( wait > 0 and lane_bucket is not None ):
+                        lane_bucket.refund()
+                if ( wait > 0 ):
+                    chat_bucket.refund()
+                    ready.appendleft(chat_id)
+                    waits.append(wait)
+                    break
+                self.scheduled.discard((priority, chat_id))
+                chat_queue = self.pending[priority][chat_id]
+                message = chat_queue.popleft()
+                if ( not chat_queue ):
+                    del self.pending[priority][chat_id]
+                self.busy.add(chat_id)
+                self.in_flight[priority] += 1
+                return message, None
+        return None, (min(waits) if waits else None)
+
+    def deliver_loop(self):
+        while True:
+            with self.condition:
+                message = None
+                while ( message is None ):
+                    if ( self.stopping ):
+                        return
+                    message, wait = self.take()
+                    if ( message is None ):
+                        self.condition.wait(wait)
+            self.deliver(message)
+
+    def deliver(self,message):
+        lane = LANE_NAMES[message.priority]
+        retry_at = None
+        try :
+            getattr(self.bot,message.method)(chat_id=message.chat_id,**message.kwargs)
+            result = 'delivered'
+        except RetryAfter as err:
+            ## Telegram said when to try again, that doesn't count as a failed attempt
+            result = 'retry_after'
+            retry_at = time.monotonic() + err.retry_after
+        except BadRequest as err:
+            result = 'failed'
+            logging.error(f'Telegram refused {message.method} to {message.chat_id} :: {err}')
+        except NetworkError as err:
+            message.attempts += 1
+            result = 'retry' if message.attempts < self.max_attempts else 'failed'
+            if ( 'retry' == result ):
+                retry_at = time.monotonic() + min(self.backoff_max,self.backoff_base * (2 ** message.attempts))
+            else :
+                logging.error(f'Gave up on {message.method} to {message.chat_id} after {message.attempts} attempts :: {err}')
+        except TelegramError as err:
+            ## Blocked by the user, chat gone and the like, trying again won't help
+            result = 'failed'
+            logging.warning(f'Could not send {message.method} to {message.chat_id} :: {err}')
+        except Exception as err:
+            result = 'failed'
+            logging.exception(f'Sending {message.method} to {message.chat_id} failed :: {err}')
+        metrics.inc('vaxonbot_outbound_messages_total',lane=lane,result=result)
+        if ( 'delivered' == result ):
+            metrics.observe('vaxonbot_outbound_lag_seconds',max(0.0,time.time() - message.enqueued),lane=lane)
+
+        with self.condition:
+            self.busy.discard(message.chat_id)
+            self.in_flight[message.priority] -= 1
+            if ( retry_at is not None ):
+                self.paused[message.chat_id] = retry_at
+                if ( 'retry_after' == result ):
+                    self.broadcasts_paused = max(retry_at,self.broadcasts_paused)
+                self.push(message,first=True)
+            else :
+                self.chat_counts[message.chat_id] -= 1
+                if ( 0 == self.chat_counts[message.chat_id] ):
+                    del self.chat_counts[message.chat_id]
+                    self.paused.pop(message.chat_id,None)
+                self.done_ids.append(message.message_id)
+                if ( 'delivered' == result ):
+                    self.delivered_times.append(time.monotonic())
+            for priority in LANE_NAMES:
+                self.schedule(priority,message.chat_id,self.paused.get(message.chat_id,0))
+            self.condition.notify_all()
+
+    def flush_loop(self):
+        while True:
+            ## New messages are written at once, removals wait for them or for flush_seconds
+            with self.condition:
+                self.condition.wait_for(lambda : self.stopping or self.new_rows,self.flush_seconds)
+                if ( self.stopping ):
+                    return
+            self.flush()
+
+    def flush(self):
+        ## Writes the queued messages and removes the ones done with in one transaction, a message queued and
+        ## delivered since the last flush is inserted and deleted in the same transaction
+        with self.condition:
+            new_rows, self.new_rows = self.new_rows, []
+            done_ids, self.done_ids = self.done_ids, []
+        if ( not new_rows and not done_ids ):
+            return
+        try :
+            with self.db_lock, self.db:
+                self.db.executemany('INSERT INTO outbound (message_id, priority, chat_id, method, kwargs, enqueued) VALUES (?, ?, ?, ?, ?, ?)',new_rows)
+                self.db.executemany('DELETE FROM outbound WHERE message_id = ?',[ (message_id,) for message_id in done_ids ])
+        except sqlite3.Error as err:
+            logging.error(f'Could not write {len(new_rows)} new and remove {len(done_ids)} sent messages of the outbound queue :: {err}')
+            with self.condition:
+                self.new_rows = new_rows + self.new_rows
+                self.done_ids = done_ids + self.done_ids
+
+    def drain(self,chat_id=None,timeout=None):
+        ## Waits until nothing is pending or in flight, for chat_id only if given, returns False on timeout
+        with self.condition:
+            return self.condition.wait_for(lambda : (chat_id not in self.chat_counts) if chat_id is not None else not self.chat_counts,timeout)
+
+    def stop(self):
+        ## Lets the sends in flight finish, whatever is still pending stays in SQLite for the next start
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.flush()
+        with self.db_lock:
+            self.db.close()
+
+    def stats(self):
+        now = time.monotonic()
+        wall_now = time.time()
+        with self.condition:
+            while ( self.delivered_times and self.delivered_times[0] < now - self.RATE_WINDOW ):
+                self.delivered_times.popleft()
+            delivered = len(self.delivered_times)
+            queued = { LANE_NAMES[priority] : sum(len(chat_queue) for chat_queue in chats.values()) for priority, chats in self.pending.items() }
+            ## The head of a chat's queue is its oldest message, so the oldest of the heads is the lag of the lane
+            oldest = { LANE_NAMES[priority] : max((wall_now - chat_queue[0].enqueued for chat_queue in chats.values()),default=0)
+                       for priority, chats in self.pending.items() }
+            in_flight = { LANE_NAMES[priority] : count for priority, count in self.in_flight.items() }
+        return {'queued' : queued, 'in_flight' : in_flight, 'lag' : oldest, 'delivered_per_second' : delivered / self.RATE_WINDOW}
+
+
+
+
+"""
+function_name       :   util_reply
+input               :   app         ->  the App whose outbound queue the reply goes through
+                        update      ->  Updater context of the message to reply to
+                        text        ->  reply text
+                        kwargs      ->  passed on to send_message
+output              :   id of the queued message
+description         :   Queues a reply to the chat of update in the interactive lane of app.outbound
+"""
+
+def util_reply(app,update,text,**kwargs):
+    return app.outbound.send(update.effective_chat.id,text,**kwargs)
@@ -0,0 +1,145 @@
+## Includes for Utils
+import logging
+import json
+import threading
+import sqlite3
+from collections import defaultdict
+
+## Includes for Telegram API etc
+from telegram.ext import BasePersistence, ConversationHandler
+from telegram.ext.utils.promise import Promise
+
+from .config import PERSISTENCE_FILE, PERSISTENCE_FLUSH_SECONDS
+
+
+
+
+"""
+
+class_name          :   SqlitePersistence
+input               :   path            ->  SQLite database file
+                        flush_interval  ->  seconds between two batched writes
+description         :   Persistence for the ConversationHandler and user_data backed by SQLite in WAL mode
+                        Everything is read into memory once at startup and served from there,
+                        updates only mark the key dirty and a writer thread stores all dirty keys in one transaction
+                        every flush_interval seconds so handlers never wait on the disk
+                        Values are stored as JSON, conversation keys are tuples and are turned back into tuples on load
+                        A ConversationHandler keeps its states in the dict get_conversations hands it and changes that dict
+                        itself, so every update_conversation marks its key and the writer stores whatever the dict holds then
+
+"""
+
+class SqlitePersistence(BasePersistence):
+    def __init__(self,path=PERSISTENCE_FILE,flush_interval=PERSISTENCE_FLUSH_SECONDS):
+        super().__init__(store_user_data=True,store_chat_data=False,store_bot_data=False)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.db = sqlite3.connect(path,check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS conversations (name TEXT, key TEXT, state TEXT NOT NULL, PRIMARY KEY (name, key))')
+        self.db.commit()
+
+        self.user_data = defaultdict(dict)
+        for user_id, data in self.db.execute('SELECT user_id, data FROM user_data'):
+            self.user_data[user_id] = json.loads(data)
+        self.conversations = {}
+        for name, key, state in self.db.execute('SELECT name, key, state FROM conversations'):
+            self.conversations.setdefault(name,{})[tuple(json.loads(key))] = json.loads(state)
+
+        self.dirty_users = set()
+        self.dirty_conversations = set()
+        self.dirty_lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.writer = threading.Thread(target=self.write_loop,name='persistence-writer',daemon=True)
+        self.writer.start()
+
+    def get_user_data(self):
+        return self.user_data
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self,name):
+        return self.conversations.setdefault(name,{})
+
+    def update_user_data(self,user_id,data):
+        if ( self.user_data.get(user_id) == data ):
+            return
+        self.user_data[user_id] = data
+        with self.dirty_lock:
+            self.dirty_users.add(user_id)
+
+    def update_chat_data(self,chat_id,data):
+        pass
+
+    def update_bot_data(self,data):
+        pass
+
+    def update_conversation(self,name,key,new_state):
+        ## The handler has already put new_state in self.conversations[name], or removed the key for None
+        with self.dirty_lock:
+            self.dirty_conversations.add((name,key))
+
+    def write_loop(self):
+        while ( not self.stopped.wait(self.flush_interval) ):
+            self.write_dirty()
+
+    def write_dirty(self):
+        with self.dirty_lock:
+            dirty_users, self.dirty_users = self.dirty_users, set()
+            dirty_conversations, self.dirty_conversations = self.dirty_conversations, set()
+        if ( not dirty_users and not dirty_conversations ):
+            return
+        user_rows = [ (user_id, json.dumps(self.user_data[user_id])) for user_id in dirty_users if self.user_data.get(user_id) ]
+        removed_users = [ (user_id,) for user_id in dirty_users if not self.user_data.get(user_id) ]
+        conversation_rows = []
+        removed_conversations = []
+        running = set()
+        for name, key in dirty_conversations:
+            state = self.conversations.get(name,{}).get(key)
+            ## After a run_async handler the state is (state before it, Promise) until the next update of the conversation,
+            ## store the state the handler returned as the ConversationHandler will resolve it, or the state before it
+            ## while the handler still runs and write the key again on a later flush
+            while ( isinstance(state,tuple) and 2 == len(state) and isinstance(state[1],Promise) ):
+                old_state, promise = state
+                if ( not promise.done.is_set() ):
+                    running.add((name,key))
+                    state = old_state
+                    continue
+                try :
+                    new_state = promise.result(0)
+                except Exception:
+                    new_state = None
+                state = old_state if new_state is None else None if ConversationHandler.END == new_state else new_state
+            if ( state is None ):
+                removed_conversations.append((name, json.dumps(key)))
+            else :
+                conversation_rows.append((name, json.dumps(key), json.dumps(state)))
+        try :
+            with self.db_lock, self.db:
+                self.db.executemany('INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)',user_rows)
+                self.db.executemany('DELETE FROM user_data WHERE user_id = ?',removed_users)
+                self.db.executemany('INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',conversation_rows)
+                self.db.executemany('DELETE FROM conversations WHERE name = ? AND key = ?',removed_conversations)
+        except sqlite3.Error as err:
+            logging.error(f'Could not persist {len(dirty_users)} users {len(dirty_conversations)} conversations :: {err}')
+            with self.dirty_lock:
+                self.dirty_users |= dirty_users
+                self.dirty_conversations |= dirty_conversations
+            return
+        with self.dirty_lock:
+            self.dirty_conversations |= running
+
+    def flush(self):
+        ## Called by the Updater on shutdown
+        self.stopped.set()
+        self.writer.join()
+        self.write_dirty()
+        with self.db_lock:
+            self.db.close()
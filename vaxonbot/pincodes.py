@@ -0,0 +1,212 @@
+## Includes for Utils
+import logging
+import re
+import json
+import threading
+import csv
+from bisect import bisect_left
+from array import array
+
+from .config import PINCODE_INDEX_FILE, BY_DIST, BY_PIN
+from .upstream import http_get, send_http_request_with_age, HTTPError, RequestException, UpstreamBudgetExhausted
+
+
+
+
+"""
+
+class_name          :   PincodeIndex
+input               :   pincode_map ->  dict of pincode -> CoWIN district id (0 if the district is not known) 
+description         :   Compact in memory index of the valid six digit pincodes
+                        A bitset over 100000-999999 answers validity in O(1), the district id is found by bisecting
+                        a sorted array of the pincodes with a parallel array of district ids
+                        Pincodes looked up remotely are remembered in a separate dict along with the result
+
+"""
+
+class PincodeIndex:
+    FIRST_PIN = 100000
+    LAST_PIN = 999999
+
+    def __init__(self,pincode_map=None):
+        pincode_map = pincode_map or {}
+        self.valid_bits = bytearray((self.LAST_PIN - self.FIRST_PIN) // 8 + 1)
+        self.pincodes = array('I')
+        self.district_ids = array('H')
+        for pincode in sorted(int(pincode) for pincode in pincode_map):
+            offset = pincode - self.FIRST_PIN
+            self.valid_bits[offset >> 3] |= 1 << (offset & 7)
+            self.pincodes.append(pincode)
+            self.district_ids.append(int(pincode_map[str(pincode)] or 0))
+        self.remote = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pincodes)
+
+    def contains(self,pincode):
+        offset = int(pincode) - self.FIRST_PIN
+        if ( offset < 0 or offset > self.LAST_PIN - self.FIRST_PIN ):
+            return False
+        return bool(self.valid_bits[offset >> 3] & (1 << (offset & 7)))
+
+    def lookup(self,pincode):
+        ## Returns (valid, district_id) if known, locally or from an earlier remote lookup, None otherwise
+        pincode = int(pincode)
+        if ( self.contains(pincode) ):
+            district_id = self.district_ids[bisect_left(self.pincodes,pincode)]
+            return (True, district_id or None)
+        with self.lock:
+            return self.remote.get(pincode)
+
+    def remember(self,pincode,valid,district_id=None):
+        with self.lock:
+            self.remote[int(pincode)] = (valid, district_id)
+
+
+
+
+"""
+
+function_name       :   util_load_pincode_index
+input               :   path - location of the pincode -> district id json file
+output              :   PincodeIndex, empty if the file is not present
+description         :   Loads the offline pincode index, a missing file only means every pincode is looked up remotely
+
+"""
+
+def util_load_pincode_index(path=PINCODE_INDEX_FILE):
+    try :
+        with open(path) as index_file:
+            index = PincodeIndex(json.load(index_file))
+    except FileNotFoundError:
+        logging.warning(f'No pincode index at {path}, pincodes will be validated against India Post')
+        return PincodeIndex()
+    logging.info(f'Loaded {len(index)} pincodes from {path}')
+    return index
+
+
+
+
+"""
+
+function_name       :   util_district_id_by_name
+input               :   district_metadata   ->  DistrictMetadata to match against
+                        state_name          ->  state name as written by India Post, any case
+                        district_name       ->  district name as written by India Post, any case
+output              :   CoWIN district id or None if the names could not be matched
+description         :   Matches the names India Post uses against district_metadata ignoring case and punctuation
+                        and through NAME_ALIASES, never fuzzily since a pincode put in the wrong district is worse than none
+
+"""
+
+def util_district_id_by_name(district_metadata,state_name,district_name):
+    state = district_metadata.resolve_state(state_name,fuzzy=False)
+    if ( state is None or district_name.strip().isdigit() ):
+        return None
+    return district_metadata.resolve_district(district_name,state,fuzzy=False)
+
+
+
+
+"""
+
+function_name       :   util_build_pincode_index
+input               :   district_metadata   ->  DistrictMetadata the India Post district names are matched against
+                        csv_path            ->  the all India pincode directory CSV published by India Post on data.gov.in
+                        out_path            ->  where the pincode -> district id json is written
+output              :   number of pincodes written
+description         :   Builds the file read by util_load_pincode_index, run as
+                        python -m vaxonbot --build-pincode-index <csv_path> [out_path]
+
+"""
+
+def util_build_pincode_index(district_metadata,csv_path,out_path=PINCODE_INDEX_FILE):
+    pincode_map = {}
+    with open(csv_path,newline='',encoding='utf-8') as csv_file:
+        for row in csv.DictReader(csv_file):
+            row = { key.strip().lower() : value for key, value in row.items() if key }
+            pincode = row.get('pincode','').strip()
+            if ( not re.match(r'^[1-9][0-9]{5}$',pincode) ):
+                continue
+            district_id = util_district_id_by_name(district_metadata,row.get('statename',''),row.get('districtname',''))
+            if ( district_id is not None or pincode not in pincode_map ):
+                pincode_map[pincode] = district_id or 0
+    with open(out_path,'w') as out_file:
+        json.dump(pincode_map,out_file,separators=(',',':'),sort_keys=True)
+    logging.info(f'Wrote {len(pincode_map)} pincodes to {out_path}')
+    return len(pincode_map)
+
+
+
+
+"""
+
+function_name       :   util_validate_pincode
+input               :   app - the App whose pincode index is checked
+                        pincode - the text entered by user when prompted for PIN-code
+output              :   True or False based on validity of pincode provided
+description         :   This function is used to Validate the pincode provided by the user, first against a regex, then the offline
+                        app.pincode_index and only for pincodes not in it the INDIA post api, whose answer is remembered in it
+
+"""
+
+def util_validate_pincode(app,pincode):
+    ## Six digit pin code or not??
+    if not re.match(r'^[1-9][0-9]{5}$',str(pincode)):
+        return False
+    known = app.pincode_index.lookup(pincode)
+    if ( known is not None ):
+        return known[0]
+
+    ## API to check if URL exists at postal pincode
+    req_url= f'{app.config.POSTAL_PINCODE_API}/{pincode}'
+    try:
+        response = http_get(app,req_url,'postalpincode')
+    except HTTPError as http_err:
+        logging.error(f'HTTPError in validate_pincode{http_err}')
+        return False
+    except RequestException as err:
+        logging.error(f'Network error in util_validate_pincode {err}')
+        return False
+    except UpstreamBudgetExhausted as err:
+        logging.error(f'Postal pincode API busy in util_validate_pincode {err}')
+        return False
+
+    ## Taking the first object from the response     
+    json_obj = response.json()[0]
+    if (json_obj['Status'] != "Success" or not json_obj.get('PostOffice')):
+        logging.warning(f'Invalid PIN CODE {pincode}')
+        app.pincode_index.remember(pincode,False)
+        return False
+    post_office = json_obj['PostOffice'][0]
+    district_id = util_district_id_by_name(app.district_metadata,post_office.get('State',''),post_office.get('District',''))
+    app.pincode_index.remember(pincode,True,district_id)
+    return True
+
+
+
+
+"""
+
+function_name       :   util_calendar_by_pincode
+input               :   app - the App the calendar is looked up for
+                        pincode - a pincode already checked by util_validate_pincode
+output              :   (calendar JSON in the calendarByPin format or None on error, seconds since it was fetched)
+description         :   If the district of the pincode is known, the cached calendar of the whole district is filtered down
+                        to the centers in that pincode so that pincode and district queries share cache entries,
+                        otherwise calendarByPin is queried
+
+"""
+
+def util_calendar_by_pincode(app,pincode):
+    known = app.pincode_index.lookup(pincode)
+    if ( known is not None and known[1] is not None ):
+        response, age = send_http_request_with_age(app,BY_DIST,known[1])
+        if ( response is not None ):
+            resp_obj = response.json()
+            return ({ 'centers' : [ center for center in resp_obj['centers'] if str(center['pincode']) == str(pincode) ] }, age)
+    response, age = send_http_request_with_age(app,BY_PIN,pincode)
+    if ( response is None ):
+        return (None, 0)
+    return (response.json(), age)
@@ -0,0 +1,173 @@
+## Includes for Utils
+import logging
+import time
+import sys
+from bisect import bisect_left
+from array import array
+from collections import defaultdict
+
+from .config import CACHE_TTL_SECONDS, BY_DIST, PRIORITY_BACKGROUND
+from .calendars import CalendarCenter, CalendarSession, util_parse_calendar
+from .upstream import send_http_request_with_age
+
+
+
+
+"""
+
+class_name          :   AvailabilitySnapshot
+input               :   calendars   ->  dict of district id -> (calendar JSON, seconds since it was fetched)
+description         :   Read only columnar copy of the open sessions of some districts
+                        One row per session with capacity, the columns are arrays of the session date (yyyymmdd), the
+                        center (an index into the center columns), dose 1 and dose 2 capacity, min age and vaccine (an index into vaccines)
+                        Row ids are indexed by district, by pincode and by either of those with a min age, each index entry is
+                        sorted by date with a parallel array of the dates so a from_date is found by bisecting
+                        A snapshot is never modified, refresh_snapshot builds a new one and swaps app.availability_snapshot so readers never lock
+
+"""
+
+class AvailabilitySnapshot:
+    def __init__(self,calendars=None):
+        self.built_at = time.monotonic()
+        self.fetched_at = {}
+        self.vaccines = []
+        self.center_ids = array('I')
+        self.center_names = []
+        self.center_pincodes = array('I')
+        self.center_fee_types = []
+        self.dates = array('I')
+        self.centers = array('I')
+        self.dose1 = array('I')
+        self.dose2 = array('I')
+        self.min_ages = array('B')
+        self.vaccine_codes = array('B')
+        self.index = {}
+
+        vaccine_codes = {}
+        keyed_rows = defaultdict(list)
+        for district_id, (resp_obj, age) in (calendars or {}).items():
+            self.fetched_at[district_id] = self.built_at - age
+            for center, sessions in util_parse_calendar(resp_obj):
+                center_index = len(self.center_ids)
+                self.center_ids.append(center.center_id)
+                self.center_names.append(center.name)
+                self.center_pincodes.append(int(center.pincode))
+                self.center_fee_types.append(center.fee_type)
+                for session in sessions:
+                    row = len(self.dates)
+                    day, month, year = session.date.split('-')
+                    self.dates.append(int(year + month + day))
+                    self.centers.append(center_index)
+                    self.dose1.append(session.dose1)
+                    self.dose2.append(session.dose2)
+                    self.min_ages.append(session.min_age)
+                    self.vaccine_codes.append(vaccine_codes.setdefault(session.vaccine,len(vaccine_codes)))
+                    for key in (('district',district_id),('district',district_id,session.min_age),
+                                ('pincode',int(center.pincode)),('pincode',int(center.pincode),session.min_age)):
+                        keyed_rows[key].append(row)
+        self.vaccines = list(vaccine_codes)
+        for key, rows in keyed_rows.items():
+            rows.sort(key=lambda row : self.dates[row])
+            self.index[key] = (array('I',rows), array('I',( self.dates[row] for row in rows )))
+
+    def has_district(self,district_id,max_age=CACHE_TTL_SECONDS):
+        fetched_at = self.fetched_at.get(district_id)
+        return fetched_at is not None and time.monotonic() - fetched_at < max_age
+
+    def age(self,district_id=None):
+        ## Seconds since the data of district_id was fetched, of the oldest district if None
+        if ( district_id is None ):
+            return time.monotonic() - min(self.fetched_at.values(),default=self.built_at)
+        return time.monotonic() - self.fetched_at[district_id]
+
+    def lookup(self,district_id=None,pincode=None,min_age=None,dose=None,from_date=None):
+        ## Same result as util_parse_calendar, centers ordered by their earliest open session
+        key = ('pincode',int(pincode)) if pincode is not None else ('district',district_id)
+        rows, dates = self.index.get(key + ((min_age,) if min_age is not None else ()),(array('I'), array('I')))
+        start = bisect_left(dates,from_date) if from_date is not None else 0
+        capacity = self.dose1 if dose == 1 else self.dose2 if dose == 2 else None
+        available = {}
+        for row in rows[start:]:
+            if ( capacity is not None and capacity[row] <= 0 ):
+                continue
+            center_index = self.centers[row]
+            sessions = available.get(center_index)
+            if ( sessions is None ):
+                sessions = available[center_index] = []
+            date_text = str(self.dates[row])
+            sessions.append(CalendarSession(None,f'{date_text[6:]}-{date_text[4:6]}-{date_text[:4]}',self.vaccines[self.vaccine_codes[row]],
+                                            self.min_ages[row],self.dose1[row],self.dose2[row]))
+        return [ (CalendarCenter(self.center_ids[center_index],self.center_names[center_index],self.center_pincodes[center_index],
+                                 self.center_fee_types[center_index]),sessions) for center_index, sessions in available.items() ]
+
+    def calendar(self,district_id):
+        ## The rows of a district back in the calendar JSON format, to carry them over into the next snapshot
+        return {'centers' : [ {
+            'center_id' : center.center_id, 'name' : center.name, 'pincode' : center.pincode, 'fee_type' : center.fee_type,
+            'sessions'  : [ {'session_id' : session.session_id, 'date' : session.date, 'vaccine' : session.vaccine, 'min_age_limit' : session.min_age,
+                             'available_capacity_dose1' : session.dose1, 'available_capacity_dose2' : session.dose2} for session in sessions ],
+        } for center, sessions in self.lookup(district_id) ]}
+
+    def nbytes(self):
+        ## Memory held by the snapshot, the column and index arrays plus the center strings
+        columns = (self.center_ids, self.center_pincodes, self.dates, self.centers, self.dose1, self.dose2, self.min_ages, self.vaccine_codes)
+        size = sum(column.itemsize * len(column) for column in columns)
+        size += sum(rows.itemsize * len(rows) + dates.itemsize * len(dates) for rows, dates in self.index.values())
+        size += sum(sys.getsizeof(text) for text in self.center_names + self.center_fee_types + self.vaccines)
+        return size + sys.getsizeof(self.index)
+
+    def stats(self):
+        return {'districts' : len(self.fetched_at), 'sessions' : len(self.dates), 'bytes' : self.nbytes(),
+                'age' : self.age() if self.fetched_at else 0}
+
+
+
+
+"""
+
+function_name       :   refresh_snapshot
+input               :   cb_context  ->  callback context of the repeating job, its context is the App
+output              :   None
+description         :   Builds a new AvailabilitySnapshot of the HOT_DISTRICTS and swaps it in
+                        Calendars come through send_http_request_with_age at background priority, so users share the fetches
+                        and a district that can't be fetched keeps the data of the current snapshot until it is too old to serve
+
+"""
+
+def refresh_snapshot(cb_context):
+    app = cb_context.job.context
+    current = app.availability_snapshot
+    calendars = {}
+    for district_id in app.config.HOT_DISTRICTS:
+        response, age = send_http_request_with_age(app,BY_DIST,district_id,PRIORITY_BACKGROUND)
+        if ( response is not None ):
+            calendars[district_id] = (response.json(), age)
+        elif ( current.has_district(district_id,app.config.CACHE_TTL_SECONDS) ):
+            calendars[district_id] = (current.calendar(district_id), current.age(district_id))
+    app.availability_snapshot = AvailabilitySnapshot(calendars)
+    logging.info(f'Availability snapshot of {len(calendars)} districts :: {app.availability_snapshot.stats()}')
+
+
+
+
+"""
+
+function_name       :   util_snapshot_lookup
+input               :   app         ->  the App whose snapshot is looked in
+                        district_id ->  district id, as int or text
+                        pincode     ->  pincode already checked by util_validate_pincode, used instead of district_id if given
+output              :   util_parse_calendar style list of the open centers, None if the snapshot can't answer
+description         :   Answers from app.availability_snapshot when the district (of the pincode) is in it and fresh enough
+
+"""
+
+def util_snapshot_lookup(app,district_id=None,pincode=None):
+    snapshot = app.availability_snapshot
+    if ( pincode is not None ):
+        known = app.pincode_index.lookup(pincode)
+        district_id = known[1] if known is not None else None
+    if ( not str(district_id).isdigit() or not snapshot.has_district(int(district_id),app.config.CACHE_TTL_SECONDS) ):
+        return None
+    if ( pincode is not None ):
+        return snapshot.lookup(pincode=pincode)
+    return snapshot.lookup(int(district_id))
@@ -0,0 +1,167 @@
+## Includes for Utils
+import logging
+import json
+import threading
+import sqlite3
+from collections import namedtuple
+
+from .config import PRIORITY_BACKGROUND, PERSISTENCE_FILE
+from .calendars import util_render_center, util_pack_messages
+from .feed import util_opened_doses
+from .upstream import send_http_request
+
+
+
+
+"""
+
+class_name          :   SubscriptionRegistry
+input               :   path        ->  SQLite database file the subscriptions are kept in, the persistence file of the bot
+                        shard       ->  (shard, workers) of a cluster worker, only the chats the router sends it are loaded
+description         :   Holds the /subscribe requests of every chat grouped by the calendar they need
+                        A target is (BY_DIST, district_id) or (BY_PIN, pincode) for pincodes whose district is not known,
+                        the same key change_feed uses, so every poll fetches each target once however many chats are subscribed to it
+                        add refuses a subscription once the chat holds limit of them, repeating one it already holds is fine
+                        Every change is written to SQLite before add or remove_chat returns, subscriptions are rare enough not
+                        to need batching, and everything is loaded again on the next start
+                        Cluster workers share the file, each loads the chats with chat id modulo workers equal to its shard
+                        so a chat is alerted by the worker that handled its /subscribe and by no other
+
+"""
+
+Subscription = namedtuple('Subscription', ['chat_id', 'pincode', 'min_age', 'dose'])
+
+class SubscriptionRegistry:
+    def __init__(self,path=PERSISTENCE_FILE,shard=None):
+        self.by_target = {}
+        self.chat_counts = {}
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path,check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS subscriptions (target TEXT NOT NULL, subscription TEXT NOT NULL, chat_id INTEGER NOT NULL, '
+                        'PRIMARY KEY (target, subscription))')
+        self.db.commit()
+        loaded = 0
+        for target, subscription in self.db.execute('SELECT target, subscription FROM subscriptions ORDER BY rowid'):
+            subscription = Subscription(*json.loads(subscription))
+            if ( shard is not None and subscription.chat_id % shard[1] != shard[0] ):
+                continue
+            self.by_target.setdefault(tuple(json.loads(target)),[]).append(subscription)
+            self.chat_counts[subscription.chat_id] = self.chat_counts.get(subscription.chat_id,0) + 1
+            loaded += 1
+        if ( loaded ):
+            logging.info(f'Loaded {loaded} subscriptions from {path}')
+
+    def add(self,target,subscription,limit=None):
+        ## Returns False if the chat already holds limit subscriptions
+        with self.lock:
+            subscriptions = self.by_target.get(target,[])
+            if ( subscription in subscriptions ):
+                return True
+            count = self.chat_counts.get(subscription.chat_id,0)
+            if ( limit is not None and count >= limit ):
+                return False
+            self.by_target.setdefault(target,[]).append(subscription)
+            self.chat_counts[subscription.chat_id] = count + 1
+            with self.db:
+                self.db.execute('INSERT OR IGNORE INTO subscriptions (target, subscription, chat_id) VALUES (?, ?, ?)',
+                                (json.dumps(target), json.dumps(subscription), subscription.chat_id))
+        return True
+
+    def remove_chat(self,chat_id):
+        removed = 0
+        with self.lock:
+            for target in list(self.by_target):
+                kept = [ subscription for subscription in self.by_target[target] if subscription.chat_id != chat_id ]
+                removed += len(self.by_target[target]) - len(kept)
+                if ( [] == kept ):
+                    del self.by_target[target]
+                else :
+                    self.by_target[target] = kept
+            self.chat_counts.pop(chat_id,None)
+            with self.db:
+                self.db.execute('DELETE FROM subscriptions WHERE chat_id = ?',(chat_id,))
+        return removed
+
+    def targets(self):
+        with self.lock:
+            return { target : list(subscriptions) for target, subscriptions in self.by_target.items() }
+
+    def subscriptions(self,target):
+        with self.lock:
+            return list(self.by_target.get(target,[]))
+
+
+
+
+"""
+
+function_name       :   util_matching_alerts
+input               :   subscriptions   ->  the subscriptions of one target
+                        changes         ->  CalendarChange list of a change_feed delta for that target
+output              :   dict of chat_id -> list of (CalendarCenter, CalendarSession) to alert that chat about
+description         :   Applies each subscription's pincode, min_age and dose filters to the sessions in which a dose opened up
+
+"""
+
+def util_matching_alerts(subscriptions,changes):
+    alerts = {}
+    for change in changes:
+        opened_doses = util_opened_doses(change)
+        if ( not opened_doses ):
+            continue
+        for subscription in subscriptions:
+            if ( subscription.pincode is not None and str(change.center.pincode) != subscription.pincode ):
+                continue
+            if ( subscription.dose is not None and subscription.dose not in opened_doses ):
+                continue
+            if ( subscription.min_age is not None and change.after.min_age != subscription.min_age ):
+                continue
+            alerts.setdefault(subscription.chat_id,[]).append((change.center,change.after))
+    return alerts
+
+
+
+
+"""
+
+function_name       :   poll_subscriptions
+input               :   cb_context      ->  callback context of the repeating job, its context is the App
+output              :   None
+description         :   Run every SUBSCRIPTION_POLL_SECONDS by the job queue, makes sure every subscribed target is fetched
+                        at least that often, what changed reaches send_alerts through change_feed
+
+"""
+
+def poll_subscriptions(cb_context):
+    app = cb_context.job.context
+    targets = app.subscription_registry.targets()
+    logging.info(f'Polling {len(targets)} subscription targets')
+    for target in targets:
+        if ( send_http_request(app,target[0],target[1],PRIORITY_BACKGROUND) is None ):
+            logging.error(f'Could not poll subscription target {target}')
+
+
+
+
+"""
+
+function_name       :   send_alerts
+input               :   app         ->  the App whose subscriptions are alerted
+                        delta       ->  CalendarDelta from change_feed
+output              :   None
+description         :   Change feed subscriber sending one alert per subscribed chat listing the sessions that opened up,
+                        whichever fetch of the calendar found them, a user query or poll_subscriptions
+                        Alerts go in the broadcast lane of app.outbound so they never hold up replies
+
+"""
+
+def send_alerts(app,delta):
+    subscriptions = app.subscription_registry.subscriptions(delta.key)
+    if ( not subscriptions ):
+        return
+    for chat_id, sessions in util_matching_alerts(subscriptions,delta.changes).items():
+        blocks = ['New slots just opened up'] + [ util_render_center(center,[session]) for center, session in sessions ]
+        for alert in util_pack_messages(blocks):
+            app.outbound.send(chat_id,alert,priority=PRIORITY_BACKGROUND)
+
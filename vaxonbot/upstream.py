@@ -0,0 +1,479 @@
+## Includes for Utils
+import logging
+from datetime import date
+import time
+import threading
+import random
+import heapq
+import itertools
+from collections import OrderedDict, namedtuple
+
+## Includes for API requests
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, RequestException
+
+from .config import (
+    UPSTREAM_BUDGETS, PRIORITY_INTERACTIVE, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX, HTTP_POOL_SIZE, CACHE_TTL_SECONDS,
+    CACHE_MAX_ENTRIES, CACHE_STALE_SECONDS, BY_DIST, BY_PIN,
+)
+from .instrumentation import LatencyRecorder, metrics, util_endpoint_name
+
+
+
+
+"""
+class_name          :   TokenBucket
+input               :   rate        ->  tokens added per second
+                        capacity    ->  maximum tokens held, the size of a burst
+description         :   Thread safe token bucket, acquire blocks until a token is available
+"""
+
+class TokenBucket:
+    def __init__(self,rate,capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        ## Takes a token if there is one, otherwise returns the seconds until the next token
+        with self.lock:
+            self.refill()
+            if ( self.tokens >= 1 ):
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        ## Gives back a token taken by try_acquire that ended up unused
+        with self.lock:
+            self.tokens = min(self.capacity,self.tokens + 1)
+
+    def acquire(self):
+        wait = self.try_acquire()
+        while ( wait > 0 ):
+            time.sleep(wait)
+            wait = self.try_acquire()
+
+
+
+
+"""
+
+class_name      :  UpstreamBudget
+input           :  budgets         ->   dict of upstream -> (calls per second, burst), upstreams not in it are not limited
+description     :  Token buckets limiting how often each upstream is called, and the queue of calls waiting on them
+                   Waiting calls are ordered by priority and then arrival, only the head of the queue takes tokens
+                   so interactive queries always go ahead of background polling
+                   Buckets are local to the process unless a shared store is attached with use_store,
+                   then every worker takes tokens from the same buckets in the store
+                   The priority queue stays local to the process though, so with a shared store priority only orders the calls
+                   of one worker and a background call of one worker may take a token an interactive call of another is waiting for
+                   use_store takes a function returning the calling thread's SharedState proxy
+
+"""
+
+class UpstreamBudgetExhausted(Exception):
+    pass
+
+
+class UpstreamBudget:
+    def __init__(self,budgets=UPSTREAM_BUDGETS):
+        self.budgets = budgets
+        self.buckets = {}
+        self.store = None
+        self.lock = threading.Lock()
+        self.queue_changed = threading.Condition()
+        self.queues = {}
+        self.sequence = itertools.count()
+        self.wait_times = LatencyRecorder()
+        self.exhausted = 0
+
+    def use_store(self,store_for_thread):
+        self.store = store_for_thread
+
+    def try_acquire(self,upstream):
+        ## Returns 0 if a call may be made now, otherwise the seconds until it may
+        if ( upstream not in self.budgets ):
+            return 0
+        rate, burst = self.budgets[upstream]
+        if ( self.store is not None ):
+            return self.store().take_token(upstream,rate,burst)
+        with self.lock:
+            if ( upstream not in self.buckets ):
+                self.buckets[upstream] = TokenBucket(rate,burst)
+        return self.buckets[upstream].try_acquire()
+
+    def acquire(self,upstream,priority=PRIORITY_INTERACTIVE,timeout=None):
+        ## Waits in the queue of upstream for a token, returns False if none was given within timeout seconds
+        if ( upstream not in self.budgets ):
+            return True
+        started = time.monotonic()
+        granted = False
+        with self.queue_changed:
+            entry = (priority, next(self.sequence))
+            waiting = self.queues.setdefault(upstream,[])
+            heapq.heappush(waiting,entry)
+            try :
+                while True:
+                    ## Only the head of the queue takes tokens, the rest sleep until the head changes
+                    wait = None
+                    if ( waiting[0] == entry ):
+                        wait = self.try_acquire(upstream)
+                        if ( wait <= 0 ):
+                            granted = True
+                            break
+                    if ( timeout is not None ):
+                        remaining = started + timeout - time.monotonic()
+                        if ( remaining <= 0 ):
+                            break
+                        wait = remaining if wait is None else min(wait,remaining)
+                    self.queue_changed.wait(wait)
+            finally :
+                waiting.remove(entry)
+                heapq.heapify(waiting)
+                self.queue_changed.notify_all()
+        self.wait_times.record((upstream, priority),time.monotonic() - started)
+        if ( not granted ):
+            self.exhausted += 1
+        return granted
+
+    def stats(self):
+        with self.queue_changed:
+            queued = { upstream : len(waiting) for upstream, waiting in self.queues.items() }
+        return {'queued' : queued, 'exhausted' : self.exhausted, 'wait' : self.wait_times.percentiles()}
+
+
+
+
+"""
+
+function_name   :  util_http_session
+input           :  pool_size       ->   connections kept open per host
+output          :  requests.Session for every upstream call of an App
+description     :  One keep-alive session shared by every upstream call, urllib3 keeps a separate connection pool per host
+
+"""
+
+def util_http_session(pool_size=HTTP_POOL_SIZE):
+    http_session = requests.Session()
+    http_session.mount('https://',HTTPAdapter(pool_connections=4,pool_maxsize=pool_size))
+    http_session.mount('http://',HTTPAdapter(pool_connections=4,pool_maxsize=pool_size))
+    return http_session
+
+
+
+
+"""
+
+function_name   :  util_backoff_delay
+input           :  attempt         ->   number of attempts already made, starting at 0
+                   response        ->   the last response received if any, used to honour Retry-After
+                   base            ->   seconds the backoff starts from, doubled with every attempt
+                   cap             ->   most seconds the backoff grows to
+output          :  seconds to sleep before the next attempt
+description     :  Full jitter exponential backoff capped at cap, a Retry-After header from a 429/503 takes precedence
+                   and is returned as sent, even when it is longer than cap
+
+"""
+
+def util_backoff_delay(attempt,response=None,base=HTTP_BACKOFF_BASE,cap=HTTP_BACKOFF_MAX):
+    if ( response is not None ):
+        retry_after = response.headers.get('Retry-After')
+        if ( retry_after is not None and retry_after.strip().isdigit() ):
+            return float(retry_after)
+    return random.uniform(0,min(cap,base * (2 ** attempt)))
+
+
+
+
+"""
+
+function_name   :  http_get
+input           :  app             ->   the App whose session, budget and upstream slots are used
+                   req_url         ->   url to GET
+                   upstream        ->   name the latency samples of this call are recorded under
+                   priority        ->   PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND, its place in the app.upstream_budget queue
+output          :  returns the response, raises HTTPError or RequestException once retries are exhausted
+                   and UpstreamBudgetExhausted if no budget was given within UPSTREAM_MAX_WAIT[priority]
+                   or the upstream asked with Retry-After to wait longer than HTTP_BACKOFF_MAX
+description     :  GET through the shared app.http_session with HTTP_TIMEOUT, retrying network errors and
+                   HTTP_RETRY_STATUSES up to HTTP_MAX_RETRIES times with util_backoff_delay in between
+                   Every attempt waits for a token from app.upstream_budget first, all of these settings are read from app.config
+
+"""
+
+def http_get(app,req_url,upstream,priority=PRIORITY_INTERACTIVE):
+    config = app.config
+    attempt = 0
+    while True:
+        response = None
+        if ( not app.upstream_budget.acquire(upstream,priority,config.UPSTREAM_MAX_WAIT[priority]) ):
+            raise UpstreamBudgetExhausted(f'No {upstream} budget left for priority {priority}')
+        started = time.monotonic()
+        try :
+            with app.upstream_slots:
+                response = app.http_session.get(req_url,timeout=config.HTTP_TIMEOUT)
+        except RequestException as err:
+            if ( attempt >= config.HTTP_MAX_RETRIES ):
+                raise
+            logging.warning(f'Network error from {upstream} attempt {attempt} :: {err}')
+        else :
+            if ( response.status_code not in config.HTTP_RETRY_STATUSES or attempt >= config.HTTP_MAX_RETRIES ):
+                response.raise_for_status()
+                return response
+            logging.warning(f'{upstream} returned {response.status_code} attempt {attempt}')
+        finally :
+            elapsed = time.monotonic() - started
+            app.upstream_latency.record(upstream,elapsed)
+            endpoint = util_endpoint_name(req_url)
+            metrics.observe('vaxonbot_upstream_seconds',elapsed,endpoint=endpoint)
+            metrics.inc('vaxonbot_upstream_requests_total',endpoint=endpoint,status=response.status_code if response is not None else 'error')
+        delay = util_backoff_delay(attempt,response,config.HTTP_BACKOFF_BASE,config.HTTP_BACKOFF_MAX)
+        ## Retrying before the Retry-After the upstream sent only earns more 429s, a wait that long is left to the stale data path
+        if ( delay > config.HTTP_BACKOFF_MAX ):
+            raise UpstreamBudgetExhausted(f'{upstream} asked to retry after {delay:.0f}s')
+        time.sleep(delay)
+        attempt += 1
+
+
+
+
+"""
+
+class_name      :  ResponseCache
+input           :  ttl             ->   seconds an entry is served before it is fetched again
+                   max_entries     ->   maximum number of keys held, least recently used key is evicted first
+                   stale_ttl       ->   seconds an expired entry is kept to be served when the upstream budget is used up
+description     :  Thread safe TTL + LRU cache used in front of the CoWIN calendar API
+                   Concurrent misses on the same key are collapsed so that only one thread hits upstream,
+                   the others wait for it and share the result. Failed fetches (None) are never cached
+                   A waiting thread gives up after max_wait seconds, since the thread fetching may be background polling
+                   queued behind every interactive call, and serves the expired entry or fetches at its own priority
+                   If the fetch raises UpstreamBudgetExhausted the expired entry is served instead when there is one
+                   get_or_fetch returns (value, seconds since value was fetched), cached tells if it would without fetching
+
+"""
+
+class ResponseCache:
+    def __init__(self,ttl=CACHE_TTL_SECONDS,max_entries=CACHE_MAX_ENTRIES,stale_ttl=CACHE_STALE_SECONDS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_served = 0
+
+    def get_or_fetch(self,key,fetch,max_wait=None):
+        stale = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if ( entry is not None ):
+                stored_at, value = entry
+                age = time.monotonic() - stored_at
+                if ( age < self.ttl ):
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return (value, age)
+                if ( age < self.stale_ttl ):
+                    stale = entry
+                else :
+                    del self.entries[key]
+            self.misses += 1
+            ## Somebody else is already fetching this key, wait on their result instead
+            waiter = self.in_flight.get(key)
+            if ( waiter is None ):
+                waiter = self.in_flight[key] = {'done' : threading.Event(), 'result' : (None, 0)}
+                leader = True
+            else :
+                leader = False
+
+        if ( not leader ):
+            if ( waiter['done'].wait(max_wait) ):
+                return waiter['result']
+            if ( stale is not None ):
+                logging.warning(f'Fetch of {key} still running after {max_wait}s, serving it from {stale[0]}')
+                with self.lock:
+                    self.stale_served += 1
+                return (stale[1], time.monotonic() - stale[0])
+            return self.fetch_stale_on_exhausted(key,fetch,None)
+
+        result = (None, 0)
+        try :
+            result = self.fetch_stale_on_exhausted(key,fetch,stale)
+        finally :
+            with self.lock:
+                del self.in_flight[key]
+            waiter['result'] = result
+            waiter['done'].set()
+        return result
+
+    def cached(self,key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and time.monotonic() - entry[0] < self.ttl
+
+    def fetch_stale_on_exhausted(self,key,fetch,stale):
+        ## Fetches key and caches a value that is not None, serves stale if the budget is used up
+        try :
+            value = fetch()
+        except UpstreamBudgetExhausted as err:
+            if ( stale is not None ):
+                logging.warning(f'{err}, serving {key} from {stale[0]}')
+                with self.lock:
+                    self.stale_served += 1
+                return (stale[1], time.monotonic() - stale[0])
+            logging.error(f'{err}, nothing cached for {key}')
+            return (None, 0)
+        if ( value is not None ):
+            with self.lock:
+                self.entries[key] = (time.monotonic(),value)
+                self.entries.move_to_end(key)
+                while ( len(self.entries) > self.max_entries ):
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        return (value, 0)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits'          : self.hits,
+                'misses'        : self.misses,
+                'evictions'     : self.evictions,
+                'stale_served'  : self.stale_served,
+                'size'          : len(self.entries),
+            }
+
+
+
+
+"""
+
+class_name      :  CalendarResponse
+description     :  What the calendar caches keep of a CoWIN response, the status, the parsed JSON and the unix time it was fetched
+                   Small enough to pickle through the shared store on every hit, which a requests.Response with its headers,
+                   raw stream and body is not. json() returns the parsed JSON like the Response did, callers must not modify it
+
+"""
+
+class CalendarResponse(namedtuple('CalendarResponse', ['status', 'payload', 'fetched_at'])):
+    __slots__ = ()
+
+    def json(self):
+        return self.payload
+
+
+
+
+"""
+
+function_name   :  fetch_calendar_upstream
+input           :  app             ->   the App the call is made for
+                   req_type        ->   enum identifying the type of request to be made
+                   req_details     ->   integer containing district id or pincode depending on req_type
+                   req_date        ->   date string in dd-mm-YYYY the calendar starts from
+                   priority        ->   priority of the request in the app.upstream_budget queue
+output          :  returns None if error invalid input, the CalendarResponse otherwise
+                   UpstreamBudgetExhausted from http_get is passed on for the cache to fall back on stale data
+description     :  creates http request based on req_type and req_details provided and returns None or response obtained
+                   always goes to the CoWIN API, use send_http_request to go through the cache
+
+"""
+
+def fetch_calendar_upstream(app,req_type,req_details,req_date,priority=PRIORITY_INTERACTIVE):
+    calendar_api = app.config.CALENDAR_API
+    if req_type == BY_DIST:
+        req_url = f'{calendar_api}/calendarByDistrict?district_id={req_details}&date={req_date}'
+    elif req_type == BY_PIN:
+        req_url = f'{calendar_api}/calendarByPin?pincode={req_details}&date={req_date}'
+    else :
+        return None
+    try :
+        response = http_get(app,req_url,'cowin',priority)
+    except HTTPError as http_err:
+        logging.error(f'HTTP error occurred :: {http_err}')
+        return None
+    except RequestException as err:
+        logging.error(f'Network error occurred :: {err}')
+        return None
+    try :
+        payload = response.json()
+    except ValueError as err:
+        logging.error(f'CoWIN returned a calendar that is not JSON :: {err}')
+        return None
+    app.change_feed.observe((req_type,str(req_details)),response.content)
+    return CalendarResponse(response.status_code,payload,time.time())
+
+
+
+
+"""
+
+function_name   :  util_calendar_key, util_calendar_cached
+input           :  req_type, req_details as for send_http_request_with_age
+                   req_date        ->   date string in dd-mm-YYYY the calendar starts from
+output          :  the app.calendar_cache key of the calendar, whether send_http_request_with_age would answer it without CoWIN
+
+"""
+
+def util_calendar_key(req_type,req_details,req_date):
+    return (req_type,str(req_details).strip(),req_date)
+
+def util_calendar_cached(app,req_type,req_details):
+    return app.calendar_cache.cached(util_calendar_key(req_type,req_details,date.today().strftime("%d-%m-%Y")))
+
+
+
+
+"""
+
+function_name   :  send_http_request_with_age
+input           :  app             ->   the App the calendar is looked up for
+                   req_type        ->   enum identifying the type of request to be made
+                   req_details     ->   integer containing district id or pincode depending on req_type
+                   priority        ->   PRIORITY_INTERACTIVE for user queries, PRIORITY_BACKGROUND for polling
+output          :  (response, age) response is the CalendarResponse, None on error, age is the seconds since it was fetched from CoWIN
+description     :  Looks up today's calendar for req_type and req_details in app.calendar_cache and only
+                   creates an http request on a miss or once the cached response is older than CACHE_TTL_SECONDS
+                   When the upstream budget is used up, or another thread's fetch of it takes longer than
+                   UPSTREAM_MAX_WAIT[priority], an older cached response is returned with its age
+
+"""
+
+def send_http_request_with_age(app,req_type,req_details,priority=PRIORITY_INTERACTIVE):
+    if req_type not in (BY_DIST,BY_PIN):
+        return (None, 0)
+    today = date.today().strftime("%d-%m-%Y")
+    cache_key = util_calendar_key(req_type,req_details,today)
+    ## The cache, budget and upstream latency stats are exported on /metrics, a lookup does not collect them
+    return app.calendar_cache.get_or_fetch(cache_key,lambda : fetch_calendar_upstream(app,req_type,req_details,today,priority),
+                                           app.config.UPSTREAM_MAX_WAIT[priority])
+
+
+
+
+"""
+
+function_name   :  send_http_request
+input           :  app             ->   the App the calendar is looked up for
+                   req_type        ->   enum identifying the type of request to be made
+                   req_details     ->   integer containing district id or pincode depending on req_type
+                   priority        ->   PRIORITY_INTERACTIVE for user queries, PRIORITY_BACKGROUND for polling
+output          :  returns None if error invalid input, the CalendarResponse otherwise
+description     :  send_http_request_with_age for callers that don't show how old the data is
+
+"""
+
+def send_http_request(app,req_type,req_details,priority=PRIORITY_INTERACTIVE):
+    return send_http_request_with_age(app,req_type,req_details,priority)[0]
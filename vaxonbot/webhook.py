@@ -0,0 +1,166 @@
+## Includes for Utils
+import logging
+import json
+import time
+import threading
+import queue
+import signal
+from http.server import BaseHTTPRequestHandler
+
+## Includes for Telegram API etc
+from telegram import Update
+
+from .config import WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS
+from .instrumentation import LatencyRecorder, metrics
+from .cluster import UpdateHTTPServer, util_update_chat_id
+
+
+
+
+"""
+
+class_name          :   WebhookServer
+input               :   dispatcher  ->  the dispatcher updates are handed to
+                        listen      ->  address to listen on
+                        port        ->  port to listen on
+                        path        ->  only POSTs to /path are accepted
+                        queue_size  ->  updates accepted but not yet picked up, split evenly between the workers
+                        workers     ->  number of threads processing updates
+description         :   Receives updates POSTed by Telegram, or by anyone replaying recorded Update JSON, on a threaded HTTP server
+                        Every worker has a bounded queue of its own and each chat's updates go to the queue of one worker
+                        (chat id modulo workers, as the cluster router does), so a chat's updates are handled one at a time
+                        in the order they arrived while different chats run in parallel. The conversation state and user_data
+                        of a chat are never changed by two updates at once even though handlers don't run async in this mode
+                        When the queue of the chat's worker is full the POST is answered with 503 and Retry-After
+                        so Telegram backs off and redelivers instead of the bot queueing without limit
+                        Time from intake to the handler returning, with its replies queued in app.outbound, is recorded in
+                        latency as intake_to_handled, their delivery is in vaxonbot_outbound_lag_seconds. run_webhook adds
+                        runtime_gauges to the metrics collectors, which exports its percentiles and the queued updates on /metrics
+                        stop closes the listener first and then drains the queues so accepted updates are not lost
+
+"""
+
+class WebhookServer:
+    def __init__(self,dispatcher,listen=WEBHOOK_LISTEN,port=WEBHOOK_PORT,path=WEBHOOK_PATH,queue_size=WEBHOOK_QUEUE_SIZE,workers=WEBHOOK_WORKERS):
+        self.dispatcher = dispatcher
+        self.latency = LatencyRecorder()
+        self.path = '/' + path.strip('/')
+        self.queues = [ queue.Queue(maxsize=max(1,queue_size // workers)) for _ in range(workers) ]
+        self.workers = [ threading.Thread(target=self.work,args=(updates,),name=f'webhook-worker-{worker}',daemon=True)
+                         for worker, updates in enumerate(self.queues) ]
+        self.httpd = UpdateHTTPServer((listen,port),self.request_handler())
+        self.server_thread = threading.Thread(target=self.httpd.serve_forever,name='webhook-server',daemon=True)
+
+    def request_handler(self):
+        webhook = self
+
+        class UpdateRequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                received = time.monotonic()
+                if ( self.path != webhook.path ):
+                    return self.reply(404)
+                try :
+                    data = json.loads(self.rfile.read(int(self.headers.get('Content-Length',0))))
+                    update = Update.de_json(data,webhook.dispatcher.bot)
+                    updates = webhook.queues[util_update_chat_id(data) % len(webhook.queues)]
+                except (ValueError, TypeError, KeyError) as err:
+                    logging.warning(f'Bad update POSTed to the webhook :: {err}')
+                    return self.reply(400)
+                try :
+                    updates.put_nowait((received,update))
+                except queue.Full:
+                    logging.warning('Webhook queue full, asking for redelivery')
+                    return self.reply(503,{'Retry-After' : '1'})
+                self.reply(200)
+
+            def reply(self,status,headers=None):
+                self.send_response(status)
+                for header, value in (headers or {}).items():
+                    self.send_header(header,value)
+                self.send_header('Content-Length','0')
+                self.end_headers()
+
+            def log_message(self,format,*args):
+                logging.debug(f'webhook :: {format % args}')
+
+        return UpdateRequestHandler
+
+    def work(self,updates):
+        while True:
+            item = updates.get()
+            if ( item is None ):
+                updates.task_done()
+                return
+            received, update = item
+            try :
+                self.dispatcher.process_update(update)
+            finally :
+                self.latency.record('intake_to_handled',time.monotonic() - received)
+                updates.task_done()
+
+    def runtime_gauges(self):
+        ## Metrics collector, the latency over the last LatencyRecorder window as the quantiles of a summary
+        samples = [ ('vaxonbot_webhook_queued', {}, sum(updates.qsize() for updates in self.queues)) ]
+        for stage, latency in self.latency.percentiles().items():
+            for point in (50,90,99):
+                samples.append(('vaxonbot_webhook_latency_seconds', {'stage' : stage, 'quantile' : point / 100}, latency[f'p{point}']))
+        return samples
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.server_thread.start()
+        logging.info(f'Webhook listening on {self.httpd.server_address} {self.path}')
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for updates in self.queues:
+            updates.join()
+            updates.put(None)
+        for worker in self.workers:
+            worker.join()
+        logging.info(f'Webhook stopped, latency :: {self.latency.percentiles()}')
+
+
+
+
+"""
+
+function_name       :   run_webhook
+input               :   app         ->  the App whose webhook settings are used
+                        updater     ->  the Updater built by create_updater, only its dispatcher, job queue and persistence are used
+                        port        ->  port the webhook listens on
+output              :   None
+description         :   Serves updates with WebhookServer until SIGINT/SIGTERM and then shuts down in order,
+                        intake first, then queued updates and running handlers, the sends in flight and persistence last
+
+"""
+
+def run_webhook(app,updater,port=WEBHOOK_PORT):
+    config = app.config
+    webhook = WebhookServer(updater.dispatcher,config.WEBHOOK_LISTEN,port,config.WEBHOOK_PATH,config.WEBHOOK_QUEUE_SIZE,config.WEBHOOK_WORKERS)
+    ## Cluster workers sit behind the router which is the address Telegram knows
+    if ( config.WEBHOOK_URL is not None and config.WEBHOOK_PORT == port ):
+        updater.bot.set_webhook(f'{config.WEBHOOK_URL.rstrip("/")}/{config.WEBHOOK_PATH.strip("/")}')
+    else :
+        logging.warning('WEBHOOK_URL not set, the webhook is not registered with Telegram')
+    updater.job_queue.start()
+    metrics.add_collector(webhook.runtime_gauges)
+    webhook.start()
+
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum,lambda signum, frame : stopping.set())
+    while ( not stopping.wait(1) ):
+        pass
+
+    logging.info('Stopping webhook')
+    webhook.stop()
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+    app.outbound.stop()
+    if ( updater.persistence ):
+        updater.dispatcher.update_persistence()
+        updater.persistence.flush()
+